@@ -0,0 +1,81 @@
+"""
+Compares the throughput (events/s) and the peak memory (RSS) of the .lhe readers.
+
+Usage:
+    python -m PyLHE_EventAnalysis.benchmarks.bench_reader path/to/file.lhe [--readers pylhe builtin builtin-batches]
+
+Each reader runs in a fresh process, so the peak RSS of one reader does not affect the others.
+"""
+
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+
+
+def _load_reader(reader_name: str):
+    """Returns the reader function and whether it yields EventBatch chunks."""
+    if reader_name == "pylhe":
+        import pylhe
+        return pylhe.read_lhe, False
+    if reader_name == "builtin":
+        from PyLHE_EventAnalysis.src.LHEReader import read_lhe
+        return read_lhe, False
+    if reader_name == "builtin-batches":
+        from PyLHE_EventAnalysis.src.LHEReader import read_lhe_batches
+        return read_lhe_batches, True
+    raise ValueError(f"Unknown reader: {reader_name}")
+
+
+def _peak_rss_mb() -> float:
+    """Peak resident set size of the current process in MB."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kB on Linux
+    return peak_rss / 1024 ** 2 if sys.platform == "darwin" else peak_rss / 1024
+
+
+def _run_reader(reader_name: str, filename: str, results):
+    """Reads all the events of the file, touching the momentum of every particle."""
+    reader, yields_batches = _load_reader(reader_name)
+    n_events, checksum = 0, 0.0
+    start_time = time.perf_counter()
+    for chunk in reader(filename):
+        if yields_batches:
+            n_events += len(chunk)
+            checksum += float(chunk["px"].sum())
+        else:
+            n_events += 1
+            checksum += sum(part.px for part in chunk.particles)
+    elapsed = time.perf_counter() - start_time
+    results.put({
+        "reader": reader_name, "events": n_events, "seconds": elapsed,
+        "events_per_second": n_events / elapsed, "peak_rss_mb": _peak_rss_mb(), "checksum": checksum
+    })
+
+
+def run_benchmark(filename: str, reader_names):
+    """Runs each reader in a separate process and returns the measurements."""
+    context = multiprocessing.get_context("spawn")
+    measurements = []
+    for reader_name in reader_names:
+        results = context.Queue()
+        process = context.Process(target=_run_reader, args=(reader_name, filename, results))
+        process.start()
+        measurements.append(results.get())
+        process.join()
+    return measurements
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("filename", help="Path to the .lhe file")
+    parser.add_argument("--readers", nargs="+", default=["pylhe", "builtin", "builtin-batches"])
+    args = parser.parse_args()
+
+    print(f"{'reader':<18}{'events':>10}{'time [s]':>12}{'events/s':>14}{'peak RSS [MB]':>16}")
+    for measurement in run_benchmark(args.filename, args.readers):
+        print(
+            f"{measurement['reader']:<18}{measurement['events']:>10}{measurement['seconds']:>12.2f}"
+            f"{measurement['events_per_second']:>14.0f}{measurement['peak_rss_mb']:>16.1f}"
+        )
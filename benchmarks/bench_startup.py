@@ -0,0 +1,99 @@
+"""
+Measures the import time of the package modules, as seen by short jobs starting a fresh interpreter.
+
+Usage:
+    python -m PyLHE_EventAnalysis.benchmarks.bench_startup [--modules ...] [--repeat 5] [--top 8] [--json out.json]
+
+Each module is imported in a fresh process with python -X importtime, best of --repeat runs. The
+report gives the wall time of the interpreter, the cumulative import time of the module, its
+slowest direct imports, and which of the heavy optional dependencies were imported.
+"""
+
+from typing import Dict, List
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+DEFAULT_MODULES = [
+    "PyLHE_EventAnalysis.src.LHEReader",
+    "PyLHE_EventAnalysis.src.Histogram",
+    "PyLHE_EventAnalysis.src.Analysis",
+    "PyLHE_EventAnalysis.src.Shards",
+    "PyLHE_EventAnalysis.examples.FCC_hh.tau_leptonic.analyse_events",
+]
+# Dependencies that must only be imported when they are used
+HEAVY_DEPENDENCIES = ["numba", "pylhe", "vector", "concurrent.futures"]
+
+
+def parse_importtime(stderr: str) -> List[Dict]:
+    """Parses the lines "import time: self [us] | cumulative | imported package" of -X importtime."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        # The names are indented by two spaces per nesting level
+        imports.append({
+            "name": name.strip(), "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+            "self_ms": int(self_time) / 1000, "cumulative_ms": int(cumulative) / 1000,
+        })
+    return imports
+
+
+def measure_module(module: str) -> Dict:
+    """Imports the module in a fresh interpreter and returns its import times."""
+    start_time = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    )
+    wall_time = time.perf_counter() - start_time
+    imports = parse_importtime(process.stderr)
+    # Each import is listed after the imports it triggered, so those of the module precede it
+    position = next(index for index, entry in enumerate(imports) if entry["name"] == module)
+    module_depth = imports[position]["depth"]
+    start = position
+    while start > 0 and imports[start - 1]["depth"] > module_depth:
+        start -= 1
+    direct_imports = [entry for entry in imports[start:position] if entry["depth"] == module_depth + 1]
+    imported = {entry["name"] for entry in imports}
+    return {
+        "wall_ms": wall_time * 1000,
+        "import_ms": imports[position]["cumulative_ms"],
+        "direct_imports": sorted(direct_imports, key=lambda entry: -entry["cumulative_ms"]),
+        "heavy_dependencies": [name for name in HEAVY_DEPENDENCIES if name in imported],
+    }
+
+
+def run_benchmark(modules: List[str], repeat: int = 5) -> Dict[str, Dict]:
+    """Best measurement of each module over repeat runs."""
+    return {
+        module: min((measure_module(module) for _ in range(repeat)), key=lambda measurement: measurement["import_ms"])
+        for module in modules
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modules", nargs="+", default=DEFAULT_MODULES, help="Modules to import")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs of each module")
+    parser.add_argument("--top", type=int, default=8, help="Number of direct imports reported for each module")
+    parser.add_argument("--json", help="Saves the measurements to this JSON file")
+    args = parser.parse_args(argv)
+
+    measurements = run_benchmark(args.modules, args.repeat)
+    for module, measurement in measurements.items():
+        heavy = ", ".join(measurement["heavy_dependencies"]) or "none"
+        print(f"{module}: {measurement['import_ms']:.1f} ms import, {measurement['wall_ms']:.1f} ms interpreter wall time")
+        print(f"    heavy dependencies imported: {heavy}")
+        for entry in measurement["direct_imports"][:args.top]:
+            print(f"    {entry['cumulative_ms']:8.1f} ms  {entry['name']}")
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(measurements, json_file, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,289 @@
+"""
+Benchmark suite of the event analysis: reading, observables, cuts, histogram filling and the
+whole EventLoop.analyse_events, in the per-event and in the batch (vectorized) modes.
+
+Usage:
+    python -m PyLHE_EventAnalysis.benchmarks.bench_suite [--events 20000] [--file path/to/file.lhe]
+                                                         [--save-baseline baseline.json]
+                                                         [--baseline baseline.json] [--tolerance 0.1]
+
+Without --file, a synthetic ditau -> e mu + neutrinos sample is generated (see generate_lhe).
+Each benchmark runs in a fresh process, reporting its best time over --repeat runs in events/s
+and the peak RSS of the process. With --baseline, the throughput is compared with a stored run,
+and the exit code is 1 if any benchmark is slower than the baseline by more than the tolerance.
+"""
+
+from typing import Callable, Dict, List
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+def _read_events(filename: str) -> List:
+    from PyLHE_EventAnalysis.src.LHEReader import read_lhe
+    return list(read_lhe(filename))
+
+
+def _read_batches(filename: str) -> List:
+    from PyLHE_EventAnalysis.src.LHEReader import read_lhe_batches
+    return list(read_lhe_batches(filename))
+
+
+def _analyses(vectorized: bool) -> Dict:
+    """The analyses of examples/FCC_hh/tau_leptonic, with the per-event or the vectorized cuts."""
+    from PyLHE_EventAnalysis.src.Analysis import EventAnalysis
+    if vectorized:
+        from PyLHE_EventAnalysis.examples.FCC_hh import Observables_kinematics as observables
+        return {
+            f"MET_MLL_{ratio}": EventAnalysis([observables.rapidity_cut, observables.met_mll_cut(ratio)])
+            for ratio in (0.1, 0.2)
+        }
+    from PyLHE_EventAnalysis.examples.FCC_hh.tau_leptonic.analyse_events import CutRatioMETMLL, rapidity_cut
+    return {f"MET_MLL_{ratio}": EventAnalysis([rapidity_cut, CutRatioMETMLL(ratio)]) for ratio in (0.1, 0.2)}
+
+
+def _histogram(vectorized: bool):
+    """Histogram of the e-mu invariant mass, with the binning of examples/FCC_hh/tau_leptonic."""
+    from PyLHE_EventAnalysis.src.Histogram import ObservableHistogram
+    if vectorized:
+        from PyLHE_EventAnalysis.examples.FCC_hh.Observables_kinematics import invariant_mass_emu
+    else:
+        from PyLHE_EventAnalysis.examples.FCC_hh.Observables import invariant_mass_emu
+    return ObservableHistogram(bin_edges=list(range(0, 16400, 400)) + [1e12], observable=invariant_mass_emu)
+
+
+# Each benchmark is a function taking the filename and returning a callable that runs the
+# benchmarked code and returns the number of processed events. The setup is not timed.
+
+def bench_read_events(filename: str) -> Callable:
+    return lambda: len(_read_events(filename))
+
+
+def bench_read_batches(filename: str) -> Callable:
+    return lambda: sum(len(batch) for batch in _read_batches(filename))
+
+
+def bench_observables_events(filename: str) -> Callable:
+    from PyLHE_EventAnalysis.examples.FCC_hh import Observables
+    events = _read_events(filename)
+
+    def run():
+        for event in events:
+            Observables.met_mll_ratio(event)
+            Observables.rapidity(event)
+        return len(events)
+    return run
+
+
+def bench_observables_batches(filename: str) -> Callable:
+    from PyLHE_EventAnalysis.examples.FCC_hh import Observables_kinematics
+    batches = _read_batches(filename)
+
+    def run():
+        for batch in batches:
+            # The observables are not cached, as in the per-event benchmark
+            Observables_kinematics.met_mll_ratio.compute(batch)
+            Observables_kinematics.rapidity.compute(batch)
+        return sum(len(batch) for batch in batches)
+    return run
+
+
+def bench_cuts_events(filename: str) -> Callable:
+    from PyLHE_EventAnalysis.src.CutFlow import CutFlowEngine
+    from PyLHE_EventAnalysis.src.ObservableCache import ObservableCache
+    events = _read_events(filename)
+    analyses = _analyses(vectorized=False)
+    cache = ObservableCache()
+
+    def run():
+        engine = CutFlowEngine(analyses)
+        with cache.activate():
+            for event in events:
+                cache.clear()
+                engine.select(event)
+        return len(events)
+    return run
+
+
+def bench_cuts_batches(filename: str) -> Callable:
+    from PyLHE_EventAnalysis.src.CutFlow import CutFlowEngine
+    from PyLHE_EventAnalysis.src.ObservableCache import ObservableCache
+    batches = _read_batches(filename)
+    analyses = _analyses(vectorized=True)
+    cache = ObservableCache()
+
+    def run():
+        engine = CutFlowEngine(analyses)
+        with cache.activate():
+            for batch in batches:
+                cache.clear()
+                engine.select_batch(batch)
+        return sum(len(batch) for batch in batches)
+    return run
+
+
+def bench_fill_events(filename: str) -> Callable:
+    from PyLHE_EventAnalysis.src.Histogram import ObservableHistogram
+    from PyLHE_EventAnalysis.examples.FCC_hh.Observables import invariant_mass_emu
+    values = [float(invariant_mass_emu(event)) for event in _read_events(filename)]
+    # The values are precomputed, so only the bin search and the filling are timed
+    hist = ObservableHistogram(bin_edges=_histogram(vectorized=False).bin_edges, observable=lambda value: value)
+
+    def run():
+        for value in values:
+            hist.update_hist(value)
+        return len(values)
+    return run
+
+
+def bench_fill_batches(filename: str) -> Callable:
+    from PyLHE_EventAnalysis.examples.FCC_hh.Observables_kinematics import invariant_mass_emu
+    values = [invariant_mass_emu.compute(batch) for batch in _read_batches(filename)]
+    hist = _histogram(vectorized=True)
+
+    def run():
+        for batch_values in values:
+            hist.fill_many(batch_values)
+        return sum(len(batch_values) for batch_values in values)
+    return run
+
+
+def bench_analyse_events(filename: str) -> Callable:
+    from PyLHE_EventAnalysis.src.Analysis import EventLoop
+    from PyLHE_EventAnalysis.src.LHEReader import read_lhe
+    event_loop = EventLoop(read_lhe, _histogram(vectorized=False), progress=None)
+    analyses = _analyses(vectorized=False)
+    return lambda: event_loop.analyse_events(filename, analyses).metadata.num_events
+
+
+def bench_analyse_batches(filename: str) -> Callable:
+    from PyLHE_EventAnalysis.src.Analysis import EventLoop
+    from PyLHE_EventAnalysis.src.LHEReader import read_lhe_batches
+    event_loop = EventLoop(read_lhe_batches, _histogram(vectorized=True), progress=None)
+    analyses = _analyses(vectorized=True)
+    return lambda: event_loop.analyse_events(filename, analyses).metadata.num_events
+
+
+def bench_analyse_fused(filename: str) -> Callable:
+    from PyLHE_EventAnalysis.src.Analysis import EventLoop
+    from PyLHE_EventAnalysis.src.LHEReader import read_lhe_batches
+    event_loop = EventLoop(read_lhe_batches, _histogram(vectorized=True), progress=None, fused=True)
+    analyses = _analyses(vectorized=True)
+    # The first run compiles the fused loop (or loads it from the numba cache)
+    event_loop.analyse_events(filename, analyses)
+    return lambda: event_loop.analyse_events(filename, analyses).metadata.num_events
+
+
+BENCHMARKS = {
+    "read/events": bench_read_events,
+    "read/batches": bench_read_batches,
+    "observables/events": bench_observables_events,
+    "observables/batches": bench_observables_batches,
+    "cuts/events": bench_cuts_events,
+    "cuts/batches": bench_cuts_batches,
+    "fill/events": bench_fill_events,
+    "fill/batches": bench_fill_batches,
+    "analyse_events/events": bench_analyse_events,
+    "analyse_events/batches": bench_analyse_batches,
+    "analyse_events/fused": bench_analyse_fused,
+}
+
+
+def _run_benchmark(name: str, filename: str, repeat: int, results):
+    """Runs a benchmark in the current (fresh) process and puts its measurement in the results queue."""
+    from PyLHE_EventAnalysis.src.Instrumentation import peak_memory_mb
+    # Output of the EventLoop is not part of the measurement
+    sys.stdout = open(os.devnull, "w")
+    run = BENCHMARKS[name](filename)
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        n_events = run()
+        times.append(time.perf_counter() - start_time)
+    best_time = min(times)
+    results.put({
+        "events": n_events, "seconds": best_time, "events_per_second": n_events / best_time,
+        "peak_rss_mb": peak_memory_mb(),
+    })
+
+
+def run_suite(filename: str, names: List[str], repeat: int = 3) -> Dict[str, Dict]:
+    """Runs each benchmark in a separate process and returns the measurements."""
+    context = multiprocessing.get_context("spawn")
+    measurements = {}
+    for name in names:
+        results = context.Queue()
+        process = context.Process(target=_run_benchmark, args=(name, filename, repeat, results))
+        process.start()
+        measurements[name] = results.get()
+        process.join()
+    return measurements
+
+
+def compare(measurements: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """Returns the benchmarks whose throughput dropped by more than tolerance with respect to the baseline."""
+    return [
+        name for name, measurement in measurements.items()
+        if name in baseline
+        and measurement["events_per_second"] < (1 - tolerance) * baseline[name]["events_per_second"]
+    ]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="Path to the .lhe file. If not given, a synthetic sample is generated")
+    parser.add_argument("--events", type=int, default=20000, help="Number of events of the synthetic sample")
+    parser.add_argument("--benchmarks", nargs="+", choices=sorted(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark")
+    parser.add_argument("--baseline", help="JSON file with the measurements to compare with")
+    parser.add_argument("--save-baseline", help="Saves the measurements to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative drop of the throughput reported as a regression")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        filename = args.file
+        if filename is None:
+            from PyLHE_EventAnalysis.benchmarks.generate_lhe import generate_lhe
+            filename = os.path.join(temporary_dir, "synthetic.lhe")
+            generate_lhe(filename, args.events)
+        measurements = run_suite(filename, args.benchmarks, repeat=args.repeat)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["benchmarks"]
+
+    print(f"{'benchmark':<26}{'events':>10}{'time [s]':>12}{'events/s':>14}{'peak RSS [MB]':>16}{'vs baseline':>14}")
+    for name, measurement in measurements.items():
+        ratio = ""
+        if name in baseline:
+            ratio = f"{measurement['events_per_second'] / baseline[name]['events_per_second']:.2f}x"
+        print(
+            f"{name:<26}{measurement['events']:>10}{measurement['seconds']:>12.3f}"
+            f"{measurement['events_per_second']:>14.0f}{measurement['peak_rss_mb']:>16.1f}{ratio:>14}"
+        )
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump({
+                "python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                "file": args.file, "events": args.events, "benchmarks": measurements,
+            }, baseline_file, indent=2)
+
+    regressions = compare(measurements, baseline, args.tolerance)
+    if regressions:
+        print(f"Regressions (more than {args.tolerance:.0%} slower): {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
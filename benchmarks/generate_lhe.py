@@ -0,0 +1,172 @@
+"""
+Generates synthetic .lhe files for the benchmarks.
+
+The events mimic parton-level Drell-Yan production at a hadron collider, pp -> Z/gamma* -> l+ l-,
+with the leptons decaying or not depending on the final state:
+    ditau-emu: tau- -> e- nu_e~ nu_tau and tau+ -> mu+ nu_mu nu_tau~ (11 particles per event)
+    dilepton:  Z/gamma* -> e+ e- (5 particles per event)
+The invariant mass of the pair follows a falling power law, and the decays are isotropic in the
+rest frame of the decaying particle, so the four-momenta are conserved in each event.
+The file has a MadGraph-like banner with the 'Integrated weight (pb)' line, an <init> block and,
+optionally, reweighting weights.
+
+Usage:
+    python -m PyLHE_EventAnalysis.benchmarks.generate_lhe output.lhe[.gz|.xz] --events 100000
+"""
+
+import argparse
+import gzip
+import lzma
+import math
+import random
+
+# Masses in GeV
+TAU_MASS = 1.77686
+MUON_MASS = 0.10566
+ELECTRON_MASS = 0.000511
+# Beam energy in GeV
+BEAM_ENERGY = 50000.0
+# Particles of each final state: (pid, status, first mother, last mother, mass).
+# A mass of None is computed from the four-momentum, generated by _final_state_momenta
+FINAL_STATES = {
+    "ditau-emu": [
+        (2, -1, 0, 0, 0.0), (-2, -1, 0, 0, 0.0), (23, 2, 1, 2, None),
+        (15, 2, 3, 3, TAU_MASS), (-15, 2, 3, 3, TAU_MASS),
+        (11, 1, 4, 4, ELECTRON_MASS), (-12, 1, 4, 4, 0.0), (16, 1, 4, 4, 0.0),
+        (-13, 1, 5, 5, MUON_MASS), (14, 1, 5, 5, 0.0), (-16, 1, 5, 5, 0.0),
+    ],
+    "dilepton": [
+        (2, -1, 0, 0, 0.0), (-2, -1, 0, 0, 0.0), (23, 2, 1, 2, None),
+        (11, 1, 3, 3, ELECTRON_MASS), (-11, 1, 3, 3, ELECTRON_MASS),
+    ],
+}
+
+
+def _boost(momentum, parent, parent_mass: float):
+    """Boosts the four-momentum (e, px, py, pz) from the rest frame of the parent to the frame where it has the given momentum."""
+    energy, px, py, pz = momentum
+    parent_energy, parent_px, parent_py, parent_pz = parent
+    # Written in terms of the parent four-momentum, which is stable for highly boosted parents
+    parent_p = parent_px * px + parent_py * py + parent_pz * pz
+    boosted_energy = (parent_energy * energy + parent_p) / parent_mass
+    factor = (energy + boosted_energy) / (parent_energy + parent_mass)
+    return boosted_energy, px + factor * parent_px, py + factor * parent_py, pz + factor * parent_pz
+
+
+def _two_body_decay(rng: random.Random, parent, mass1: float, mass2: float):
+    """Isotropic decay of the parent four-momentum into two particles with the given masses."""
+    energy, px, py, pz = parent
+    parent_mass = math.sqrt(max(energy ** 2 - px ** 2 - py ** 2 - pz ** 2, 0.0))
+    # Momentum of the daughters in the rest frame of the parent
+    momentum = math.sqrt(
+        max((parent_mass ** 2 - (mass1 + mass2) ** 2) * (parent_mass ** 2 - (mass1 - mass2) ** 2), 0.0)
+    ) / (2 * parent_mass)
+    cos_theta = rng.uniform(-1, 1)
+    sin_theta = math.sqrt(1 - cos_theta ** 2)
+    phi = rng.uniform(0, 2 * math.pi)
+    direction = (sin_theta * math.cos(phi), sin_theta * math.sin(phi), cos_theta)
+    daughters = []
+    for mass, sign in ((mass1, 1), (mass2, -1)):
+        rest_frame = (math.sqrt(momentum ** 2 + mass ** 2), *(sign * momentum * component for component in direction))
+        daughters.append(_boost(rest_frame, parent, parent_mass))
+    return daughters
+
+
+def _leptonic_decay(rng: random.Random, parent, lepton_mass: float):
+    """Three-body decay tau -> l nu nu, generated as tau -> l (nu nu) followed by (nu nu) -> nu nu."""
+    neutrinos_mass = rng.uniform(0, TAU_MASS - lepton_mass)
+    lepton, neutrinos = _two_body_decay(rng, parent, lepton_mass, neutrinos_mass)
+    return [lepton, *_two_body_decay(rng, neutrinos, 0.0, 0.0)]
+
+
+def _final_state_momenta(rng: random.Random, final_state: str, min_mass: float):
+    """Four-momenta of the particles of an event, in the order of FINAL_STATES[final_state]."""
+    # Invariant mass with a falling spectrum dsigma/dm ~ m^-3 and rapidity of the pair
+    mass = min(min_mass / math.sqrt(1 - rng.random()), BEAM_ENERGY)
+    pair_rapidity = rng.gauss(0, 1.5)
+    pair_rapidity = max(min(pair_rapidity, math.log(2 * BEAM_ENERGY / mass)), -math.log(2 * BEAM_ENERGY / mass))
+    incoming = [
+        (0.5 * mass * math.exp(pair_rapidity), 0.0, 0.0, 0.5 * mass * math.exp(pair_rapidity)),
+        (0.5 * mass * math.exp(-pair_rapidity), 0.0, 0.0, -0.5 * mass * math.exp(-pair_rapidity)),
+    ]
+    boson = tuple(first + second for first, second in zip(*incoming))
+    if final_state == "dilepton":
+        return [*incoming, boson, *_two_body_decay(rng, boson, ELECTRON_MASS, ELECTRON_MASS)]
+    tau_minus, tau_plus = _two_body_decay(rng, boson, TAU_MASS, TAU_MASS)
+    return [
+        *incoming, boson, tau_minus, tau_plus,
+        *_leptonic_decay(rng, tau_minus, ELECTRON_MASS), *_leptonic_decay(rng, tau_plus, MUON_MASS),
+    ]
+
+
+def _open_output(path: str):
+    """Opens the output file, compressing it if the name ends with .gz or .xz."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt")
+    if path.endswith(".xz"):
+        return lzma.open(path, "wt")
+    return open(path, "w")
+
+
+def generate_lhe(path: str, n_events: int, final_state: str = "ditau-emu", cross_section: float = 1.2345,
+                 n_weights: int = 0, min_mass: float = 100.0, seed: int = 0):
+    """
+    Writes a synthetic .lhe file.
+
+    :param path: Output path. Names ending with .gz or .xz are compressed.
+    :param n_events: Number of events.
+    :param final_state: One of the FINAL_STATES.
+    :param cross_section: Cross-section in pb, written in the banner and in the <init> block.
+    :param n_weights: Number of reweighting weights stored in each event.
+    :param min_mass: Minimum invariant mass of the lepton pair in GeV.
+    :param seed: Seed of the random number generator, so the files are reproducible.
+    """
+    particles = FINAL_STATES[final_state]
+    rng = random.Random(seed)
+    event_weight = cross_section / n_events
+    with _open_output(path) as lhe_file:
+        lhe_file.write('<LesHouchesEvents version="3.0">\n<header>\n<MGGenerationInfo>\n')
+        lhe_file.write(f"#  Number of Events        :       {n_events}\n")
+        lhe_file.write(f"#  Integrated weight (pb)  :       {cross_section}\n</MGGenerationInfo>\n")
+        if n_weights:
+            lhe_file.write("<initrwgt>\n<weightgroup name='scale_variation'>\n")
+            for weight_index in range(n_weights):
+                lhe_file.write(f"<weight id='{weight_index + 1}'> variation {weight_index + 1} </weight>\n")
+            lhe_file.write("</weightgroup>\n</initrwgt>\n")
+        lhe_file.write("</header>\n<init>\n")
+        lhe_file.write(f"2212 2212 {BEAM_ENERGY:.8e} {BEAM_ENERGY:.8e} 0 0 247000 247000 -4 1\n")
+        lhe_file.write(f"{cross_section:.8e} {cross_section * 1e-3:.8e} {cross_section:.8e} 1\n</init>\n")
+        for _ in range(n_events):
+            momenta = _final_state_momenta(rng, final_state, min_mass)
+            lines = [f"<event>\n {len(particles)} 1 {event_weight:+.8e} {momenta[2][0]:.8e} 7.54677100e-03 1.18000000e-01\n"]
+            for (pid, status, mother1, mother2, mass), (energy, px, py, pz) in zip(particles, momenta):
+                if mass is None:
+                    mass = math.sqrt(max(energy ** 2 - px ** 2 - py ** 2 - pz ** 2, 0.0))
+                color = "501    0" if pid == 2 else ("  0  501" if pid == -2 else "  0    0")
+                lines.append(
+                    f" {pid:>8d} {status:>2d} {mother1:>4d} {mother2:>4d} {color} {px:+.10e} {py:+.10e} {pz:+.10e}"
+                    f" {energy:.10e} {mass:.10e} 0.0000e+00 9.0000e+00\n"
+                )
+            if n_weights:
+                lines.append("<rwgt>\n")
+                lines.extend(
+                    f"<wgt id='{weight_index + 1}'> {event_weight * rng.uniform(0.8, 1.2):+.8e} </wgt>\n"
+                    for weight_index in range(n_weights)
+                )
+                lines.append("</rwgt>\n")
+            lines.append("</event>\n")
+            lhe_file.write("".join(lines))
+        lhe_file.write("</LesHouchesEvents>\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="Output .lhe file")
+    parser.add_argument("--events", type=int, default=100000, help="Number of events")
+    parser.add_argument("--final-state", choices=sorted(FINAL_STATES), default="ditau-emu")
+    parser.add_argument("--cross-section", type=float, default=1.2345, help="Cross-section in pb")
+    parser.add_argument("--weights", type=int, default=0, help="Number of reweighting weights per event")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_lhe(args.path, args.events, final_state=args.final_state, cross_section=args.cross_section,
+                 n_weights=args.weights, seed=args.seed)
@@ -1,9 +1,16 @@
 """Collects the observables for the analysis."""
 
-import pylhe
+from __future__ import annotations
+from typing import TYPE_CHECKING
 import numpy as np
+from PyLHE_EventAnalysis.src.ObservableCache import cached_observable
 
+# pylhe is only used in the annotations, so it is not imported at run time
+if TYPE_CHECKING:
+    import pylhe
 
+
+@cached_observable
 def evaluate_total_momentum(event: pylhe.LHEEvent, part_pids: list):
     """Calculates the total momentum taking into account only the particles with PIDs in the part_pid list."""
     # Total momentum vector
@@ -16,6 +23,7 @@ def evaluate_total_momentum(event: pylhe.LHEEvent, part_pids: list):
     return np.sum(momentum, axis=0)
 
 
+@cached_observable
 def invariant_mass_emu(event: pylhe.LHEEvent):
     """Evaluates the invariant mass of the e-mu pair"""
     charged_leptons_momentum = evaluate_total_momentum(event, [11, 13])
@@ -26,6 +34,7 @@ def invariant_mass_emu(event: pylhe.LHEEvent):
     return np.sqrt(invariant_mass_squared)
 
 
+@cached_observable
 def missing_energy(event: pylhe.LHEEvent):
     """Calculates the missing energy of the event."""
     nu_total = evaluate_total_momentum(event, [12, 14, 16])
@@ -33,6 +42,7 @@ def missing_energy(event: pylhe.LHEEvent):
     return np.sqrt(np.power(nu_total[1], 2) + np.power(nu_total[2], 2))
 
 
+@cached_observable
 def met_mll_ratio(event: pylhe.LHEEvent):
     """Evaluates the MET/mll ratio of the event."""
     inv_mass = invariant_mass_emu(event)
@@ -41,6 +51,7 @@ def met_mll_ratio(event: pylhe.LHEEvent):
     return met / inv_mass
 
 
+@cached_observable
 def rapidity(event: pylhe.LHEEvent):
     """Rapidity"""
     charged_lep_m = evaluate_total_momentum(event, [11, 13])
@@ -0,0 +1,21 @@
+"""Vectorized version of the observables in Observables.py, evaluated on whole batches of events."""
+
+from PyLHE_EventAnalysis.src.Kinematics import Cut, InvariantMass, MomentumSum, Rapidity, Ratio, TransverseMomentum
+
+# Total four-momentum of the charged leptons and of the neutrinos
+charged_leptons_momentum = MomentumSum(pids=[11, 13])
+neutrinos_momentum = MomentumSum(pids=[12, 14, 16])
+
+# Observables
+invariant_mass_emu = InvariantMass(charged_leptons_momentum)
+missing_energy = TransverseMomentum(neutrinos_momentum)
+met_mll_ratio = Ratio(missing_energy, invariant_mass_emu)
+rapidity = Rapidity(charged_leptons_momentum)
+
+# Selection cuts
+rapidity_cut = Cut(rapidity, maximum=2.5, absolute=True)
+
+
+def met_mll_cut(ratio_cut: float) -> Cut:
+    """Cut on the met/mll ratio."""
+    return Cut(met_mll_ratio, minimum=ratio_cut)
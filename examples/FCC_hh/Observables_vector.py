@@ -1,11 +1,18 @@
 """Collects the observables for the analysis."""
 
-import pylhe
-import vector
+from __future__ import annotations
+from typing import TYPE_CHECKING
+from PyLHE_EventAnalysis.src.ObservableCache import cached_observable
 
+# pylhe is only used in the annotations, and vector is imported on the first use of an observable
+if TYPE_CHECKING:
+    import pylhe
 
+
+@cached_observable
 def evaluate_total_momentum(event: pylhe.LHEEvent, part_pids: list):
     """Calculates the total momentum taking into account only the particles with PIDs in the part_pid list."""
+    import vector
     # Total momentum vector
     total_momentum = vector.MomentumObject4D(px=0, py=0, pz=0, e=0)
     for part in event.particles:
@@ -14,8 +21,10 @@ def evaluate_total_momentum(event: pylhe.LHEEvent, part_pids: list):
     return total_momentum
 
 
+@cached_observable
 def evaluate_total_momentum_pids(event: pylhe.LHEEvent, part_pids: list):
     """Calculates the total momentum taking into account only the particles with PIDs in the part_pid list."""
+    import vector
     # Total momentum vector
     total_momentum = vector.MomentumObject4D(px=0, py=0, pz=0, e=0)
     for part in event.particles:
@@ -24,18 +33,21 @@ def evaluate_total_momentum_pids(event: pylhe.LHEEvent, part_pids: list):
     return total_momentum
 
 
+@cached_observable
 def invariant_mass_emu(event: pylhe.LHEEvent):
     """Evaluates the invariant mass of the e-mu pair"""
     charged_leptons_momentum = evaluate_total_momentum(event, [11, 13])
     return charged_leptons_momentum.m
 
 
+@cached_observable
 def missing_energy(event: pylhe.LHEEvent):
     """Calculates the missing energy of the event."""
     nu_total = evaluate_total_momentum(event, [12, 14, 16])
     return nu_total.pt
 
 
+@cached_observable
 def met_mll_ratio(event: pylhe.LHEEvent):
     """Evaluates the MET/mll ratio of the event."""
     inv_mass = invariant_mass_emu(event)
@@ -44,12 +56,14 @@ def met_mll_ratio(event: pylhe.LHEEvent):
     return met / inv_mass
 
 
+@cached_observable
 def pseudo_rapidity(event: pylhe.LHEEvent):
     """Rapidity"""
     charged_lep_m = evaluate_total_momentum(event, [11, 13])
     return charged_lep_m.eta
 
 
+@cached_observable
 def rapidity(event: pylhe.LHEEvent):
     """Rapidity"""
     charged_lep_m = evaluate_total_momentum(event, [11, 13])
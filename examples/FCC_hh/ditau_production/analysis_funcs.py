@@ -1,9 +1,16 @@
 """Defines the important functions for the analysis"""
 
-import pylhe
+from __future__ import annotations
+from typing import TYPE_CHECKING
 import numpy as np
+from PyLHE_EventAnalysis.src.ObservableCache import cached_observable
 
+# pylhe is only used in the annotations, so it is not imported at run time
+if TYPE_CHECKING:
+    import pylhe
 
+
+@cached_observable
 def invariant_mass_taus(event: pylhe.LHEEvent):
     """Computes the invariant mass for a pair of taus"""
     # Four-momentum of each tau in the event
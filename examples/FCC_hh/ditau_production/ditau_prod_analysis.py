@@ -3,8 +3,7 @@
 from PyLHE_EventAnalysis.src.Analysis import EventAnalysis, EventLoop
 from PyLHE_EventAnalysis.src.Histogram import ObservableHistogram
 from PyLHE_EventAnalysis.examples.FCC_hh.ditau_production import analysis_funcs
-from PyLHE_EventAnalysis.src.Utilities import read_xsection
-import pylhe
+from PyLHE_EventAnalysis.src.LHEReader import read_pylhe
 import copy
 import json
 
@@ -25,7 +24,7 @@ if __name__ == "__main__":
     # Creates the EventAnalysis object - handles the selection of the event
     event_analysis = EventAnalysis(selection_cuts=[])  # No cuts being applied
     # Creates the EventLoop object - iterates over all the events in a .lhe file and books the histogram
-    event_loop = EventLoop(file_reader=pylhe.read_lhe, histogram_template=mtautau_distribution)
+    event_loop = EventLoop(file_reader=read_pylhe, histogram_template=mtautau_distribution)
 
     # Dictionary to store the constructed m_tautau distribution of each term
     terms_dists = {}
@@ -38,15 +37,15 @@ if __name__ == "__main__":
         for bin_index in range(1, 13):
             # Path to the .lhe file
             lhe_filename = f"{folder_path}/{term}-bin-{bin_index}.lhe"
-            # Reads the cross-section for the current simulated bin
-            cross_section = read_xsection(path_to_file=lhe_filename)
-            # Reads the total number of events in the file
-            num_events = pylhe.read_num_events(filepath=lhe_filename)
             # Runs the analysis in each event - returns the mtautau dist constructed out of the
             # selected events in the current file
-            bin_mtautau_dist = event_loop.analyse_events(
-                filename=lhe_filename, event_analysis=event_analysis
+            bin_result = event_loop.analyse_events(
+                filename=lhe_filename, event_analyses={"mtautau": event_analysis}
             )
+            bin_mtautau_dist = bin_result["mtautau"]
+            # Cross-section and total number of events in the file, collected while reading it
+            cross_section = bin_result.metadata.cross_section
+            num_events = bin_result.metadata.num_events
             # Prints the number of events in each bin
             print(bin_mtautau_dist)
             # Adds the bin distribution to the term distribution
@@ -1,14 +1,19 @@
 """Reads the events from .lhe files and constructs the parton-level m_{tautau} distribution"""
 
-import numpy as np
+from __future__ import annotations
+from typing import TYPE_CHECKING
 from PyLHE_EventAnalysis.src.Analysis import EventAnalysis, EventLoop
-from PyLHE_EventAnalysis.src.Histogram import ObservableHistogram, HistogramCompound, CorrelatedHist
+from PyLHE_EventAnalysis.src.Histogram import ObservableHistogram, HistogramCompound, ProfileHistogram
+from PyLHE_EventAnalysis.src.Checkpoint import CheckpointRunner
+from PyLHE_EventAnalysis.src.LHEReader import read_pylhe
 from PyLHE_EventAnalysis.examples.FCC_hh import Observables
-from PyLHE_EventAnalysis.src.Utilities import read_xsection
-import pylhe
 import copy
 import json
 
+# pylhe is only used in the annotations, and imported by read_pylhe when the first file is read
+if TYPE_CHECKING:
+    import pylhe
+
 
 class CutRatioMETMLL:
     """Applies the cut on the met/mll ratio."""
@@ -25,6 +30,16 @@ class CutRatioMETMLL:
         # Applies the cut
         return met > self.cut * mll
 
+    def __eq__(self, other):
+        """Cuts with the same ratio are shared by the analyses using them."""
+        return isinstance(other, CutRatioMETMLL) and self.cut == other.cut
+
+    def __hash__(self):
+        return hash((CutRatioMETMLL, self.cut))
+
+    def __repr__(self):
+        return f"CutRatioMETMLL({self.cut})"
+
 
 def rapidity_cut(event: pylhe.LHEEvent):
     """Rapidity of the charged lepton pair"""
@@ -43,23 +58,24 @@ def rapidity_cut(event: pylhe.LHEEvent):
 #     return abs(tau.eta) < 4 and abs(antitau.eta) < 4
 
 
-if __name__ == "__main__":
-    # Folder where the files are stored
-    folder_path = "/Users/martines/Desktop/PhD/Data/FCC-hh/ditau-leptonic/mU1_10TeV/mU1_10TeV"
+# Histograms for the analysis
+bin_edges = list(range(0, 16400, 400)) + [1000000000000]
 
-    # Histograms for the analysis
-    bin_edges = list(range(0, 16400, 400)) + [1000000000000]
 
+def build_analysis():
+    """
+    Returns the EventLoop and the analyses of the m_{emu} distribution.
+    Used by this script and by the shard manifests (see src/Shards.py), e.g. manifest_mU1_10TeV.json.
+    """
     # 1. Invariant mass of the charged leptons
-    inv_mass_observable = Observables.invariant_mass_emu
-    inv_mass_hist = ObservableHistogram(bin_edges=bin_edges, observable=inv_mass_observable)
-
-    # 2. For the met/mll distribution
-    met_mll_observable = Observables.met_mll_ratio
-    met_mll_dist = CorrelatedHist(xobservable=inv_mass_observable, yobservable=met_mll_observable, bin_edges=bin_edges)
+    inv_mass_hist = ObservableHistogram(bin_edges=bin_edges, observable=Observables.invariant_mass_emu)
+    # 2. Mean of the met/mll ratio in bins of m_{emu}
+    met_mll_profile = ProfileHistogram(
+        xobservable=Observables.invariant_mass_emu, yobservable=Observables.met_mll_ratio, bin_edges=bin_edges
+    )
 
     # All histograms that need to be booked for the analysis
-    compound_hist = HistogramCompound(histograms={"MLL": inv_mass_hist})
+    compound_hist = HistogramCompound(histograms={"MLL": inv_mass_hist, "MET_MLL": met_mll_profile})
 
     # Creates the EventAnalysis object - handles the selection of the event
     event_analyses = {
@@ -69,46 +85,53 @@ if __name__ == "__main__":
     }
 
     # Creates the EventLoop object - iterates over all the events in a .lhe file and books the histogram
-    event_loop = EventLoop(file_reader=pylhe.read_lhe, histogram_template=compound_hist)
+    event_loop = EventLoop(file_reader=read_pylhe, histogram_template=compound_hist)
+    return event_loop, event_analyses
 
-    # Dictionary to store the constructed histograms
-    mll_hists = {analysis: copy.copy(inv_mass_hist) for analysis in event_analyses}
 
-    # MET/Mll distribution
-    met_mll_sum = np.zeros(len(bin_edges) - 1)
-    event_count = copy.copy(inv_mass_hist)
+if __name__ == "__main__":
+    # Folder where the files are stored
+    folder_path = "/Users/martines/Desktop/PhD/Data/FCC-hh/ditau-leptonic/mU1_10TeV/mU1_10TeV"
+
+    event_loop, event_analyses = build_analysis()
+    # Files already analysed with the same configuration are loaded from their checkpoints
+    runner = CheckpointRunner(event_loop=event_loop, checkpoint_dir=f"{folder_path}/checkpoints")
+
+    # Histograms of each analysis, normalised to the cross-section and merged over the files
+    # (the same normalisation as the merge of the shards, see src/Shards.py)
+    merged_hists = {analysis: copy.copy(event_loop.histogram_template) for analysis in event_analyses}
 
     # Iterates over all the different phase-space simulated regions
     for bin_index in range(1, 42):
         # Path to the .lhe file
         lhe_filename = f"{folder_path}/x1L-x1L-x1L-x1L-bin-{bin_index}.lhe"
-        # Reads the cross-section for the current simulated bin
-        cross_section = read_xsection(path_to_file=lhe_filename)
-        # Reads the total number of events in the file
-        num_events = pylhe.read_num_events(filepath=lhe_filename)
 
         # Runs the analysis in each event - returns the disttributions constructed out of the
         # selected events in the current file
-        bin_hist = event_loop.analyse_events(
+        bin_hist = runner.analyse_events(
             filename=lhe_filename, event_analyses=event_analyses
         )
+        # Cross-section and total number of events in the file, collected while reading it
+        cross_section = bin_hist.metadata.cross_section
+        num_events = bin_hist.metadata.num_events
 
-        # Extracts the info from the histograms
+        # Normalises a copy of the histograms of the file and adds it to the merged histograms
         for analysis in event_analyses:
-            mll_hists[analysis] += (2 * cross_section / num_events) * bin_hist[analysis].get_hist("MLL")
-
-        # For the met/mll plot
-        # met_mll_sum += bin_hist["no_cut"].get_hist("MET_MLL").bin_sum
-        # event_count += bin_hist["no_cut"].get_hist("MLL")
+            normalised_hist = copy.copy(event_loop.histogram_template)
+            normalised_hist.merge_hist(bin_hist[analysis])
+            normalised_hist.scale(2 * cross_section / num_events)
+            merged_hists[analysis].merge_hist(normalised_hist)
 
         print(cross_section)
         print(bin_hist["no_cut"].get_hist("MLL"))
         # print(bin_hist["no_cut"].get_hist("MET_MLL").bin_sum)
 
     # Invariant mass dists
+    mll_hists = {analysis: hist.get_hist("MLL") for analysis, hist in merged_hists.items()}
     with open(f"{folder_path}/LQ_ML_tau_cuts.json", "w") as file_:
         simulations_hists = {term: dist.tolist() for term, dist in mll_hists.items()}
         json.dump(simulations_hists, file_, indent=4)
 
-    # with open(f"{folder_path}/LQ_MET_ML_tau_cuts.json", "w") as file_:
-    #     json.dump((met_mll_sum / event_count).tolist(), file_, indent=4)
+    with open(f"{folder_path}/LQ_MET_ML_tau_cuts.json", "w") as file_:
+        met_mll_means = {term: hist.get_hist("MET_MLL").mean().tolist() for term, hist in merged_hists.items()}
+        json.dump(met_mll_means, file_, indent=4)
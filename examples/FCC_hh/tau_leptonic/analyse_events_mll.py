@@ -4,8 +4,8 @@ import numpy as np
 from PyLHE_EventAnalysis.src.Analysis import EventAnalysis, EventLoop
 from PyLHE_EventAnalysis.src.Histogram import ObservableHistogram
 from PyLHE_EventAnalysis.examples.FCC_hh import Observables
-from PyLHE_EventAnalysis.src.Utilities import read_xsection
-import pylhe
+from PyLHE_EventAnalysis.src.Metadata import MetadataIndex
+from PyLHE_EventAnalysis.src.LHEReader import read_pylhe
 import copy
 import json
 from PyLHE_EventAnalysis.examples.FCC_hh.tau_leptonic.analyse_events import CutRatioMETMLL, rapidity_cut
@@ -31,7 +31,11 @@ if __name__ == "__main__":
     }
 
     # Creates the EventLoop object - iterates over all the events in a .lhe file and books the histogram
-    event_loop = EventLoop(file_reader=pylhe.read_lhe, histogram_template=inv_mass_hist)
+    # The metadata of the files is stored in an index, so it is only extracted once
+    event_loop = EventLoop(
+        file_reader=read_pylhe, histogram_template=inv_mass_hist,
+        metadata_index=MetadataIndex(f"{folder_path}/metadata_index.json")
+    )
 
     # Dictionary to store the constructed histograms for each mass
     mll_hists = {leptoquark_mass: copy.copy(inv_mass_hist) for leptoquark_mass in leptoquark_masses}
@@ -42,14 +46,13 @@ if __name__ == "__main__":
         for bin_index in range(1, 42):
             # Path to the .lhe file
             lhe_filename = f"{folder_path}/mU1_{leptoquark_mass}TeV/x1L-x1L-x1L-x1L-bin-{bin_index}.lhe"
-            # Reads the cross-section for the current simulated bin
-            cross_section = read_xsection(path_to_file=lhe_filename)
-            # Reads the total number of events in the file
-            num_events = pylhe.read_num_events(filepath=lhe_filename)
 
             # Runs the analysis in each event - returns the disttributions constructed out of the
             # selected events in the current file
             mll_hist = event_loop.analyse_events(filename=lhe_filename, event_analyses=event_analyses)
+            # Cross-section and total number of events in the file, collected while reading it
+            cross_section = mll_hist.metadata.cross_section
+            num_events = mll_hist.metadata.num_events
 
             # Extracts the info from the histograms
             mll_hists[leptoquark_mass] += (2 * cross_section / num_events) * mll_hist["MLL"]
@@ -1,8 +1,19 @@
 """Simple classes responsible for iterating over events and performing event-by-event analysis."""
 
-from typing import List, Callable, Dict
+from typing import List, Callable, Dict, Optional
 from PyLHE_EventAnalysis.src.Histogram import Histogram
+from PyLHE_EventAnalysis.src.EventBatch import EventBatch
+from PyLHE_EventAnalysis.src.ObservableCache import ObservableCache
+from PyLHE_EventAnalysis.src.Metadata import LHEMetadata, MetadataIndex, read_metadata
+from PyLHE_EventAnalysis.src.CutFlow import CutFlowEngine
+from PyLHE_EventAnalysis.src.Instrumentation import Profiler, ProgressPrinter
+from PyLHE_EventAnalysis.src.Prefetch import PrefetchStream
+from PyLHE_EventAnalysis.src.FusedAnalysis import FusedAnalysis
+from PyLHE_EventAnalysis.src.EarlyStopping import EarlyStopping
+from PyLHE_EventAnalysis.src.LHEReader import resume_reader
 import copy
+import itertools
+import time
 
 
 class EventAnalysis:
@@ -19,10 +30,25 @@ class EventAnalysis:
         """
         self._cuts = selection_cuts
 
+    @property
+    def cuts(self) -> List[Callable]:
+        """The selection cuts, in the order they were given."""
+        return self._cuts
+
+    def selection(self) -> List[Callable]:
+        """
+        The cuts evaluated by the CutFlowEngine of the EventLoop: the selection cuts or, if a subclass overrides
+        launch_analysis, a single cut calling it, so the cut-flow table has a single launch_analysis row.
+        """
+        if type(self).launch_analysis is not EventAnalysis.launch_analysis:
+            return [self.launch_analysis]
+        return self._cuts
+
     def launch_analysis(self, event) -> bool:
         """
         Launches the analysis on the event.
         Returns True if the event is selected for analysis, and False otherwise.
+        Subclasses may override it to implement their own selection (see selection).
         """
         # Apply the event selection cuts
         passed_cuts = all(cut(event) for cut in self._cuts)
@@ -30,19 +56,125 @@ class EventAnalysis:
         return passed_cuts
 
 
+class AnalysisResult(dict):
+    """
+    Dictionary with the booked histogram for each analysis, returned by EventLoop.analyse_events.
+    The metadata attribute holds the LHEMetadata of the file (cross-section, number of events, ...),
+    and the cutflow attribute the cut-flow table of each analysis (see CutFlowEngine.cutflow).
+    If the EventLoop has a Profiler, the profile attribute holds its report (see Profiler.report).
+    For the built-in readers, reader_statistics holds the number of events read, skipped by the
+    prefilter and decoded (see LHEReader.ReadStatistics), and, with prefetch, the stall_time.
+    If the EventLoop stopped reading the file early, early_stopping holds the reason and the
+    precision reached (see EarlyStopping.report).
+    If the EventLoop keeps its partial sums (see EventLoop.keep_partial_sums), partial_sums holds them in
+    file order, and the booked histograms are empty.
+    """
+
+    def __init__(self, histograms: Dict[str, Histogram], metadata: LHEMetadata, cutflow: Dict = None,
+                 profile: Dict = None, reader_statistics: Dict = None, early_stopping: Dict = None,
+                 partial_sums: List[Dict[str, Histogram]] = None):
+        super().__init__(histograms)
+        self.metadata = metadata
+        self.cutflow = cutflow
+        self.profile = profile
+        self.reader_statistics = reader_statistics
+        self.early_stopping = early_stopping
+        self.partial_sums = partial_sums
+
+
 class EventLoop:
     """
     Iterates over all events in an .lhe file
     and manages histogram booking with the selected events.
+
+    The file reader may yield single events or EventBatch chunks (see EventBatch.BatchReader).
+    In the latter case, the cuts and histograms are evaluated on whole batches at once.
+
+    Observables decorated with ObservableCache.cached_observable are evaluated at most once per event
+    (or per batch). The number of cache hits and misses is available from observable_cache.stats().
+
+    The cuts of all the analyses are evaluated by a CutFlowEngine, so cuts shared by several
+    analyses are evaluated once per event.
+
+    The progress callback is called after each event (or chunk) as progress(filename, n_processed, n_new).
+    If a Profiler is given, the time spent in the reader, the cuts, the cached observables and the
+    histogram filling is recorded, and its report is attached to the results.
+
+    With prefetch > 0, the reader runs in a background thread, and the time the analysis spent
+    waiting for it is reported as the stall_time of the reader statistics.
+
+    With fused=True, the cuts and the histograms of declarative analyses are evaluated on each
+    EventBatch in a single loop (see FusedAnalysis), compiled with numba if it is installed.
+
+    With an EarlyStopping, the file stops being read once the histograms reach the target precision
+    or the event budget is used up, and the number of events of the metadata is the number consumed.
+
+    With partial_events, the histograms are filled in partial sums of partial_events events, which are
+    added to the booked histograms in file order. ParallelEventLoop splits a file on the same boundaries,
+    so histograms accumulating floating point values (e.g. CorrelatedHist) match the serial run bit-for-bit.
     """
 
-    def __init__(self, file_reader: Callable, histogram_template: Histogram):
+    def __init__(self, file_reader: Callable, histogram_template: Histogram, metadata_index: MetadataIndex = None,
+                 reorder_cuts: bool = False, progress: Callable = ProgressPrinter(), profiler: Profiler = None,
+                 prefetch: int = 0, prefetch_max_bytes: int = None, fused: bool = False,
+                 early_stopping: EarlyStopping = None, partial_events: int = 10000):
+        """
+        :param file_reader: Function that takes the filename and yields the events (or EventBatch chunks).
+        :param histogram_template: Histogram cloned for each analysis.
+        :param metadata_index: Optional index where the metadata of the files is stored, so the
+                               header of a file that did not change is not parsed again.
+        :param reorder_cuts: Whether the cuts are reordered by their measured cost and rejection rate. The
+                             sequential cut-flow in the declared order is only reported without reordering,
+                             with reordering the table only holds the selected events (see CutFlowEngine.cutflow).
+        :param progress: Progress callback. If None, the progress is not reported.
+        :param profiler: Optional Profiler recording where the time is spent.
+        :param prefetch: If positive, the file is read in a background thread, keeping up to prefetch
+                         chunks ahead of the analysis (see Prefetch.PrefetchStream).
+        :param prefetch_max_bytes: Maximum memory used by the EventBatch chunks read ahead.
+        :param fused: If True, the EventBatch chunks are analysed by a FusedAnalysis, which requires
+                      Kinematics cuts and observables (see FusedAnalysis).
+        :param early_stopping: Optional EarlyStopping criterion. Not supported with fused=True.
+        :param partial_events: Number of events in each partial sum of the histograms. It must be a multiple
+                               of the batch size of EventBatch readers (a ValueError is raised otherwise).
+                               If None, the histograms are filled directly. FusedAnalysis only counts entries,
+                               so fused runs fill them directly.
+        """
+        if fused and early_stopping is not None:
+            raise ValueError("EarlyStopping is not supported with fused=True.")
         # Function responsible for reading events
         self._file_reader = file_reader
         # Store the histogram template to be used for constructing histograms
         self._hist_template = histogram_template
+        self.metadata_index = metadata_index
+        self.reorder_cuts = reorder_cuts
+        self.progress = progress
+        self.profiler = profiler
+        self.prefetch = prefetch
+        self.prefetch_max_bytes = prefetch_max_bytes
+        self.fused = fused
+        self.early_stopping = early_stopping
+        self.partial_events = partial_events
+        # If True, the partial sums are returned in the partial_sums attribute of the result instead of being
+        # added to the booked histograms, so ParallelEventLoop adds the partial sums of all chunks in file order
+        self.keep_partial_sums = False
+        # Event-scoped cache of the observable values
+        self.observable_cache = ObservableCache()
+
+    @property
+    def file_reader(self) -> Callable:
+        return self._file_reader
+
+    @property
+    def histogram_template(self) -> Histogram:
+        return self._hist_template
 
-    def analyse_events(self, filename: str, event_analyses: Dict[str, EventAnalysis]):
+    def with_reader(self, file_reader: Callable) -> "EventLoop":
+        """Returns a copy of the EventLoop that reads the events with a different file reader."""
+        event_loop = copy.copy(self)
+        event_loop._file_reader = file_reader
+        return event_loop
+
+    def analyse_events(self, filename: str, event_analyses: Dict[str, EventAnalysis], checkpoint=None):
         """
         Runs the analysis on events from the .lhe file and returns a histogram
         constructed from the selected events.
@@ -50,29 +182,233 @@ class EventLoop:
         :param filename: Path to the .lhe file storing the events.
         :param event_analyses: Dictionary with all the diferent analysis that must be applied to the
                                list of events.
+        :param checkpoint: Optional Checkpoint.FileCheckpoint. The run resumes from its state, if it has one,
+                           and it is updated after each chunk. The built-in readers of plain files resume
+                           reading at the byte offset after the chunks already processed (see
+                           LHEReader.resume_reader); other readers read them again without analysing them.
 
-        :return: Dict with the booked histogram for each analysis.
+        :return: AnalysisResult, a dict with the booked histogram for each analysis,
+                 which also holds the metadata of the file and the cut-flow tables.
         """
+        if checkpoint is not None and self.keep_partial_sums:
+            raise ValueError("The partial sums kept in the result are not saved in the checkpoint.")
         print(f"Reading events from file: {filename}")
 
+        # Metadata from the index or from the header of the file
+        metadata = self.metadata_index.get(filename) if self.metadata_index is not None else None
+        if metadata is None:
+            metadata = read_metadata(filename)
+
         # Count the number of processed events
         evt_number = 0
         # Initialize an empty for each of the analysis
         analyses_hist = {analysis_name: copy.copy(self._hist_template) for analysis_name in event_analyses}
+        # Evaluates the cuts of all the analyses
+        # The cost of the cuts is only measured if it is used to reorder them or reported by the profiler
+        cutflow_engine = CutFlowEngine(
+            event_analyses, reorder=self.reorder_cuts, timed=self.reorder_cuts or self.profiler is not None
+        )
 
-        # Iterate over events in the file
-        for event in self._file_reader(filename):
-            if evt_number > 0 and evt_number % 10000 == 0:
-                print(f"INFO: Processed {evt_number} events")
-            # Iterates over all the analyses
-            for analysis_name, event_analysis in event_analyses.items():
-                # Launch the analysis on the event
-                passed_cuts = event_analysis.launch_analysis(event=event)
-                # Update the histogram if the event passes selection cuts
-                if passed_cuts:
-                    analyses_hist[analysis_name].update_hist(event=event)
-            # Increment event counter
-            evt_number += 1
+        # Number of chunks already processed in an interrupted run, and the state of the reader statistics
+        # after them, holding the byte offset where the reading of the file resumes
+        n_processed_chunks, reader_state = 0, None
+        if checkpoint is not None and checkpoint.state is not None:
+            for analysis_name, hist in analyses_hist.items():
+                hist.load_state_dict(checkpoint.state["histograms"][analysis_name])
+            cutflow_engine.load_state_dict(checkpoint.state["cutflow"])
+            evt_number = checkpoint.state["n_events"]
+            n_processed_chunks = checkpoint.state["n_chunks"]
+            reader_state = checkpoint.state.get("reader_state")
+        fused_analysis = FusedAnalysis(cutflow_engine, analyses_hist) if self.fused else None
+        # Histograms filled with the events, holding the partial sums if partial_events is given
+        filled_hist = analyses_hist
+        partial_events = None if self.fused else self.partial_events
+        partial_sums = [] if partial_events is not None and self.keep_partial_sums else None
+        if partial_events is not None:
+            filled_hist = {analysis_name: copy.copy(self._hist_template) for analysis_name in event_analyses}
+            # Number of events at the end of the current partial sum
+            next_partial = (evt_number // partial_events + 1) * partial_events
+        # Histograms of the sum of weights monitoring the precision of each analysis
+        monitors = None
+        if self.early_stopping is not None:
+            monitors = {analysis_name: self.early_stopping.monitor() for analysis_name in event_analyses}
+        stop_reason = None
+
+        profiler = self.profiler
+        file_reader = self._file_reader
+        if reader_state is not None and reader_state["position"] is not None:
+            try:
+                file_reader = resume_reader(file_reader, reader_state["position"])
+            except ValueError:
+                # The reader can not start at a byte offset
+                reader_state = None
+        else:
+            reader_state = None
+        stream = file_reader(filename)
+        # The built-in readers report the events skipped by their prefilter
+        read_statistics = getattr(stream, "statistics", None)
+        if reader_state is not None:
+            # The events before the offset still count in the statistics
+            read_statistics.load_state_dict(reader_state)
+        if self.prefetch > 0:
+            stream = PrefetchStream(stream, depth=self.prefetch, max_bytes=self.prefetch_max_bytes)
+        if reader_state is None:
+            # Other readers read the chunks already processed again, without analysing them
+            for _ in itertools.islice(stream, n_processed_chunks):
+                pass
+        # Number of chunks read
+        n_chunks = n_processed_chunks
+        chunks = stream
+        if profiler is not None:
+            chunks = profiler.timed_iter(chunks, "reader")
+            observable_timings = dict(self.observable_cache.timings)
+            observable_misses = dict(self.observable_cache.misses)
+            self.observable_cache.profile = True
+            start_time = time.perf_counter()
+
+        # Iterate over events (or batches of events) in the file
+        try:
+            with self.observable_cache.activate():
+                for chunk in chunks:
+                    n_chunks += 1
+                    # Values cached for the previous event (or batch) are no longer needed
+                    self.observable_cache.clear()
+                    if isinstance(chunk, EventBatch) and fused_analysis is not None:
+                        if profiler is None:
+                            fused_analysis.process(chunk)
+                        else:
+                            with profiler.time("fused"):
+                                fused_analysis.process(chunk)
+                        n_events = len(chunk)
+                    elif isinstance(chunk, EventBatch):
+                        self._analyse_batch(batch=chunk, cutflow_engine=cutflow_engine, analyses_hist=filled_hist,
+                                            profiler=profiler, monitors=monitors)
+                        n_events = len(chunk)
+                    else:
+                        self._analyse_event(event=chunk, cutflow_engine=cutflow_engine, analyses_hist=filled_hist,
+                                            profiler=profiler, monitors=monitors)
+                        n_events = 1
+                    # Increment event counter
+                    evt_number += n_events
+                    if self.progress is not None:
+                        self.progress(filename, evt_number, n_events)
+                    if partial_events is not None and evt_number > next_partial:
+                        raise ValueError(
+                            f"The batch of {n_events} events ending at event {evt_number} overshoots the partial "
+                            f"sum ending at event {next_partial}: partial_events ({partial_events}) must be a "
+                            "multiple of the batch size."
+                        )
+                    completed_partial = partial_events is not None and evt_number == next_partial
+                    if completed_partial:
+                        filled_hist = self._add_partial_sums(analyses_hist, filled_hist, partial_sums)
+                        next_partial += partial_events
+                    # With partial sums, the state is only saved once a partial sum was added to the histograms
+                    if checkpoint is not None and (partial_events is None or completed_partial):
+                        checkpoint.update(
+                            n_chunks, evt_number, analyses_hist, cutflow_engine, self._reader_state(stream)
+                        )
+                    if monitors is not None:
+                        stop_reason = self.early_stopping.check(evt_number, n_events, monitors)
+                        if stop_reason is not None:
+                            break
+        finally:
+            # Stops the reader if the analysis failed or stopped early
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+
+        if partial_events is not None:
+            self._add_partial_sums(analyses_hist, filled_hist, partial_sums)
 
+        profile = None
+        if profiler is not None:
+            self.observable_cache.profile = False
+            profiler.wall_time += time.perf_counter() - start_time
+            profiler.n_events += evt_number
+            for name, stats in cutflow_engine.statistics().items():
+                profiler.add(f"cut:{name}", stats["time"], stats["calls"])
+            for name, elapsed in self.observable_cache.timings.items():
+                profiler.add(
+                    f"observable:{name}", elapsed - observable_timings.get(name, 0.0),
+                    self.observable_cache.misses.get(name, 0) - observable_misses.get(name, 0)
+                )
+            if isinstance(stream, PrefetchStream):
+                profiler.add("reader_stall", stream.stall_time)
+            profile = profiler.report()
+
+        # The number of events is known once the whole file was read (or the number of events consumed,
+        # if it stopped early). Events skipped by the prefilter of the reader are part of the sample,
+        # so they count for the normalisation
+        metadata.num_events = evt_number
+        reader_statistics = None
+        if read_statistics is not None:
+            metadata.num_events += read_statistics.n_skipped
+            reader_statistics = read_statistics.to_dict()
+        if isinstance(stream, PrefetchStream):
+            reader_statistics = {**(reader_statistics or {}), "stall_time": stream.stall_time}
+        early_stopping = None
+        if stop_reason is not None:
+            early_stopping = self.early_stopping.report(stop_reason, evt_number, monitors)
+        elif self.metadata_index is not None:
+            # The number of events of a file read partially is not stored in the index
+            self.metadata_index.put(filename, metadata)
+
+        result = AnalysisResult(
+            analyses_hist, metadata, cutflow_engine.cutflow(), profile, reader_statistics, early_stopping, partial_sums
+        )
+        if checkpoint is not None:
+            checkpoint.complete(result)
         # Returns the dictionary with booked histogram for each analysis
-        return analyses_hist
+        return result
+
+    @staticmethod
+    def _reader_state(stream) -> Optional[Dict]:
+        """State of the statistics of the reader after the chunks analysed, without the chunks read ahead."""
+        if isinstance(stream, PrefetchStream):
+            return stream.consumed_statistics
+        statistics = getattr(stream, "statistics", None)
+        return statistics.state_dict() if statistics is not None else None
+
+    def _add_partial_sums(self, analyses_hist: Dict[str, Histogram], partial_hist: Dict[str, Histogram],
+                          partial_sums: List[Dict[str, Histogram]] = None) -> Dict[str, Histogram]:
+        """
+        Adds the partial sums to the booked histograms (or appends them to partial_sums, if given),
+        and returns empty histograms for the next partial sums.
+        """
+        if partial_sums is not None:
+            partial_sums.append(partial_hist)
+        else:
+            for analysis_name, hist in analyses_hist.items():
+                hist.merge_hist(partial_hist[analysis_name])
+        return {analysis_name: copy.copy(self._hist_template) for analysis_name in analyses_hist}
+
+    @staticmethod
+    def _analyse_event(event, cutflow_engine: CutFlowEngine, analyses_hist: Dict[str, Histogram],
+                       profiler: Profiler = None, monitors: Dict[str, Histogram] = None):
+        """Runs all the analyses on a single event, also filling the monitors of the EarlyStopping if given."""
+        # Iterates over all the analyses
+        for analysis_name, passed_cuts in cutflow_engine.select(event).items():
+            # Update the histogram if the event passes selection cuts
+            if passed_cuts:
+                if profiler is None:
+                    analyses_hist[analysis_name].update_hist(event=event)
+                else:
+                    with profiler.time(f"update_hist:{analysis_name}"):
+                        analyses_hist[analysis_name].update_hist(event=event)
+                if monitors is not None:
+                    monitors[analysis_name].update_hist(event=event)
+
+    @staticmethod
+    def _analyse_batch(batch: EventBatch, cutflow_engine: CutFlowEngine, analyses_hist: Dict[str, Histogram],
+                       profiler: Profiler = None, monitors: Dict[str, Histogram] = None):
+        """Runs all the analyses on a batch of events, also filling the monitors of the EarlyStopping if given."""
+        # Boolean mask with the selected events of each analysis
+        for analysis_name, passed_cuts in cutflow_engine.select_batch(batch).items():
+            if passed_cuts.any():
+                if profiler is None:
+                    analyses_hist[analysis_name].update_hist_batch(batch=batch, mask=passed_cuts)
+                else:
+                    with profiler.time(f"update_hist:{analysis_name}"):
+                        analyses_hist[analysis_name].update_hist_batch(batch=batch, mask=passed_cuts)
+                if monitors is not None:
+                    monitors[analysis_name].update_hist_batch(batch=batch, mask=passed_cuts)
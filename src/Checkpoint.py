@@ -0,0 +1,192 @@
+"""
+Checkpoints of the histograms booked for each file, so multi-file scans can be re-run incrementally.
+
+Each checkpoint is a .npz file holding the histogram states of the analyses and a JSON header with
+the identity of the input file (path, size and modification time), the fingerprint of the analysis
+configuration, the metadata, the cut-flow and the early stopping report. Files that did not change
+since their checkpoint was written are loaded instead of analysed, and runs interrupted in the middle
+of a file resume from the last chunk saved.
+"""
+
+from typing import Callable, Dict, List, Optional
+from PyLHE_EventAnalysis.src.Analysis import AnalysisResult, EventAnalysis, EventLoop
+from PyLHE_EventAnalysis.src.CutFlow import CutFlowEngine
+from PyLHE_EventAnalysis.src.Histogram import Histogram, callable_name
+from PyLHE_EventAnalysis.src.Metadata import LHEMetadata
+from PyLHE_EventAnalysis.src.Utilities import file_signature
+import copy
+import functools
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+# Version of the checkpoint format
+CHECKPOINT_VERSION = 2
+
+
+def _reader_name(file_reader: Callable) -> str:
+    """Name of the file reader, including the arguments of functools.partial objects."""
+    if isinstance(file_reader, functools.partial):
+        return f"{callable_name(file_reader.func)}{file_reader.args}{sorted(file_reader.keywords.items())}"
+    return callable_name(file_reader)
+
+
+def analysis_fingerprint(event_loop: EventLoop, event_analyses: Dict[str, EventAnalysis]) -> str:
+    """
+    Hash of the analysis configuration: the file reader, the histogram configuration (binning and
+    observables), the EarlyStopping criterion and the cuts of each analysis. Functions are identified by their qualified name and
+    other callables by their repr, so callables without a stable repr always give a new fingerprint.
+    """
+    configuration = {
+        "reader": _reader_name(event_loop.file_reader),
+        "reorder_cuts": event_loop.reorder_cuts,
+        "partial_events": None if event_loop.fused else event_loop.partial_events,
+        "histogram": event_loop.histogram_template.config(),
+        "early_stopping": event_loop.early_stopping.config() if event_loop.early_stopping is not None else None,
+        "analyses": {
+            name: [callable_name(cut) for cut in event_analysis.selection()] for name, event_analysis in event_analyses.items()
+        },
+    }
+    return hashlib.blake2b(json.dumps(configuration, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def _save_checkpoint(path: str, header: Dict, histograms: Dict[str, Histogram]):
+    """Writes the checkpoint atomically, so an interruption never leaves a truncated file."""
+    arrays = {
+        f"hist/{analysis_name}/{key}": value
+        for analysis_name, hist in histograms.items() for key, value in hist.state_dict().items()
+    }
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as checkpoint_file:
+        np.savez(checkpoint_file, header=np.array(json.dumps(header)), **arrays)
+    os.replace(temporary_path, path)
+
+
+def _load_checkpoint(path: str) -> Optional[Dict]:
+    """Reads the header and the histogram states of a checkpoint, or returns None if it can not be read."""
+    try:
+        with np.load(path, allow_pickle=False) as checkpoint:
+            header = json.loads(str(checkpoint["header"]))
+            histograms = {}
+            for key in checkpoint.files:
+                if key.startswith("hist/"):
+                    analysis_name, state_key = key[len("hist/"):].split("/", 1)
+                    histograms.setdefault(analysis_name, {})[state_key] = checkpoint[key]
+    except (OSError, ValueError, KeyError):
+        return None
+    header["histograms"] = histograms
+    return header
+
+
+class FileCheckpoint:
+    """
+    Checkpoint of the analysis of a single file, updated by EventLoop.analyse_events.
+    The state attribute holds the state of an interrupted run, or None to start from the beginning.
+    """
+
+    def __init__(self, path: str, filename: str, fingerprint: str, interval: float, state: Dict = None):
+        """
+        :param path: Path of the checkpoint file.
+        :param filename: The analysed file.
+        :param fingerprint: Fingerprint of the analysis configuration.
+        :param interval: Minimum time in seconds between two saves during the run.
+        :param state: State of an interrupted run.
+        """
+        self.path = path
+        self.filename = filename
+        self.fingerprint = fingerprint
+        self.interval = interval
+        self.state = state
+        self._last_save = time.monotonic()
+
+    def _header(self, complete: bool) -> Dict:
+        return {
+            "version": CHECKPOINT_VERSION,
+            "source": os.path.abspath(self.filename),
+            "signature": list(file_signature(self.filename)),
+            "fingerprint": self.fingerprint,
+            "complete": complete,
+        }
+
+    def update(self, n_chunks: int, n_events: int, analyses_hist: Dict[str, Histogram], cutflow_engine: CutFlowEngine,
+               reader_state: Dict = None):
+        """
+        Saves the state of the run after n_chunks chunks, if interval seconds passed since the last save.
+        The reader_state holds the state of the reader statistics (see LHEReader.ReadStatistics.state_dict),
+        with the byte offset where the reading of the file resumes.
+        """
+        if time.monotonic() - self._last_save < self.interval:
+            return
+        header = self._header(complete=False)
+        header.update(n_chunks=n_chunks, n_events=n_events, cutflow=cutflow_engine.state_dict(),
+                      reader_state=reader_state)
+        _save_checkpoint(self.path, header, analyses_hist)
+        self._last_save = time.monotonic()
+
+    def complete(self, result: AnalysisResult):
+        """Saves the final histograms, metadata and cut-flow of the file."""
+        header = self._header(complete=True)
+        header.update(metadata=result.metadata.to_dict(), cutflow_table=result.cutflow,
+                      reader_statistics=result.reader_statistics, early_stopping=result.early_stopping)
+        _save_checkpoint(self.path, header, result)
+
+
+class CheckpointRunner:
+    """
+    Runs an EventLoop over several files, keeping a checkpoint of each file in checkpoint_dir.
+    A file is analysed again only if it was modified, the analysis configuration changed (see
+    analysis_fingerprint) or its previous run did not finish, in which case it resumes at the
+    last saved chunk. The built-in readers of plain files resume reading the file after the chunks
+    already processed; other readers read them again, but do not analyse them.
+    """
+
+    def __init__(self, event_loop: EventLoop, checkpoint_dir: str, interval: float = 60.0):
+        """
+        :param event_loop: The EventLoop used to analyse the files.
+        :param checkpoint_dir: Directory where the checkpoints are stored.
+        :param interval: Minimum time in seconds between two checkpoints of the same file.
+        """
+        self.event_loop = event_loop
+        self.checkpoint_dir = checkpoint_dir
+        self.interval = interval
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def checkpoint_path(self, filename: str, fingerprint: str) -> str:
+        """Path of the checkpoint of the file for the given analysis configuration."""
+        file_key = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=8).hexdigest()
+        base_name = os.path.splitext(os.path.basename(filename))[0]
+        return os.path.join(self.checkpoint_dir, f"{base_name}-{file_key}-{fingerprint[:16]}.npz")
+
+    def _stored_state(self, path: str, filename: str, fingerprint: str) -> Optional[Dict]:
+        """State stored in the checkpoint, if it belongs to the current version of the file and configuration."""
+        if not os.path.exists(path):
+            return None
+        state = _load_checkpoint(path)
+        if (
+            state is None or state.get("version") != CHECKPOINT_VERSION or state.get("fingerprint") != fingerprint
+            or tuple(state.get("signature", ())) != file_signature(filename)
+        ):
+            return None
+        return state
+
+    def analyse_events(self, filename: str, event_analyses: Dict[str, EventAnalysis]) -> AnalysisResult:
+        """Returns the result for the file, loaded from its checkpoint or computed (and checkpointed)."""
+        fingerprint = analysis_fingerprint(self.event_loop, event_analyses)
+        path = self.checkpoint_path(filename, fingerprint)
+        state = self._stored_state(path, filename, fingerprint)
+        if state is not None and state["complete"]:
+            print(f"Loading checkpoint of file: {filename}")
+            analyses_hist = {name: copy.copy(self.event_loop.histogram_template) for name in event_analyses}
+            for analysis_name, hist in analyses_hist.items():
+                hist.load_state_dict(state["histograms"][analysis_name])
+            return AnalysisResult(analyses_hist, LHEMetadata.from_dict(state["metadata"]), state["cutflow_table"],
+                                  reader_statistics=state.get("reader_statistics"),
+                                  early_stopping=state.get("early_stopping"))
+        checkpoint = FileCheckpoint(path, filename, fingerprint, self.interval, state=state)
+        return self.event_loop.analyse_events(filename, event_analyses, checkpoint=checkpoint)
+
+    def analyse_files(self, filenames: List[str], event_analyses: Dict[str, EventAnalysis]) -> Dict[str, AnalysisResult]:
+        """Analyses the files one after the other, returning {filename: result}."""
+        return {filename: self.analyse_events(filename, event_analyses) for filename in filenames}
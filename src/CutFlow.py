@@ -0,0 +1,281 @@
+"""Shared evaluation of the selection cuts of several analyses and bookkeeping of their cut-flow."""
+
+from typing import Callable, Dict, List
+from PyLHE_EventAnalysis.src.EventBatch import EventBatch, evaluate_on_batch, is_vectorized
+import numpy as np
+import time
+
+
+def cut_name(cut: Callable) -> str:
+    """Name of the cut used in the cut-flow tables."""
+    return getattr(cut, "__name__", None) or repr(cut)
+
+
+class CutStatistics:
+    """Measured cost and selection rate of a cut."""
+
+    __slots__ = ("n_evaluated", "n_passed", "time")
+
+    def __init__(self):
+        self.n_evaluated = 0
+        self.n_passed = 0
+        self.time = 0.0
+
+    def score(self) -> float:
+        """
+        Expected cost of the cut per rejected event. Cuts with the lowest score should run first.
+        Cuts that were never evaluated get a score of zero, so their statistics are measured.
+        """
+        if self.n_evaluated == 0:
+            return 0.0
+        rejection_rate = 1 - self.n_passed / self.n_evaluated
+        return (self.time / self.n_evaluated) / max(rejection_rate, 1e-6)
+
+
+class CutFlowEngine:
+    """
+    Evaluates the selection cuts of all the analyses as a single graph of distinct cuts.
+    A cut used by several analyses (the same object, or objects comparing equal) is evaluated
+    at most once per event. If reorder is True, the cuts already evaluated for the event are checked
+    first within each analysis, and the others are periodically sorted by their measured cost per
+    rejected event, so cheap and selective cuts run first. Otherwise, the cuts of each analysis are
+    checked in the declared order. The cuts of each analysis are given by EventAnalysis.selection, so
+    analyses overriding launch_analysis are selected by it.
+
+    Without reordering, the cut-flow table is the sequential cut-flow in the declared order: the number
+    of events rejected by each cut and the number of events remaining after it. The order of the cuts
+    changes which cuts an event is checked against, so with reordering the table only holds the number
+    of events and the number of selected events, which do not depend on the execution order.
+    """
+
+    def __init__(self, event_analyses: Dict, reorder: bool = False, reorder_interval: int = 1000,
+                 timed: bool = None):
+        """
+        :param event_analyses: Dictionary with the EventAnalysis objects.
+        :param reorder: Whether the cuts are reordered by their measured cost and rejection rate.
+        :param reorder_interval: Number of events between two reorderings.
+        :param timed: Whether the time spent in each cut is measured (see statistics). Defaults to reorder,
+                      which needs it.
+        """
+        self._reorder = reorder
+        self._timed = reorder if timed is None else timed
+        self._reorder_interval = reorder_interval
+        self._events_since_reorder = 0
+        # Distinct cuts and the indices of the cuts used by each analysis, in the declared order
+        self._cuts: List[Callable] = []
+        self._analysis_cuts = {}
+        for analysis_name, event_analysis in event_analyses.items():
+            indices = []
+            for cut in event_analysis.selection():
+                cut_index = next(
+                    (index for index, known_cut in enumerate(self._cuts) if known_cut is cut or known_cut == cut), None
+                )
+                if cut_index is None:
+                    cut_index = len(self._cuts)
+                    self._cuts.append(cut)
+                indices.append(cut_index)
+            self._analysis_cuts[analysis_name] = indices
+        self._stats = [CutStatistics() for _ in self._cuts]
+        # Order in which the cuts of each analysis are evaluated
+        self._evaluation_order = {name: list(indices) for name, indices in self._analysis_cuts.items()}
+        # Number of events seen and selected by each analysis, and checked against and passing each of its cuts
+        self._n_events = {name: 0 for name in self._analysis_cuts}
+        self._n_selected = {name: 0 for name in self._analysis_cuts}
+        self._evaluated = {name: {cut_index: 0 for cut_index in indices} for name, indices in self._analysis_cuts.items()}
+        self._passed = {name: {cut_index: 0 for cut_index in indices} for name, indices in self._analysis_cuts.items()}
+
+    @property
+    def cuts(self) -> List[Callable]:
+        """The distinct cuts of all the analyses."""
+        return self._cuts
+
+    @property
+    def analysis_cuts(self) -> Dict[str, List[int]]:
+        """Indices in cuts of the cuts of each analysis, in the declared order."""
+        return self._analysis_cuts
+
+    def _evaluate(self, cut_index: int, event) -> bool:
+        """Evaluates a cut on a single event, measuring its cost if the engine is timed."""
+        stats = self._stats[cut_index]
+        if self._timed:
+            start_time = time.perf_counter()
+            passed = bool(self._cuts[cut_index](event))
+            stats.time += time.perf_counter() - start_time
+        else:
+            passed = bool(self._cuts[cut_index](event))
+        stats.n_evaluated += 1
+        stats.n_passed += passed
+        return passed
+
+    def _evaluate_batch(self, cut_index: int, batch: EventBatch, mask: np.ndarray):
+        """Evaluates a cut on the events of the batch selected by the mask (or on all of them if it is vectorized)."""
+        cut = self._cuts[cut_index]
+        stats = self._stats[cut_index]
+        start_time = time.perf_counter() if self._timed else None
+        if is_vectorized(cut):
+            mask = np.ones(len(batch), dtype=bool)
+            passed = np.asarray(cut(batch), dtype=bool)
+        else:
+            passed = evaluate_on_batch(cut, batch, mask).astype(bool)
+        if start_time is not None:
+            stats.time += time.perf_counter() - start_time
+        stats.n_evaluated += len(passed)
+        stats.n_passed += int(np.count_nonzero(passed))
+        return mask, passed
+
+    def _count_events(self, n_events: int):
+        """Reorders the cuts once reorder_interval events were processed."""
+        self._events_since_reorder += n_events
+        if self._reorder and self._events_since_reorder >= self._reorder_interval:
+            self._events_since_reorder = 0
+            for analysis_name, indices in self._analysis_cuts.items():
+                self._evaluation_order[analysis_name] = sorted(indices, key=lambda index: self._stats[index].score())
+
+    def select(self, event) -> Dict[str, bool]:
+        """Returns, for each analysis, whether the event passes all its cuts."""
+        results = {}
+        selected = {}
+        for analysis_name, order in self._evaluation_order.items():
+            self._n_events[analysis_name] += 1
+            evaluated, passed = self._evaluated[analysis_name], self._passed[analysis_name]
+            # Cuts already evaluated for this event are free, so they are checked first
+            rejected_by = next((index for index in order if results.get(index) is False), None) if self._reorder else None
+            if rejected_by is not None:
+                evaluated[rejected_by] += 1
+            else:
+                for cut_index in order:
+                    if cut_index not in results:
+                        results[cut_index] = self._evaluate(cut_index, event)
+                    evaluated[cut_index] += 1
+                    if not results[cut_index]:
+                        rejected_by = cut_index
+                        break
+                    passed[cut_index] += 1
+            selected[analysis_name] = rejected_by is None
+            self._n_selected[analysis_name] += rejected_by is None
+        self._count_events(1)
+        return selected
+
+    def select_batch(self, batch: EventBatch) -> Dict[str, np.ndarray]:
+        """Returns, for each analysis, a boolean mask with the events of the batch passing all its cuts."""
+        n_events = len(batch)
+        # For each cut evaluated on the batch, the events where it is known and its result
+        known, results = {}, {}
+        selected = {}
+        for analysis_name, order in self._evaluation_order.items():
+            self._n_events[analysis_name] += n_events
+            if self._reorder:
+                # Cuts already evaluated on the whole batch are checked first
+                order = sorted(order, key=lambda index: index not in known or not known[index].all())
+            passed = np.ones(n_events, dtype=bool)
+            for cut_index in order:
+                if not passed.any():
+                    break
+                if cut_index not in known:
+                    known[cut_index] = np.zeros(n_events, dtype=bool)
+                    results[cut_index] = np.zeros(n_events, dtype=bool)
+                missing = passed & ~known[cut_index]
+                if missing.any():
+                    evaluated, evaluated_results = self._evaluate_batch(cut_index, batch, missing)
+                    results[cut_index][evaluated] = evaluated_results
+                    known[cut_index] |= evaluated
+                self._evaluated[analysis_name][cut_index] += int(np.count_nonzero(passed))
+                passed &= results[cut_index]
+                self._passed[analysis_name][cut_index] += int(np.count_nonzero(passed))
+            selected[analysis_name] = passed
+            self._n_selected[analysis_name] += int(np.count_nonzero(passed))
+        self._count_events(n_events)
+        return selected
+
+    def record_counts(self, n_events: int, rejected: Dict[str, List[int]], n_evaluated: List[int], n_passed: List[int]):
+        """
+        Adds the counts of cuts evaluated outside the engine (see FusedAnalysis) on n_events events.
+
+        :param n_events: Number of events seen by each analysis.
+        :param rejected: For each analysis, the number of events rejected by each of its cuts, in the declared order.
+        :param n_evaluated: Number of events each distinct cut was evaluated on.
+        :param n_passed: Number of events passing each distinct cut.
+        """
+        for analysis_name, indices in self._analysis_cuts.items():
+            self._n_events[analysis_name] += n_events
+            # The cuts were checked in the declared order
+            remaining = n_events
+            for cut_index, n_rejected in zip(indices, rejected[analysis_name]):
+                self._evaluated[analysis_name][cut_index] += remaining
+                remaining -= n_rejected
+                self._passed[analysis_name][cut_index] += remaining
+            self._n_selected[analysis_name] += remaining
+        for stats, evaluated, passed in zip(self._stats, n_evaluated, n_passed):
+            stats.n_evaluated += evaluated
+            stats.n_passed += passed
+
+    def statistics(self) -> Dict[str, Dict]:
+        """
+        Time spent in each distinct cut (zero if the engine is not timed), with the number of events
+        it was evaluated on and passed.
+        """
+        statistics = {}
+        for cut, stats in zip(self._cuts, self._stats):
+            # Different cuts may have the same name (e.g. lambdas), their statistics are added
+            entry = statistics.setdefault(cut_name(cut), {"time": 0.0, "calls": 0, "passed": 0})
+            entry["time"] += stats.time
+            entry["calls"] += stats.n_evaluated
+            entry["passed"] += stats.n_passed
+        return statistics
+
+    def state_dict(self) -> Dict:
+        """Counters, cut statistics and evaluation order, so the engine can resume an interrupted run."""
+        return {
+            "n_events": dict(self._n_events),
+            "n_selected": dict(self._n_selected),
+            # Lists of (cut index, count) pairs, since the keys of JSON objects are strings
+            "evaluated": {name: list(counts.items()) for name, counts in self._evaluated.items()},
+            "passed": {name: list(counts.items()) for name, counts in self._passed.items()},
+            "evaluation_order": {name: list(order) for name, order in self._evaluation_order.items()},
+            "stats": [[stats.n_evaluated, stats.n_passed, stats.time] for stats in self._stats],
+            "events_since_reorder": self._events_since_reorder,
+        }
+
+    def load_state_dict(self, state: Dict):
+        """Restores the state saved by state_dict. The engine must be built from the same analyses."""
+        self._n_events = dict(state["n_events"])
+        self._n_selected = dict(state["n_selected"])
+        self._evaluated = {name: dict(map(tuple, counts)) for name, counts in state["evaluated"].items()}
+        self._passed = {name: dict(map(tuple, counts)) for name, counts in state["passed"].items()}
+        self._evaluation_order = {name: list(order) for name, order in state["evaluation_order"].items()}
+        for stats, (n_evaluated, n_passed, elapsed) in zip(self._stats, state["stats"]):
+            stats.n_evaluated, stats.n_passed, stats.time = n_evaluated, n_passed, elapsed
+        self._events_since_reorder = state["events_since_reorder"]
+
+    def cutflow(self) -> Dict[str, List[Dict]]:
+        """
+        Cut-flow table of each analysis: a first row holding the total number of events, then one row
+        per cut, in the declared order, with the cut name, the number of events it rejected and the number
+        of events passing after it. With reordering, the cut rows are replaced by a single "selected" row
+        holding the number of events rejected by any of the cuts and the number passing all of them.
+        """
+        tables = {}
+        for analysis_name, indices in self._analysis_cuts.items():
+            n_events = self._n_events[analysis_name]
+            table = [{"cut": "all events", "rejected": 0, "passed": n_events}]
+            if self._reorder:
+                n_selected = self._n_selected[analysis_name]
+                table.append({"cut": "selected", "rejected": n_events - n_selected, "passed": n_selected})
+            else:
+                evaluated, passed = self._evaluated[analysis_name], self._passed[analysis_name]
+                for cut_index in indices:
+                    table.append({"cut": cut_name(self._cuts[cut_index]),
+                                  "rejected": evaluated[cut_index] - passed[cut_index], "passed": passed[cut_index]})
+            tables[analysis_name] = table
+        return tables
+
+
+def merge_cutflows(cutflow: Dict[str, List[Dict]], other: Dict[str, List[Dict]]) -> Dict[str, List[Dict]]:
+    """Adds up the cut-flow tables of two runs of the same analyses."""
+    return {
+        analysis_name: [
+            {key: value if key == "cut" else value + other_row[key] for key, value in row.items()}
+            for row, other_row in zip(table, other[analysis_name])
+        ]
+        for analysis_name, table in cutflow.items()
+    }
@@ -0,0 +1,93 @@
+"""Stops reading a file once the histograms reach a target statistical precision or an event budget."""
+
+from typing import Callable, Dict, List
+from PyLHE_EventAnalysis.src.Histogram import WeightedHistogram, callable_name
+import numpy as np
+
+
+class EarlyStopping:
+    """
+    Criterion of the EventLoop for stopping the analysis of a file before its end.
+
+    For each analysis, the EventLoop fills a WeightedHistogram of the monitored observable with the
+    selected events. The file stops being read once, in every analysis, all the populated bins
+    have a relative uncertainty sqrt(sumw2) / |sumw| at most target_relative_error, or once
+    max_events events were analysed. Whole chunks are analysed, so with EventBatch readers the number
+    of events can exceed max_events by less than one batch.
+
+    The EventLoop then sets metadata.num_events to the number of events actually consumed, so the
+    cross_section / num_events normalisation stays correct.
+    The monitors are not checkpointed: a resumed run starts them empty, so it stops later, never earlier.
+    """
+
+    def __init__(self, bin_edges: List[float], observable: Callable, target_relative_error: float = None,
+                 max_events: int = None, min_events: int = 1000, check_interval: int = 1000):
+        """
+        :param bin_edges: The bin edges of the monitored histogram.
+        :param observable: The observable of the monitored histogram.
+        :param target_relative_error: Relative uncertainty every populated bin must reach. If None,
+                                      only the event budget stops the analysis.
+        :param max_events: Maximum number of events analysed in each file.
+        :param min_events: Number of events analysed before the precision is checked.
+        :param check_interval: The precision is checked every check_interval events.
+        """
+        if target_relative_error is None and max_events is None:
+            raise ValueError("EarlyStopping needs a target_relative_error or a max_events.")
+        self.bin_edges = bin_edges
+        self.observable = observable
+        self.target_relative_error = target_relative_error
+        self.max_events = max_events
+        self.min_events = min_events
+        self.check_interval = check_interval
+
+    @classmethod
+    def for_histogram(cls, hist, **kwargs) -> "EarlyStopping":
+        """Monitors the observable and the bin edges of an ObservableHistogram (e.g. the histogram template)."""
+        return cls(hist.bin_edges, hist.observable, **kwargs)
+
+    def config(self) -> Dict:
+        """Description of the criterion, used to fingerprint an analysis."""
+        return {
+            "bin_edges": list(map(float, self.bin_edges)), "observable": callable_name(self.observable),
+            "target_relative_error": self.target_relative_error, "max_events": self.max_events,
+            "min_events": self.min_events, "check_interval": self.check_interval,
+        }
+
+    def monitor(self) -> WeightedHistogram:
+        """Histogram filled with the selected events of an analysis."""
+        return WeightedHistogram(self.bin_edges, self.observable)
+
+    @staticmethod
+    def relative_error(monitor: WeightedHistogram) -> float:
+        """Largest relative uncertainty of the populated bins, or inf if no bin is populated."""
+        sumw, sumw2 = monitor.sumw[0], monitor.sumw2[0]
+        populated = sumw != 0
+        if not populated.any():
+            return np.inf
+        return float(np.max(np.sqrt(sumw2[populated]) / np.abs(sumw[populated])))
+
+    def check(self, n_events: int, n_new: int, monitors: Dict[str, WeightedHistogram]) -> str:
+        """
+        Returns the reason for stopping after n_events were analysed, n_new of them in the last chunk:
+        "max_events", "precision", or None if the analysis must go on.
+        """
+        if self.max_events is not None and n_events >= self.max_events:
+            return "max_events"
+        if self.target_relative_error is None or n_events < self.min_events:
+            return None
+        # Only checked when a multiple of check_interval is crossed
+        if n_events // self.check_interval == (n_events - n_new) // self.check_interval:
+            return None
+        if all(self.relative_error(monitor) <= self.target_relative_error for monitor in monitors.values()):
+            return "precision"
+        return None
+
+    def report(self, reason: str, n_events: int, monitors: Dict[str, WeightedHistogram]) -> Dict:
+        """Summary attached to the AnalysisResult."""
+        return {
+            "reason": reason,
+            "n_events": n_events,
+            "max_relative_error": {
+                analysis_name: self.relative_error(monitor) for analysis_name, monitor in monitors.items()
+            },
+        }
@@ -0,0 +1,221 @@
+"""Columnar representation of chunks of events, used by the batch (vectorized) mode of the EventLoop."""
+
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence
+import numpy as np
+
+# Particle attributes stored as columns in an EventBatch
+PARTICLE_COLUMNS = ("id", "status", "e", "px", "py", "pz", "m")
+
+
+def vectorized(func: Callable) -> Callable:
+    """
+    Marks an observable or a selection cut as vectorized.
+    A vectorized callable takes a whole EventBatch and returns one value (or one boolean) per event.
+    """
+    func.vectorized = True
+    return func
+
+
+def is_vectorized(func: Callable) -> bool:
+    """Returns True if the callable operates on whole EventBatch objects."""
+    return getattr(func, "vectorized", False)
+
+
+def evaluate_on_batch(func: Callable, batch: "EventBatch", mask: np.ndarray = None) -> np.ndarray:
+    """
+    Evaluates an observable (or cut) for the events of the batch selected by the boolean mask.
+    Callables that are not vectorized are called event by event.
+
+    :param func: The observable or cut.
+    :param batch: The EventBatch holding the events.
+    :param mask: Boolean array selecting the events. If None, all events are used.
+
+    :return: Array with one value per selected event.
+    """
+    if is_vectorized(func):
+        values = np.asarray(func(batch))
+        return values if mask is None else values[mask]
+    # Falls back to the per-event API
+    events = batch.events()
+    indices = range(len(batch)) if mask is None else np.flatnonzero(mask)
+    return np.array([func(events[index]) for index in indices])
+
+
+class Particle:
+    """Lightweight particle record with the same attribute names as pylhe.LHEParticle."""
+
+    __slots__ = PARTICLE_COLUMNS
+
+    def __init__(self, id, status, e, px, py, pz, m):
+        self.id = id
+        self.status = status
+        self.e = e
+        self.px = px
+        self.py = py
+        self.pz = pz
+        self.m = m
+
+
+class EventInfo:
+    """Event-level information with the same attribute names as pylhe.LHEEventInfo."""
+
+    __slots__ = ("nparticles", "weight")
+
+    def __init__(self, nparticles, weight):
+        self.nparticles = nparticles
+        self.weight = weight
+
+
+class Event:
+    """
+    Single event record. It can be used wherever a pylhe.LHEEvent is expected by the observables.
+    As in pylhe, weights maps the id of each <rwgt> weight to its value.
+    """
+
+    __slots__ = ("eventinfo", "particles", "weights")
+
+    def __init__(self, eventinfo: EventInfo, particles: List[Particle], weights: Dict[str, float] = None):
+        self.eventinfo = eventinfo
+        self.particles = particles
+        self.weights = weights if weights is not None else {}
+
+
+class EventBatch:
+    """
+    Chunk of events stored as flat per-particle arrays.
+    The particles of event i are stored in the slice offsets[i]:offsets[i + 1] of each column.
+    A column is accessed with batch["px"].
+    The <rwgt> weights of the events, if any, are stored in the variation_weights array, with one
+    column per weight id.
+    """
+
+    def __init__(self, particles: Dict[str, np.ndarray], offsets: np.ndarray, weights: np.ndarray,
+                 variation_weights: np.ndarray = None, weight_ids: Sequence[str] = ()):
+        """
+        :param particles: Dictionary with one flat array for each entry of PARTICLE_COLUMNS.
+        :param offsets: Array with len(weights) + 1 entries delimiting the particles of each event.
+        :param weights: The weight of each event.
+        :param variation_weights: Array with shape (len(weights), len(weight_ids)) holding the <rwgt> weights.
+        :param weight_ids: The ids of the <rwgt> weights.
+        """
+        self.particles = particles
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.weight_ids = tuple(weight_ids)
+        if variation_weights is None:
+            variation_weights = np.zeros((len(self.weights), len(self.weight_ids)))
+        self.variation_weights = np.asarray(variation_weights, dtype=np.float64).reshape(len(self.weights), -1)
+        # Lazily computed helpers
+        self._event_index = None
+        self._events = None
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        """Returns the flat array holding the given particle attribute."""
+        return self.particles[column]
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the arrays of the batch."""
+        return (
+            sum(column.nbytes for column in self.particles.values())
+            + self.offsets.nbytes + self.weights.nbytes + self.variation_weights.nbytes
+        )
+
+    def weight_columns(self, weight_ids: Sequence[str]) -> np.ndarray:
+        """Returns the array with shape (len(batch), len(weight_ids)) holding the given <rwgt> weights."""
+        missing = [weight_id for weight_id in weight_ids if weight_id not in self.weight_ids]
+        if missing:
+            raise KeyError(f"The events have no weights with ids {missing}.")
+        return self.variation_weights[:, [self.weight_ids.index(weight_id) for weight_id in weight_ids]]
+
+    @property
+    def event_index(self) -> np.ndarray:
+        """Index of the event each particle belongs to."""
+        if self._event_index is None:
+            self._event_index = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        return self._event_index
+
+    def events(self) -> List[Event]:
+        """Per-event records of the batch, used to call observables and cuts that are not vectorized."""
+        if self._events is None:
+            columns = [self.particles[column].tolist() for column in PARTICLE_COLUMNS]
+            particles = [Particle(*values) for values in zip(*columns)]
+            variation_weights = [dict(zip(self.weight_ids, values)) for values in self.variation_weights.tolist()]
+            self._events = [
+                Event(EventInfo(nparticles=end - start, weight=weight), particles[start:end], event_weights)
+                for start, end, weight, event_weights in zip(
+                    self.offsets[:-1].tolist(), self.offsets[1:].tolist(), self.weights.tolist(), variation_weights
+                )
+            ]
+        return self._events
+
+    def select(self, mask: np.ndarray) -> "EventBatch":
+        """Returns a new batch containing only the events selected by the boolean mask."""
+        mask = np.asarray(mask, dtype=bool)
+        n_particles = np.diff(self.offsets)
+        particles_mask = np.repeat(mask, n_particles)
+        offsets = np.zeros(np.count_nonzero(mask) + 1, dtype=np.int64)
+        np.cumsum(n_particles[mask], out=offsets[1:])
+        return self.__class__(
+            particles={name: column[particles_mask] for name, column in self.particles.items()},
+            offsets=offsets,
+            weights=self.weights[mask],
+            variation_weights=self.variation_weights[mask],
+            weight_ids=self.weight_ids,
+        )
+
+    @classmethod
+    def from_events(cls, events: Iterable) -> "EventBatch":
+        """
+        Builds a batch from event objects such as the pylhe.LHEEvent objects yielded by pylhe.read_lhe.
+        The <rwgt> weights of the first event define the weight ids of the batch.
+        """
+        columns = {column: [] for column in PARTICLE_COLUMNS}
+        offsets, weights, variation_weights = [0], [], []
+        weight_ids = None
+        for event in events:
+            event_weights = getattr(event, "weights", None) or {}
+            if weight_ids is None:
+                weight_ids = list(event_weights)
+            variation_weights.append([event_weights[weight_id] for weight_id in weight_ids])
+            for part in event.particles:
+                for column in PARTICLE_COLUMNS:
+                    columns[column].append(getattr(part, column))
+            offsets.append(offsets[-1] + len(event.particles))
+            weights.append(event.eventinfo.weight)
+        particles = {
+            column: np.array(values, dtype=np.int64 if column in ("id", "status") else np.float64)
+            for column, values in columns.items()
+        }
+        return cls(particles=particles, offsets=offsets, weights=weights,
+                   variation_weights=np.array(variation_weights, dtype=np.float64).reshape(len(weights), -1),
+                   weight_ids=weight_ids or ())
+
+
+class BatchReader:
+    """
+    Groups the events yielded by a per-event reader (e.g. pylhe.read_lhe) into EventBatch chunks.
+    An instance can be given as the file_reader of the EventLoop to run it in batch mode.
+    """
+
+    def __init__(self, file_reader: Callable, batch_size: int = 10000):
+        """
+        :param file_reader: Function that takes a filename and yields the events one by one.
+        :param batch_size: Number of events in each batch.
+        """
+        self._file_reader = file_reader
+        self.batch_size = batch_size
+
+    def __call__(self, filename: str) -> Iterator[EventBatch]:
+        events = []
+        for event in self._file_reader(filename):
+            events.append(event)
+            if len(events) == self.batch_size:
+                yield EventBatch.from_events(events)
+                events = []
+        # Remaining events
+        if events:
+            yield EventBatch.from_events(events)
@@ -0,0 +1,194 @@
+"""Convert-once columnar cache of .lhe files, read back through memory mapping."""
+
+from typing import Dict, Iterator
+from PyLHE_EventAnalysis.src.EventBatch import EventBatch, PARTICLE_COLUMNS
+from PyLHE_EventAnalysis.src.LHEReader import read_lhe_batches
+from PyLHE_EventAnalysis.src.Utilities import file_hash, file_signature
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+
+# Data type of each array stored in the cache
+_COLUMN_DTYPES = {
+    **{column: "<i8" if column in ("id", "status") else "<f8" for column in PARTICLE_COLUMNS},
+    "offsets": "<i8",
+    "weights": "<f8",
+    # <rwgt> weights, stored event by event
+    "variation_weights": "<f8",
+}
+
+
+class ColumnarCache:
+    """
+    Stores the events of each .lhe file as flat binary columns (the EventBatch arrays) in a cache directory.
+    The first read of a file parses it and fills the cache; later reads memory-map the columns, so the
+    events are not parsed again. An entry is rebuilt when the size or modification time of the source
+    file changed. With verify=True, the hash of the whole source file is also stored and checked, which
+    reads the file once more each time an entry is created or validated (still much cheaper than parsing it).
+    If max_bytes is given, the least recently used entries are removed when the cache grows above it.
+
+    An instance can be given as the file_reader of the EventLoop, which then runs in batch mode.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, cache_dir: str, max_bytes: int = None, batch_size: int = 10000, verify: bool = False):
+        """
+        :param cache_dir: Directory where the cache entries are stored.
+        :param max_bytes: Maximum size of the cache. If None, the cache is unbounded.
+        :param batch_size: Number of events in each EventBatch yielded by the reader.
+        :param verify: Whether the entries are also validated with the hash of the whole source file.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.verify = verify
+
+    def __call__(self, filename: str) -> Iterator[EventBatch]:
+        return self.read_batches(filename)
+
+    def _entry_dir(self, filename: str) -> str:
+        """Directory storing the columns of the file."""
+        path_hash = hashlib.blake2b(os.path.abspath(filename).encode(), digest_size=8).hexdigest()
+        return os.path.join(self.cache_dir, f"{os.path.basename(filename)}.{path_hash}")
+
+    def _load_manifest(self, entry_dir: str) -> Dict:
+        manifest_path = os.path.join(entry_dir, self.MANIFEST)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as manifest_file:
+            return json.load(manifest_file)
+
+    def is_valid(self, filename: str) -> bool:
+        """
+        Checks if the cache holds an up-to-date copy of the file, from the size and modification time
+        of the file and, with verify=True, its hash.
+        """
+        manifest = self._load_manifest(self._entry_dir(filename))
+        if manifest is None or manifest["signature"] != list(file_signature(filename)):
+            return False
+        # Entries created without verify have no hash, so they are converted again
+        return not self.verify or manifest.get("hash") == file_hash(filename)
+
+    def _write_columns(self, filename: str, entry_dir: str) -> Dict:
+        """Parses the .lhe file and writes its columns to entry_dir. Returns the counts of the manifest."""
+        # The columns are written batch by batch, so the file never needs to fit in memory
+        column_files = {
+            column: open(os.path.join(entry_dir, f"{column}.bin"), "wb") for column in _COLUMN_DTYPES
+        }
+        n_events, n_particles = 0, 0
+        weight_ids = None
+        try:
+            column_files["offsets"].write(np.zeros(1, dtype=_COLUMN_DTYPES["offsets"]).tobytes())
+            for batch in read_lhe_batches(filename, batch_size=self.batch_size):
+                for column in PARTICLE_COLUMNS:
+                    column_files[column].write(batch[column].astype(_COLUMN_DTYPES[column]).tobytes())
+                offsets = batch.offsets[1:] + n_particles
+                column_files["offsets"].write(offsets.astype(_COLUMN_DTYPES["offsets"]).tobytes())
+                column_files["weights"].write(batch.weights.astype(_COLUMN_DTYPES["weights"]).tobytes())
+                if weight_ids is None:
+                    weight_ids = list(batch.weight_ids)
+                column_files["variation_weights"].write(
+                    batch.weight_columns(weight_ids).astype(_COLUMN_DTYPES["variation_weights"]).tobytes()
+                )
+                n_events += len(batch)
+                n_particles += int(batch.offsets[-1])
+        finally:
+            for column_file in column_files.values():
+                column_file.close()
+        return {"n_events": n_events, "n_particles": n_particles, "weight_ids": weight_ids or []}
+
+    def convert(self, filename: str):
+        """Parses the .lhe file and writes its columns to the cache. A failed conversion leaves no entry."""
+        entry_dir = self._entry_dir(filename)
+        # Identity of the source file before it is read, so a file modified during the conversion is
+        # converted again
+        signature = list(file_signature(filename))
+        source_hash = file_hash(filename) if self.verify else None
+        temporary_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        os.makedirs(temporary_dir, exist_ok=True)
+        try:
+            manifest = {
+                "source": os.path.abspath(filename),
+                "signature": signature,
+                "hash": source_hash,
+                **self._write_columns(filename, temporary_dir),
+            }
+            with open(os.path.join(temporary_dir, self.MANIFEST), "w") as manifest_file:
+                json.dump(manifest, manifest_file, indent=4)
+            # Replaces the previous entry
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(temporary_dir, entry_dir)
+        except BaseException:
+            # Removes the partial entry of a failed conversion
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+            raise
+        self.evict(keep=entry_dir)
+
+    def _load_columns(self, entry_dir: str, manifest: Dict) -> Dict[str, np.ndarray]:
+        """Memory-maps the columns of the cache entry."""
+        lengths = {
+            **{column: manifest["n_particles"] for column in PARTICLE_COLUMNS},
+            "offsets": manifest["n_events"] + 1,
+            "weights": manifest["n_events"],
+            "variation_weights": manifest["n_events"] * len(manifest.get("weight_ids", [])),
+        }
+        columns = {}
+        for column, dtype in _COLUMN_DTYPES.items():
+            if lengths[column] == 0:
+                # Empty files cannot be memory-mapped
+                columns[column] = np.empty(0, dtype=dtype)
+            else:
+                columns[column] = np.memmap(
+                    os.path.join(entry_dir, f"{column}.bin"), dtype=dtype, mode="r", shape=(lengths[column],)
+                )
+        return columns
+
+    def read_batches(self, filename: str) -> Iterator[EventBatch]:
+        """Yields the events of the file in EventBatch chunks, converting the file first if needed."""
+        if not self.is_valid(filename):
+            self.convert(filename)
+        entry_dir = self._entry_dir(filename)
+        manifest = self._load_manifest(entry_dir)
+        # Marks the entry as recently used
+        os.utime(os.path.join(entry_dir, self.MANIFEST))
+        columns = self._load_columns(entry_dir, manifest)
+        offsets = columns["offsets"]
+        weight_ids = manifest.get("weight_ids", [])
+        variation_weights = columns["variation_weights"].reshape(manifest["n_events"], len(weight_ids))
+        for first_event in range(0, manifest["n_events"], self.batch_size):
+            last_event = min(first_event + self.batch_size, manifest["n_events"])
+            first_particle, last_particle = int(offsets[first_event]), int(offsets[last_event])
+            # The particle arrays are views of the memory-mapped files
+            yield EventBatch(
+                particles={column: columns[column][first_particle:last_particle] for column in PARTICLE_COLUMNS},
+                offsets=np.asarray(offsets[first_event:last_event + 1]) - first_particle,
+                weights=columns["weights"][first_event:last_event],
+                variation_weights=variation_weights[first_event:last_event],
+                weight_ids=weight_ids,
+            )
+
+    def evict(self, keep: str = None):
+        """Removes the least recently used entries until the cache is smaller than max_bytes."""
+        if self.max_bytes is None or not os.path.isdir(self.cache_dir):
+            return
+        entries = []
+        for entry_name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, entry_name)
+            manifest_path = os.path.join(entry_dir, self.MANIFEST)
+            # Skips entries being written by other processes
+            if not os.path.exists(manifest_path):
+                continue
+            entry_size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+            entries.append((os.path.getmtime(manifest_path), entry_size, entry_dir))
+        total_size = sum(entry_size for _, entry_size, _ in entries)
+        # Oldest entries first
+        for _, entry_size, entry_dir in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if entry_dir == keep:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= entry_size
@@ -0,0 +1,194 @@
+"""
+Byte-offset index of the <event> blocks of an .lhe file, stored in a sidecar file next to it.
+
+The index is built by a single scan for the <event> tags of the memory-mapped file, without parsing
+the events. With it, a range of events [first, last) can be mapped to the byte range read by
+read_lhe (or read_lhe_batches), and a file can be split into chunks with the same number of events.
+Only plain files can be indexed, since compressed files can not be read from an arbitrary offset.
+
+Usage:
+    python -m PyLHE_EventAnalysis.src.EventIndex events.lhe [--stride N]
+"""
+
+from typing import Callable, List, Optional, Tuple
+from PyLHE_EventAnalysis.src.FileIO import detect_compression
+from PyLHE_EventAnalysis.src.LHEReader import read_lhe
+from PyLHE_EventAnalysis.src.Utilities import file_signature
+import numpy as np
+import argparse
+import mmap
+import os
+import re
+import sys
+
+EVENT_INDEX_VERSION = 1
+# Opening <event> tags, with the same delimiters as the readers of LHEReader
+_EVENT_TAG = re.compile(rb"<event[> \t\n\r]")
+
+
+def event_index_path(filename: str) -> str:
+    """Path of the sidecar file storing the index of the file."""
+    return f"{filename}.index.npz"
+
+
+def _scan_offsets(mapped_file) -> np.ndarray:
+    """Byte offsets of the <event> tags of every event."""
+    offsets = np.fromiter((match.start() for match in _EVENT_TAG.finditer(mapped_file)), dtype=np.int64)
+    # The readers skip a last event without a closing tag
+    if len(offsets) and mapped_file.find(b"</event>", int(offsets[-1])) == -1:
+        offsets = offsets[:-1]
+    return offsets
+
+
+class EventIndex:
+    """
+    Byte offsets of every stride-th event of a file. The offset of the other events is found by
+    scanning at most stride - 1 tags from the previous indexed event, so a larger stride gives a
+    smaller sidecar file at the cost of slower random access. The split of the file only uses the
+    indexed events, so the chunks are balanced up to stride events.
+    """
+
+    def __init__(self, filename: str, offsets: np.ndarray, n_events: int, stride: int = 1, signature: Tuple = None):
+        """
+        :param filename: Path to the .lhe file.
+        :param offsets: Byte offsets of the events 0, stride, 2 * stride, ...
+        :param n_events: Number of events in the file.
+        :param stride: Number of events between two indexed events.
+        :param signature: Size and modification time of the indexed file (see Utilities.file_signature).
+        """
+        self.filename = filename
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.n_events = n_events
+        self.stride = stride
+        self.signature = tuple(signature) if signature is not None else file_signature(filename)
+
+    @classmethod
+    def build(cls, filename: str, stride: int = 1) -> "EventIndex":
+        """Scans the file for the <event> tags."""
+        if detect_compression(filename) is not None:
+            raise ValueError(f"The compressed file {filename} can not be indexed.")
+        signature = file_signature(filename)
+        with open(filename, "rb") as lhe_file:
+            # Empty files can not be mapped
+            if os.fstat(lhe_file.fileno()).st_size == 0:
+                return cls(filename, np.zeros(0, dtype=np.int64), 0, stride, signature)
+            with mmap.mmap(lhe_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                offsets = _scan_offsets(mapped_file)
+        return cls(filename, offsets[::stride], len(offsets), stride, signature)
+
+    def save(self, path: str = None) -> str:
+        """Writes the index to the sidecar file (or to path), atomically. Returns the path."""
+        path = path or event_index_path(self.filename)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as index_file:
+            np.savez(
+                index_file, version=EVENT_INDEX_VERSION, offsets=self.offsets, n_events=self.n_events,
+                stride=self.stride, signature=np.array(self.signature, dtype=np.int64)
+            )
+        os.replace(temporary_path, path)
+        return path
+
+    @classmethod
+    def load(cls, filename: str, path: str = None) -> Optional["EventIndex"]:
+        """Reads the index of the file, or returns None if there is none or the file changed since it was built."""
+        path = path or event_index_path(filename)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as index_file:
+            if int(index_file["version"]) != EVENT_INDEX_VERSION:
+                return None
+            signature = tuple(int(value) for value in index_file["signature"])
+            if signature != file_signature(filename):
+                return None
+            return cls(filename, index_file["offsets"], int(index_file["n_events"]), int(index_file["stride"]), signature)
+
+    @classmethod
+    def open(cls, filename: str, stride: int = 1, save: bool = True) -> "EventIndex":
+        """Reads the index of the file, building it (and writing the sidecar file if save is True) if needed."""
+        index = cls.load(filename)
+        if index is None:
+            index = cls.build(filename, stride)
+            if save:
+                index.save()
+        return index
+
+    def __len__(self) -> int:
+        return self.n_events
+
+    def offset(self, event: int) -> int:
+        """Byte offset of the <event> tag of the event. The offset of event n_events is the size of the file."""
+        if not 0 <= event <= self.n_events:
+            raise IndexError(f"Event {event} is out of range for the {self.n_events} events of {self.filename}.")
+        if event == self.n_events:
+            return self.signature[0]
+        position = int(self.offsets[event // self.stride])
+        n_skipped = event % self.stride
+        if n_skipped == 0:
+            return position
+        with open(self.filename, "rb") as lhe_file:
+            with mmap.mmap(lhe_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                for _ in range(n_skipped):
+                    position = _EVENT_TAG.search(mapped_file, position + 1).start()
+        return position
+
+    def byte_range(self, first: int, last: int = None) -> Tuple[int, Optional[int]]:
+        """Byte range [start, end) holding the events [first, last), as taken by read_lhe."""
+        last = self.n_events if last is None else min(last, self.n_events)
+        if last <= first:
+            # Empty range
+            start = self.offset(min(first, self.n_events))
+            return start, start
+        return self.offset(first), None if last == self.n_events else self.offset(last)
+
+    def split(self, n_chunks: int) -> List[Tuple[int, Optional[int]]]:
+        """
+        Splits the file into n_chunks byte ranges holding the same number of events (up to stride).
+        The ranges can be given to read_lhe like those of LHEReader.split_file.
+        """
+        n_indexed = len(self.offsets)
+        if n_indexed == 0:
+            return [(0, None)]
+        boundaries = [
+            int(self.offsets[n_indexed * chunk // n_chunks]) if n_indexed * chunk // n_chunks < n_indexed else None
+            for chunk in range(n_chunks + 1)
+        ]
+        boundaries[0], boundaries[-1] = 0, None
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+class EventRangeReader:
+    """
+    File reader of the EventLoop reading only the events [first, last) of the file, located with
+    its EventIndex (which is built and saved if the file has no up-to-date sidecar file).
+    """
+
+    def __init__(self, first: int = 0, last: int = None, file_reader: Callable = read_lhe, stride: int = 1):
+        """
+        :param first: Index of the first event read.
+        :param last: Index after the last event read. If None, reads until the end of the file.
+        :param file_reader: Reader accepting the start and end byte offsets (e.g. read_lhe_batches).
+        :param stride: Stride of the index, if it must be built.
+        """
+        self.first = first
+        self.last = last
+        self._file_reader = file_reader
+        self.stride = stride
+
+    def __call__(self, filename: str):
+        start, end = EventIndex.open(filename, self.stride).byte_range(self.first, self.last)
+        return self._file_reader(filename, start=start, end=end)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("filenames", nargs="+", help="The .lhe files to index")
+    parser.add_argument("--stride", type=int, default=1, help="Number of events between two indexed events")
+    args = parser.parse_args(argv)
+    for filename in args.filenames:
+        index = EventIndex.build(filename, args.stride)
+        print(f"{index.n_events} events of {filename} indexed in {index.save()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,140 @@
+"""
+Opening of .lhe files, transparently handling gzip, xz and zstd compression.
+Compressed files can be decompressed in a background thread, so decompression overlaps with the analysis.
+"""
+
+from typing import Optional
+import gzip
+import io
+import lzma
+import queue
+import threading
+
+# Magic bytes at the start of the compressed files
+_MAGIC_BYTES = {
+    "gzip": b"\x1f\x8b",
+    "xz": b"\xfd7zXZ\x00",
+    "zstd": b"\x28\xb5\x2f\xfd",
+}
+
+
+def detect_compression(filename: str) -> Optional[str]:
+    """Returns 'gzip', 'xz' or 'zstd' for compressed files, and None for plain files."""
+    with open(filename, "rb") as data_file:
+        start = data_file.read(6)
+    for compression, magic_bytes in _MAGIC_BYTES.items():
+        if start.startswith(magic_bytes):
+            return compression
+    return None
+
+
+def _open_decompressor(filename: str, compression: str):
+    """Opens a binary stream with the decompressed content of the file."""
+    if compression == "gzip":
+        return gzip.open(filename, "rb")
+    if compression == "xz":
+        return lzma.open(filename, "rb")
+    # zstd support is optional
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(f"Reading the zstd compressed file {filename} requires the zstandard package.")
+    return zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True)
+
+
+class BackgroundReader(io.RawIOBase):
+    """
+    Binary stream that reads blocks from another stream in a background thread.
+    At most queue_size blocks are kept in memory. Exceptions raised while reading are
+    raised again by read, and closing the stream stops the thread.
+    """
+
+    def __init__(self, stream, block_size: int = 1 << 22, queue_size: int = 4):
+        """
+        :param stream: The stream to read from, e.g. a decompressing stream.
+        :param block_size: Number of bytes read from the stream at a time.
+        :param queue_size: Maximum number of blocks read ahead.
+        """
+        super().__init__()
+        self._stream = stream
+        self._block_size = block_size
+        self._blocks = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        # Part of the last block not returned by read yet
+        self._pending = b""
+        self._end_of_stream = False
+        self._thread = threading.Thread(target=self._read_blocks, daemon=True)
+        self._thread.start()
+
+    def _read_blocks(self):
+        """Runs in the background thread. An empty block marks the end of the stream."""
+        try:
+            while not self._stop.is_set():
+                block = self._stream.read(self._block_size)
+                self._put(block)
+                if not block:
+                    return
+        except Exception as exception:
+            self._put(exception)
+
+    def _put(self, item):
+        """Puts the item in the queue, giving up if the reader was closed."""
+        while not self._stop.is_set():
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        """Returns the next available bytes (at most size, if size is positive), or b'' at the end of the stream."""
+        if not self._pending and not self._end_of_stream:
+            block = self._blocks.get()
+            if isinstance(block, Exception):
+                self._end_of_stream = True
+                raise block
+            self._end_of_stream = not block
+            self._pending = block
+        if size is None or size < 0:
+            size = len(self._pending)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            # Unblocks the thread if it is waiting for space in the queue
+            while self._thread.is_alive():
+                try:
+                    self._blocks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._stream.close()
+        super().close()
+
+
+def open_lhe(filename: str, background: bool = True):
+    """
+    Opens the (possibly compressed) .lhe file as a binary stream.
+
+    :param filename: Path to the file.
+    :param background: If True, compressed files are decompressed in a background thread.
+    """
+    compression = detect_compression(filename)
+    if compression is None:
+        return open(filename, "rb")
+    stream = _open_decompressor(filename, compression)
+    return BackgroundReader(stream) if background else stream
+
+
+def open_lhe_text(filename: str):
+    """Opens the (possibly compressed) .lhe file as a text stream, e.g. to read its header."""
+    return io.TextIOWrapper(open_lhe(filename, background=False))
@@ -0,0 +1,324 @@
+"""
+Fused evaluation of declarative analyses: the momentum sums, the cuts of all the analyses and the
+histogram filling run in a single loop over the particles of each EventBatch, without the
+intermediate arrays of the Kinematics observables.
+
+The analyses are supported if their cuts are Kinematics.Cut objects and their histograms are
+ObservableHistogram objects (or a HistogramCompound of them) whose observables are built from
+MomentumSum, InvariantMass, TransverseMomentum, PseudoRapidity, Rapidity and Ratio.
+
+The loop is compiled with numba if it is installed. Otherwise, the same program is evaluated with
+NumPy on whole batches, which gives the same results with the allocations of the reference path.
+numba is only imported when the first FusedAnalysis is built, so importing this module stays cheap.
+"""
+
+from typing import Callable, Dict, List
+from PyLHE_EventAnalysis.src.CutFlow import CutFlowEngine
+from PyLHE_EventAnalysis.src.EventBatch import EventBatch
+from PyLHE_EventAnalysis.src.Histogram import Histogram, HistogramCompound, ObservableHistogram
+from PyLHE_EventAnalysis.src.Kinematics import (
+    Cut, InvariantMass, KinematicObservable, MomentumSum, PseudoRapidity, Rapidity, Ratio, TransverseMomentum,
+    invariant_mass, pseudo_rapidity, rapidity, total_momentum, transverse_momentum
+)
+import numpy as np
+import importlib.util
+
+# Whether numba is installed, checked without importing it
+_HAS_NUMBA = importlib.util.find_spec("numba") is not None
+
+# Operations of the observable nodes. The argument of the momentum functions is a momentum slot,
+# and the arguments of the ratio are two nodes
+_MASS, _PT, _ETA, _RAPIDITY, _RATIO = range(5)
+_MOMENTUM_OPERATIONS = {InvariantMass: _MASS, TransverseMomentum: _PT, PseudoRapidity: _ETA, Rapidity: _RAPIDITY}
+_MOMENTUM_FUNCTIONS = {_MASS: invariant_mass, _PT: transverse_momentum, _ETA: pseudo_rapidity, _RAPIDITY: rapidity}
+# PIDs in [-_PID_TABLE_RANGE, _PID_TABLE_RANGE) find their momentum sums in a lookup table
+_PID_TABLE_RANGE = 128
+# The momentum sums of a particle are stored as the bits of an int64
+_MAX_SLOTS = 63
+
+
+def _fused_loop(ids, statuses, energies, pxs, pys, pzs, offsets,
+                pid_table, slot_pid_offsets, slot_pids, slot_status, slot_flags,
+                node_operations, node_arguments, cut_nodes, cut_limits, cut_flags,
+                analysis_cut_offsets, analysis_cuts, analysis_fill_offsets,
+                fill_nodes, fill_edge_offsets, edges, fill_count_offsets,
+                rejected, n_evaluated, n_passed, counts):
+    """
+    Runs the program on the events delimited by offsets, adding to the rejected, n_evaluated,
+    n_passed and counts arrays. Compiled with numba when it is available.
+    """
+    n_slots = len(slot_status)
+    momenta = np.zeros((n_slots, 4))
+    values = np.zeros(len(node_operations))
+    cut_results = np.zeros(len(cut_nodes), dtype=np.int8)
+    for event in range(len(offsets) - 1):
+        # Momentum sums, adding the particles in the order they appear in the event
+        momenta[:] = 0.0
+        for particle in range(offsets[event], offsets[event + 1]):
+            pid = ids[particle]
+            # Bit mask of the momentum sums including the PID
+            if -_PID_TABLE_RANGE <= pid < _PID_TABLE_RANGE:
+                slots = pid_table[pid + _PID_TABLE_RANGE]
+            else:
+                slots = 0
+                for slot in range(n_slots):
+                    slot_pid = abs(pid) if slot_flags[slot, 1] else pid
+                    for pid_index in range(slot_pid_offsets[slot], slot_pid_offsets[slot + 1]):
+                        if slot_pids[pid_index] == slot_pid:
+                            slots |= 1 << slot
+                            break
+            slot = 0
+            while slots:
+                if slots & 1 and not (slot_flags[slot, 0] and statuses[particle] != slot_status[slot]):
+                    momenta[slot, 0] += energies[particle]
+                    momenta[slot, 1] += pxs[particle]
+                    momenta[slot, 2] += pys[particle]
+                    momenta[slot, 3] += pzs[particle]
+                slots >>= 1
+                slot += 1
+        # Observables, in the order they depend on each other
+        for node in range(len(node_operations)):
+            operation = node_operations[node]
+            argument = node_arguments[node, 0]
+            if operation == _RATIO:
+                values[node] = values[argument] / values[node_arguments[node, 1]]
+                continue
+            energy, px, py, pz = momenta[argument, 0], momenta[argument, 1], momenta[argument, 2], momenta[argument, 3]
+            if operation == _MASS:
+                values[node] = np.sqrt(energy ** 2 - px ** 2 - py ** 2 - pz ** 2)
+            elif operation == _PT:
+                values[node] = np.sqrt(px ** 2 + py ** 2)
+            elif operation == _ETA:
+                values[node] = np.arcsinh(pz / np.sqrt(px ** 2 + py ** 2))
+            else:
+                values[node] = 0.5 * np.log((energy + pz) / (energy - pz))
+        # Cuts of each analysis in the declared order, each distinct cut evaluated at most once
+        cut_results[:] = -1
+        for analysis in range(len(analysis_cut_offsets) - 1):
+            selected = True
+            for position in range(analysis_cut_offsets[analysis], analysis_cut_offsets[analysis + 1]):
+                cut = analysis_cuts[position]
+                if cut_results[cut] < 0:
+                    value = values[cut_nodes[cut]]
+                    if cut_flags[cut, 2]:
+                        value = abs(value)
+                    passed = not (cut_flags[cut, 0] and not value > cut_limits[cut, 0])
+                    passed = passed and not (cut_flags[cut, 1] and not value < cut_limits[cut, 1])
+                    cut_results[cut] = 1 if passed else 0
+                    n_evaluated[cut] += 1
+                    n_passed[cut] += cut_results[cut]
+                if cut_results[cut] == 0:
+                    rejected[position] += 1
+                    selected = False
+                    break
+            if not selected:
+                continue
+            # Column 0 of the counts of each histogram is the underflow and the last column the overflow
+            for fill in range(analysis_fill_offsets[analysis], analysis_fill_offsets[analysis + 1]):
+                value = values[fill_nodes[fill]]
+                first, last = fill_edge_offsets[fill], fill_edge_offsets[fill + 1] - 1
+                if value < edges[first]:
+                    column = 0
+                elif not value < edges[last]:
+                    column = last - first + 1
+                else:
+                    # Largest edge lower or equal to the value
+                    low, high = first, last
+                    while high - low > 1:
+                        middle = (low + high) // 2
+                        if edges[middle] <= value:
+                            low = middle
+                        else:
+                            high = middle
+                    column = low - first + 1
+                counts[fill_count_offsets[fill] + column] += 1.0
+
+
+_compiled_loop = None
+
+
+def _compile_loop() -> Callable:
+    """_fused_loop compiled with numba, imported on the first call."""
+    global _compiled_loop
+    if _compiled_loop is None:
+        import numba
+        _compiled_loop = numba.njit(cache=True, nogil=True, error_model="numpy")(_fused_loop)
+    return _compiled_loop
+
+
+class FusedAnalysis:
+    """
+    Runs the cuts and fills the histograms of all the analyses of an EventLoop on EventBatch chunks.
+    The cut-flow is recorded in the CutFlowEngine, with the cuts evaluated in the declared order.
+    Unsupported cuts or observables raise a TypeError when the FusedAnalysis is built.
+    """
+
+    def __init__(self, cutflow_engine: CutFlowEngine, analyses_hist: Dict[str, Histogram], backend: str = None):
+        """
+        :param cutflow_engine: The CutFlowEngine of the analyses, recording the cut-flow.
+        :param analyses_hist: The histograms booked for each analysis.
+        :param backend: "numba" or "numpy". Defaults to numba if it is installed.
+        """
+        if backend is None:
+            backend = "numba" if _HAS_NUMBA else "numpy"
+        if backend == "numba" and not _HAS_NUMBA:
+            raise ImportError("The numba backend of FusedAnalysis requires numba.")
+        self.backend = backend
+        self._compiled_loop = _compile_loop() if backend == "numba" else None
+        self._cutflow_engine = cutflow_engine
+        self._slots = []
+        self._nodes = []
+        # Cuts, in the order of cutflow_engine.cuts
+        self._cuts = [self._compile_cut(cut) for cut in cutflow_engine.cuts]
+        self._analysis_names = list(cutflow_engine.analysis_cuts)
+        analysis_cuts = [cutflow_engine.analysis_cuts[name] for name in self._analysis_names]
+        # Histograms filled by each analysis, with the node of their observable
+        self._fills = []
+        analysis_fill_offsets = [0]
+        for analysis_name in self._analysis_names:
+            for hist in self._observable_histograms(analyses_hist[analysis_name]):
+                self._fills.append((hist, self._compile_node(hist.observable)))
+            analysis_fill_offsets.append(len(self._fills))
+        self._program = self._build_program(analysis_cuts, analysis_fill_offsets)
+
+    @staticmethod
+    def _observable_histograms(hist: Histogram) -> List[ObservableHistogram]:
+        if isinstance(hist, HistogramCompound):
+            return [
+                observable_hist for child in hist.histograms.values()
+                for observable_hist in FusedAnalysis._observable_histograms(child)
+            ]
+        if type(hist) is not ObservableHistogram:
+            raise TypeError(f"FusedAnalysis does not support {type(hist).__name__} histograms.")
+        return [hist]
+
+    def _compile_slot(self, momentum: KinematicObservable) -> int:
+        """Index of the momentum sum."""
+        if not isinstance(momentum, MomentumSum):
+            raise TypeError(f"FusedAnalysis does not support the four-momentum {momentum!r}.")
+        if momentum not in self._slots:
+            if len(self._slots) == _MAX_SLOTS:
+                raise TypeError(f"FusedAnalysis supports at most {_MAX_SLOTS} distinct momentum sums.")
+            self._slots.append(momentum)
+        return self._slots.index(momentum)
+
+    def _compile_node(self, observable: Callable) -> int:
+        """Index of the node computing the observable, after the nodes it depends on."""
+        if isinstance(observable, Ratio):
+            arguments = (self._compile_node(observable.numerator), self._compile_node(observable.denominator))
+            node = (_RATIO, arguments)
+        elif type(observable) in _MOMENTUM_OPERATIONS:
+            node = (_MOMENTUM_OPERATIONS[type(observable)], (self._compile_slot(observable.momentum), 0))
+        else:
+            raise TypeError(f"FusedAnalysis does not support the observable {observable!r}.")
+        if node not in self._nodes:
+            self._nodes.append(node)
+        return self._nodes.index(node)
+
+    def _compile_cut(self, cut: Callable):
+        if not isinstance(cut, Cut):
+            raise TypeError(f"FusedAnalysis does not support the cut {cut!r}.")
+        return self._compile_node(cut.observable), cut
+
+    def _build_program(self, analysis_cuts: List[List[int]], analysis_fill_offsets: List[int]) -> Dict[str, np.ndarray]:
+        """Arrays describing the momentum sums, observables, cuts and histograms, as taken by _fused_loop."""
+        edges = [np.asarray(hist.bin_edges, dtype=np.float64) for hist, _ in self._fills]
+        n_columns = [len(hist_edges) + 1 for hist_edges in edges]
+        pid_table = np.zeros(2 * _PID_TABLE_RANGE, dtype=np.int64)
+        for slot_index, slot in enumerate(self._slots):
+            for pid in slot.pids:
+                for signed_pid in ((pid, -pid) if slot.absolute else (pid,)):
+                    if -_PID_TABLE_RANGE <= signed_pid < _PID_TABLE_RANGE:
+                        pid_table[signed_pid + _PID_TABLE_RANGE] |= 1 << slot_index
+        return {
+            "pid_table": pid_table,
+            "slot_pid_offsets": np.cumsum([0] + [len(slot.pids) for slot in self._slots]).astype(np.int64),
+            "slot_pids": np.array([pid for slot in self._slots for pid in slot.pids], dtype=np.int64),
+            "slot_status": np.array([slot.status or 0 for slot in self._slots], dtype=np.int64),
+            "slot_flags": np.array(
+                [(slot.status is not None, slot.absolute) for slot in self._slots], dtype=np.bool_
+            ).reshape(-1, 2),
+            "node_operations": np.array([operation for operation, _ in self._nodes], dtype=np.int64),
+            "node_arguments": np.array([arguments for _, arguments in self._nodes], dtype=np.int64).reshape(-1, 2),
+            "cut_nodes": np.array([node for node, _ in self._cuts], dtype=np.int64),
+            "cut_limits": np.array(
+                [(cut.minimum or 0.0, cut.maximum or 0.0) for _, cut in self._cuts], dtype=np.float64
+            ).reshape(-1, 2),
+            "cut_flags": np.array(
+                [(cut.minimum is not None, cut.maximum is not None, cut.absolute) for _, cut in self._cuts], dtype=np.bool_
+            ).reshape(-1, 3),
+            "analysis_cut_offsets": np.cumsum([0] + [len(cuts) for cuts in analysis_cuts]).astype(np.int64),
+            "analysis_cuts": np.array([cut for cuts in analysis_cuts for cut in cuts], dtype=np.int64),
+            "analysis_fill_offsets": np.array(analysis_fill_offsets, dtype=np.int64),
+            "fill_nodes": np.array([node for _, node in self._fills], dtype=np.int64),
+            "fill_edge_offsets": np.cumsum([0] + [len(hist_edges) for hist_edges in edges]).astype(np.int64),
+            "edges": np.concatenate(edges) if edges else np.zeros(0),
+            "fill_count_offsets": np.cumsum([0] + n_columns).astype(np.int64),
+        }
+
+    def _run_numpy(self, batch: EventBatch, rejected: np.ndarray, n_evaluated: np.ndarray, n_passed: np.ndarray,
+                   counts: np.ndarray):
+        """The program of _fused_loop evaluated on the whole batch with NumPy."""
+        program = self._program
+        momenta = [total_momentum(batch, list(slot.pids), status=slot.status, absolute=slot.absolute) for slot in self._slots]
+        values = []
+        for operation, (argument, other_argument) in self._nodes:
+            if operation == _RATIO:
+                values.append(values[argument] / values[other_argument])
+            else:
+                values.append(_MOMENTUM_FUNCTIONS[operation](momenta[argument]))
+        cut_passed = [cut.apply(values[node]) for node, cut in self._cuts]
+        # Events on which each cut is evaluated: those where an analysis reaches it
+        reached = np.zeros((len(self._cuts), len(batch)), dtype=bool)
+        for analysis in range(len(self._analysis_names)):
+            selected = np.ones(len(batch), dtype=bool)
+            for position in range(program["analysis_cut_offsets"][analysis], program["analysis_cut_offsets"][analysis + 1]):
+                cut = program["analysis_cuts"][position]
+                reached[cut] |= selected
+                rejected[position] += np.count_nonzero(selected & ~cut_passed[cut])
+                selected &= cut_passed[cut]
+            for fill in range(program["analysis_fill_offsets"][analysis], program["analysis_fill_offsets"][analysis + 1]):
+                hist, node = self._fills[fill]
+                bin_indices = hist.find_bin_indices(values[node][selected])
+                # Column 0 is the underflow and the last column the overflow
+                n_columns = len(hist.bin_edges) + 1
+                columns = np.where(bin_indices >= 0, bin_indices + 1, np.where(bin_indices == hist.UNDERFLOW, 0, n_columns - 1))
+                start = program["fill_count_offsets"][fill]
+                counts[start:start + n_columns] += np.bincount(columns, minlength=n_columns)
+        for cut in range(len(self._cuts)):
+            n_evaluated[cut] += np.count_nonzero(reached[cut])
+            n_passed[cut] += np.count_nonzero(reached[cut] & cut_passed[cut])
+
+    def process(self, batch: EventBatch):
+        """Runs the analyses on the batch, filling their histograms and recording their cut-flow."""
+        program = self._program
+        rejected = np.zeros(len(program["analysis_cuts"]), dtype=np.int64)
+        n_evaluated = np.zeros(len(self._cuts), dtype=np.int64)
+        n_passed = np.zeros(len(self._cuts), dtype=np.int64)
+        counts = np.zeros(program["fill_count_offsets"][-1])
+        if self.backend == "numba":
+            self._compiled_loop(
+                batch["id"], batch["status"], batch["e"], batch["px"], batch["py"], batch["pz"], batch.offsets,
+                program["pid_table"], program["slot_pid_offsets"], program["slot_pids"], program["slot_status"], program["slot_flags"],
+                program["node_operations"], program["node_arguments"], program["cut_nodes"], program["cut_limits"],
+                program["cut_flags"], program["analysis_cut_offsets"], program["analysis_cuts"],
+                program["analysis_fill_offsets"], program["fill_nodes"], program["fill_edge_offsets"], program["edges"],
+                program["fill_count_offsets"], rejected, n_evaluated, n_passed, counts,
+            )
+        else:
+            self._run_numpy(batch, rejected, n_evaluated, n_passed, counts)
+        # Adds the counts to the histograms and to the cut-flow
+        for fill, (hist, _) in enumerate(self._fills):
+            hist_counts = counts[program["fill_count_offsets"][fill]:program["fill_count_offsets"][fill + 1]]
+            hist += hist_counts[1:-1]
+            hist.underflow += hist_counts[0]
+            hist.overflow += hist_counts[-1]
+        cut_offsets = program["analysis_cut_offsets"]
+        self._cutflow_engine.record_counts(
+            n_events=len(batch),
+            rejected={
+                analysis_name: rejected[cut_offsets[analysis]:cut_offsets[analysis + 1]].tolist()
+                for analysis, analysis_name in enumerate(self._analysis_names)
+            },
+            n_evaluated=n_evaluated.tolist(), n_passed=n_passed.tolist(),
+        )
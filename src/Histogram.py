@@ -2,7 +2,9 @@
 
 from abc import ABC, abstractmethod
 import numpy as np
+import bisect
 from typing import List, Callable, Dict
+from PyLHE_EventAnalysis.src.EventBatch import EventBatch, evaluate_on_batch
 import copy
 
 
@@ -14,23 +16,118 @@ class Histogram(ABC):
         """Updates the histogram with a given event."""
         raise RuntimeError("Trying to use a method from an abstract class.")
 
+    def update_hist_batch(self, batch: EventBatch, mask: np.ndarray = None):
+        """
+        Updates the histogram with the events of the batch selected by the boolean mask.
+        By default, it calls update_hist for each selected event.
+        """
+        events = batch.events()
+        indices = range(len(batch)) if mask is None else np.flatnonzero(mask)
+        for index in indices:
+            self.update_hist(event=events[index])
+
     @abstractmethod
     def __copy__(self):
         """Clones an empty histogram."""
         pass
 
+    @abstractmethod
+    def merge_hist(self, hist):
+        """Adds the content of another histogram with the same binning to this histogram."""
+        pass
+
+    def scale(self, factor: float):
+        """Multiplies the booked content by factor, e.g. to normalise it to the cross-section."""
+        raise NotImplementedError(f"{type(self).__name__} does not implement scale.")
+
+    def state_dict(self) -> Dict[str, np.ndarray]:
+        """Booked content of the histogram as named arrays, e.g. to save it in a checkpoint."""
+        raise NotImplementedError(f"{type(self).__name__} does not implement state_dict.")
+
+    def load_state_dict(self, state: Dict[str, np.ndarray]):
+        """Restores the booked content saved by state_dict."""
+        raise NotImplementedError(f"{type(self).__name__} does not implement load_state_dict.")
+
+    def config(self) -> Dict:
+        """Description of the histogram configuration (type, binning and observables), used to fingerprint an analysis."""
+        return {"type": type(self).__name__}
+
+
+def callable_name(function: Callable) -> str:
+    """Stable name of an observable or cut: the qualified name of functions, and the repr of other objects."""
+    qualified_name = getattr(function, "__qualname__", None)
+    if qualified_name is not None and "<lambda>" not in qualified_name:
+        return f"{function.__module__}.{qualified_name}"
+    return repr(function)
+
 
 class BinIndexFinder:
+    """
+    Finds the bin of an observable value.
+    Bins are half-open intervals [bin_edges[i], bin_edges[i + 1]). Values below the first edge
+    get the index UNDERFLOW and values at or above the last edge (or NaN) get the index OVERFLOW.
+    """
+
+    UNDERFLOW = -1
+    OVERFLOW = -2
+
     def __init__(self, bin_edges):
         self.bin_edges = bin_edges
 
+    @property
+    def bin_edges(self):
+        return self._bin_edges
+
+    @bin_edges.setter
+    def bin_edges(self, bin_edges):
+        self._bin_edges = bin_edges
+        # The lookup tables are built on the first search
+        self._bin_lookup = None
+
+    def _get_bin_lookup(self):
+        """
+        Returns the sorted edges as a list and as an array, together with the width and the number of
+        equally spaced bins when the binning is uniform (possibly except for a last overflow bin).
+        """
+        if self._bin_lookup is None:
+            edges_array = np.asarray(self._bin_edges, dtype=np.float64)
+            edges_list = edges_array.tolist()
+            widths = np.diff(edges_array)
+            uniform_width, n_uniform = None, 0
+            # Uniform binning, or uniform binning followed by a single wide bin as in range(0, 16400, 400) + [1e12]
+            for n_bins in (len(widths), len(widths) - 1):
+                if n_bins > 0 and widths[0] > 0 and np.allclose(widths[:n_bins], widths[0], rtol=1e-9, atol=0):
+                    uniform_width, n_uniform = float(widths[0]), n_bins
+                    break
+            self._bin_lookup = (edges_list, edges_array, uniform_width, n_uniform)
+        return self._bin_lookup
+
     def find_bin_index(self, observable_value: float) -> int:
         """Finds the respective bin index for the given value of the observable."""
-        # Look for the right bin number
-        for bin_index in range(len(self.bin_edges) - 1):
-            if self.bin_edges[bin_index] <= observable_value < self.bin_edges[bin_index + 1]:
-                return bin_index
-        return -1
+        edges, _, uniform_width, n_uniform = self._get_bin_lookup()
+        if observable_value < edges[0]:
+            return self.UNDERFLOW
+        if not observable_value < edges[-1]:
+            return self.OVERFLOW
+        # Direct computation of the bin for uniform binnings
+        if uniform_width is not None and observable_value < edges[n_uniform]:
+            bin_index = min(int((observable_value - edges[0]) / uniform_width), n_uniform - 1)
+            # Corrects rounding errors in the division
+            if observable_value < edges[bin_index]:
+                bin_index -= 1
+            elif observable_value >= edges[bin_index + 1]:
+                bin_index += 1
+            return bin_index
+        # Binary search
+        return bisect.bisect_right(edges, observable_value) - 1
+
+    def find_bin_indices(self, observable_values: np.ndarray) -> np.ndarray:
+        """Finds the bin index for each value in the array, with the same conventions as find_bin_index."""
+        _, edges, _, _ = self._get_bin_lookup()
+        bin_indices = np.searchsorted(edges, observable_values, side="right") - 1
+        # NaN values are sorted after the last edge, so they also end up in the overflow
+        bin_indices[bin_indices >= len(edges) - 1] = self.OVERFLOW
+        return bin_indices
 
 
 class ObservableHistogram(Histogram, np.ndarray, BinIndexFinder):
@@ -57,6 +154,9 @@ class ObservableHistogram(Histogram, np.ndarray, BinIndexFinder):
         # Store the bin_edges and observable as attributes
         hist.bin_edges = bin_edges
         hist.observable = observable
+        # Sum of the entries outside the histogram limits
+        hist.underflow = 0.0
+        hist.overflow = 0.0
         # Return the histogram
         return hist
 
@@ -69,6 +169,8 @@ class ObservableHistogram(Histogram, np.ndarray, BinIndexFinder):
         # Add the attributes
         self.observable = getattr(hist, "observable", None)
         self.bin_edges = getattr(hist, "bin_edges", None)
+        self.underflow = getattr(hist, "underflow", 0.0)
+        self.overflow = getattr(hist, "overflow", 0.0)
 
     def update_hist(self, event):
         """Updates the histogram using the Event object."""
@@ -76,14 +178,81 @@ class ObservableHistogram(Histogram, np.ndarray, BinIndexFinder):
         obs_value = self.observable(event)
         # Find the bin index
         bin_index = self.find_bin_index(observable_value=obs_value)
-        # Update the histogram if the observable is inside the histogram limits
-        if 0 <= bin_index < len(self):
+        # Update the histogram, or the underflow and overflow counters
+        if bin_index >= 0:
             self[bin_index] += 1
+        elif bin_index == self.UNDERFLOW:
+            self.underflow += 1
+        else:
+            self.overflow += 1
+
+    def update_hist_batch(self, batch: EventBatch, mask: np.ndarray = None):
+        """Updates the histogram using the selected events of the EventBatch."""
+        # Calculate the observable for all the selected events
+        self.fill_many(evaluate_on_batch(self.observable, batch, mask))
+
+    def fill_many(self, values: np.ndarray, weights: np.ndarray = None):
+        """
+        Fills the histogram with an array of observable values.
+
+        :param values: The values of the observable.
+        :param weights: The weight of each entry. If None, each entry counts as 1.
+        """
+        bin_indices = self.find_bin_indices(np.asarray(values, dtype=np.float64))
+        inside = bin_indices >= 0
+        if weights is None:
+            # Update all the bins at once
+            self += np.bincount(bin_indices[inside], minlength=len(self))
+            self.underflow += np.count_nonzero(bin_indices == self.UNDERFLOW)
+            self.overflow += np.count_nonzero(bin_indices == self.OVERFLOW)
+        else:
+            weights = np.asarray(weights, dtype=np.float64)
+            # np.add.at accumulates the weights in the order they are given
+            np.add.at(self.view(np.ndarray), bin_indices[inside], weights[inside])
+            self.underflow += weights[bin_indices == self.UNDERFLOW].sum()
+            self.overflow += weights[bin_indices == self.OVERFLOW].sum()
 
     def __copy__(self):
         """Shallow copy of the current histogram."""
         return self.__new__(self.__class__, bin_edges=self.bin_edges, observable=self.observable)
 
+    def merge_hist(self, hist):
+        """Adds the bin contents of another histogram."""
+        self += hist
+        self.underflow += hist.underflow
+        self.overflow += hist.overflow
+
+    def scale(self, factor: float):
+        self *= factor
+        self.underflow *= factor
+        self.overflow *= factor
+
+    def state_dict(self) -> Dict[str, np.ndarray]:
+        return {
+            "contents": np.array(self.view(np.ndarray)),
+            "underflow": np.array(self.underflow),
+            "overflow": np.array(self.overflow),
+        }
+
+    def load_state_dict(self, state: Dict[str, np.ndarray]):
+        self[...] = state["contents"]
+        self.underflow = float(state["underflow"])
+        self.overflow = float(state["overflow"])
+
+    def config(self) -> Dict:
+        return {"type": type(self).__name__, "bin_edges": list(map(float, self.bin_edges)),
+                "observable": callable_name(self.observable)}
+
+    def __reduce__(self):
+        """Pickles the attributes together with the array, so histograms can be sent between processes."""
+        reconstruct, arguments, array_state = super().__reduce__()
+        return reconstruct, arguments, (array_state, self.__dict__)
+
+    def __setstate__(self, state):
+        array_state, attributes = state
+        super().__setstate__(array_state)
+        self.__dict__.update(attributes)
+
 
 class CorrelatedHist(Histogram, BinIndexFinder):
     """..."""
@@ -93,33 +262,406 @@ class CorrelatedHist(Histogram, BinIndexFinder):
         self.xobs = xobservable
         self.yobs = yobservable
         self.bin_sum = np.zeros(len(bin_edges) - 1)
+        # Sum of the y values for x outside the histogram limits
+        self.underflow = 0.0
+        self.overflow = 0.0
 
     def update_hist(self, event):
         xobs_value = self.xobs(event)
         yobs_value = self.yobs(event)
         bin_index = self.find_bin_index(xobs_value)
-        if 0 <= bin_index < len(self.bin_sum):
+        if bin_index >= 0:
             self.bin_sum[bin_index] += yobs_value
+        elif bin_index == self.UNDERFLOW:
+            self.underflow += yobs_value
+        else:
+            self.overflow += yobs_value
+
+    def update_hist_batch(self, batch: EventBatch, mask: np.ndarray = None):
+        self.fill_many(evaluate_on_batch(self.xobs, batch, mask), evaluate_on_batch(self.yobs, batch, mask))
+
+    def fill_many(self, xvalues: np.ndarray, yvalues: np.ndarray):
+        """Adds each y value to the bin of the corresponding x value."""
+        bin_indices = self.find_bin_indices(np.asarray(xvalues, dtype=np.float64))
+        yvalues = np.asarray(yvalues, dtype=np.float64)
+        inside = bin_indices >= 0
+        # np.add.at accumulates in event order, as the per-event update does
+        np.add.at(self.bin_sum, bin_indices[inside], yvalues[inside])
+        self.underflow += yvalues[bin_indices == self.UNDERFLOW].sum()
+        self.overflow += yvalues[bin_indices == self.OVERFLOW].sum()
 
     def __copy__(self):
         return self.__class__(xobservable=self.xobs, yobservable=self.yobs, bin_edges=self.bin_edges)
 
     def merge_hist(self, hist):
         self.bin_sum += hist.bin_sum
+        self.underflow += hist.underflow
+        self.overflow += hist.overflow
+
+    def scale(self, factor: float):
+        self.bin_sum *= factor
+        self.underflow *= factor
+        self.overflow *= factor
+
+    def state_dict(self) -> Dict[str, np.ndarray]:
+        return {"bin_sum": self.bin_sum.copy(), "underflow": np.array(self.underflow), "overflow": np.array(self.overflow)}
+
+    def load_state_dict(self, state: Dict[str, np.ndarray]):
+        self.bin_sum[...] = state["bin_sum"]
+        self.underflow = float(state["underflow"])
+        self.overflow = float(state["overflow"])
+
+    def config(self) -> Dict:
+        return {"type": type(self).__name__, "bin_edges": list(map(float, self.bin_edges)),
+                "xobservable": callable_name(self.xobs), "yobservable": callable_name(self.yobs)}
+
+
+class WeightedHistogram(Histogram, BinIndexFinder):
+    """
+    Histogram of the sum of weights and of the sum of squared weights of an observable, filled for
+    several weight variations at once. Row 0 uses the nominal event weight (eventinfo.weight) and
+    row i > 0 the <rwgt> weight with id weight_ids[i - 1], so all the variations are booked in a
+    single pass over the events.
+    """
+
+    def __init__(self, bin_edges: List[float], observable: Callable, weight_ids: List[str] = ()):
+        """
+        :param bin_edges: The respective bin edges for the histogram.
+        :param observable: A function or callable object that computes the observable for a single event.
+        :param weight_ids: Ids of the <rwgt> weights booked after the nominal weight (see LHEMetadata.weight_names).
+        """
+        super().__init__(bin_edges=bin_edges)
+        self.observable = observable
+        self.weight_ids = tuple(weight_ids)
+        # Column 0 is the underflow and the last column the overflow
+        shape = (len(self.weight_ids) + 1, len(bin_edges) + 1)
+        self._sumw = np.zeros(shape)
+        self._sumw2 = np.zeros(shape)
+
+    @property
+    def sumw(self) -> np.ndarray:
+        """Sum of weights in each bin, with shape (n_weights, n_bins)."""
+        return self._sumw[:, 1:-1]
+
+    @property
+    def sumw2(self) -> np.ndarray:
+        """Sum of squared weights in each bin, with shape (n_weights, n_bins)."""
+        return self._sumw2[:, 1:-1]
+
+    @property
+    def underflow(self) -> np.ndarray:
+        """Sum of weights below the first bin edge, for each weight."""
+        return self._sumw[:, 0]
+
+    @property
+    def overflow(self) -> np.ndarray:
+        """Sum of weights at or above the last bin edge, for each weight."""
+        return self._sumw[:, -1]
+
+    def errors(self) -> np.ndarray:
+        """Statistical uncertainty of each bin, sqrt(sumw2)."""
+        return np.sqrt(self.sumw2)
+
+    def _columns(self, bin_indices: np.ndarray) -> np.ndarray:
+        """Maps the bin indices (and the underflow and overflow indices) to the columns of the arrays."""
+        return np.where(bin_indices >= 0, bin_indices + 1, np.where(bin_indices == self.UNDERFLOW, 0, self._sumw.shape[1] - 1))
+
+    def update_hist(self, event):
+        """Updates all the weight variations with a single event."""
+        bin_index = self.find_bin_index(self.observable(event))
+        column = bin_index + 1 if bin_index >= 0 else (0 if bin_index == self.UNDERFLOW else -1)
+        # pylhe events have no weights if the file has no <rwgt> blocks
+        event_weights = getattr(event, "weights", None) or {}
+        missing_ids = [weight_id for weight_id in self.weight_ids if weight_id not in event_weights]
+        if missing_ids:
+            raise ValueError(f"The event has no <rwgt> weights with the ids {missing_ids} booked by the WeightedHistogram.")
+        weights = np.array([event.eventinfo.weight, *(event_weights[weight_id] for weight_id in self.weight_ids)])
+        self._sumw[:, column] += weights
+        self._sumw2[:, column] += weights ** 2
+
+    def update_hist_batch(self, batch: EventBatch, mask: np.ndarray = None):
+        """Updates all the weight variations with the selected events of the batch."""
+        weights = np.column_stack([batch.weights, batch.weight_columns(self.weight_ids)])
+        if mask is not None:
+            weights = weights[mask]
+        self.fill_many(evaluate_on_batch(self.observable, batch, mask), weights.T)
+
+    def fill_many(self, values: np.ndarray, weights: np.ndarray):
+        """
+        Fills the histogram with an array of observable values.
+
+        :param values: The values of the observable, one per event.
+        :param weights: Array with shape (n_weights, len(values)) holding the weights of each event.
+        """
+        columns = self._columns(self.find_bin_indices(np.asarray(values, dtype=np.float64)))
+        weights = np.asarray(weights, dtype=np.float64).reshape(self._sumw.shape[0], len(columns))
+        # A single bincount fills all the weights: the entries of row i go to the indices shifted by i * n_columns
+        n_rows, n_columns = self._sumw.shape
+        flat_indices = (np.arange(n_rows)[:, None] * n_columns + columns).ravel()
+        self._sumw += np.bincount(flat_indices, weights=weights.ravel(), minlength=self._sumw.size).reshape(n_rows, n_columns)
+        self._sumw2 += np.bincount(flat_indices, weights=(weights ** 2).ravel(), minlength=self._sumw.size).reshape(n_rows, n_columns)
+
+    def __copy__(self):
+        return self.__class__(bin_edges=self.bin_edges, observable=self.observable, weight_ids=self.weight_ids)
+
+    def merge_hist(self, hist):
+        self._sumw += hist._sumw
+        self._sumw2 += hist._sumw2
+
+    def scale(self, factor: float):
+        """Scales the sums of weights by factor, and the sums of squared weights by factor squared."""
+        self._sumw *= factor
+        self._sumw2 *= factor ** 2
+
+    def state_dict(self) -> Dict[str, np.ndarray]:
+        return {"sumw": self._sumw.copy(), "sumw2": self._sumw2.copy()}
+
+    def load_state_dict(self, state: Dict[str, np.ndarray]):
+        self._sumw[...] = state["sumw"]
+        self._sumw2[...] = state["sumw2"]
+
+    def config(self) -> Dict:
+        return {"type": type(self).__name__, "bin_edges": list(map(float, self.bin_edges)),
+                "observable": callable_name(self.observable), "weight_ids": list(self.weight_ids)}
+
+
+class ProfileHistogram(Histogram, BinIndexFinder):
+    """
+    Profile of the y observable in bins of the x observable: for each bin, the number of entries
+    and the sums of w, w^2, w*y and w*y^2, from which the mean of y and its uncertainty are computed.
+    The weight w is the event weight if weighted is True, and 1 otherwise. Each observable is evaluated
+    once per event, the memory does not depend on the number of events, and merging adds the sums,
+    so the parallel runs give the same profile as the serial one.
+    """
+
+    # Rows of the sums array
+    _COUNT, _SUMW, _SUMW2, _SUMWY, _SUMWY2 = range(5)
+
+    def __init__(self, xobservable: Callable, yobservable: Callable, bin_edges: List[float], weighted: bool = False):
+        """
+        :param xobservable: Observable whose value selects the bin.
+        :param yobservable: Observable whose mean is computed in each bin.
+        :param bin_edges: The respective bin edges for the x observable.
+        :param weighted: Whether the entries are weighted with the event weight (eventinfo.weight).
+        """
+        super().__init__(bin_edges=bin_edges)
+        self.xobs = xobservable
+        self.yobs = yobservable
+        self.weighted = weighted
+        # Column 0 is the underflow and the last column the overflow
+        self._sums = np.zeros((5, len(bin_edges) + 1))
+
+    @property
+    def counts(self) -> np.ndarray:
+        """Number of entries in each bin."""
+        return self._sums[self._COUNT, 1:-1]
+
+    @property
+    def sumw(self) -> np.ndarray:
+        """Sum of weights in each bin."""
+        return self._sums[self._SUMW, 1:-1]
+
+    def mean(self) -> np.ndarray:
+        """Weighted mean of y in each bin, nan for the empty bins."""
+        sumw = self.sumw
+        return np.divide(self._sums[self._SUMWY, 1:-1], sumw, out=np.full(len(sumw), np.nan), where=sumw != 0)
+
+    def std(self) -> np.ndarray:
+        """Weighted standard deviation of y in each bin, nan for the empty bins."""
+        sumw = self.sumw
+        mean_y2 = np.divide(self._sums[self._SUMWY2, 1:-1], sumw, out=np.full(len(sumw), np.nan), where=sumw != 0)
+        # Rounding can make the variance slightly negative when all the y values are equal
+        return np.sqrt(np.maximum(mean_y2 - self.mean() ** 2, 0.0))
+
+    def errors(self) -> np.ndarray:
+        """Uncertainty of the mean in each bin, std / sqrt(n_eff) with n_eff = sumw^2 / sumw2."""
+        sumw2 = self._sums[self._SUMW2, 1:-1]
+        n_effective = np.divide(self.sumw ** 2, sumw2, out=np.zeros(len(sumw2)), where=sumw2 != 0)
+        return np.divide(self.std(), np.sqrt(n_effective), out=np.full(len(sumw2), np.nan), where=n_effective != 0)
+
+    def update_hist(self, event):
+        bin_index = self.find_bin_index(self.xobs(event))
+        column = bin_index + 1 if bin_index >= 0 else (0 if bin_index == self.UNDERFLOW else -1)
+        yvalue = self.yobs(event)
+        weight = event.eventinfo.weight if self.weighted else 1.0
+        self._sums[:, column] += (1.0, weight, weight ** 2, weight * yvalue, weight * yvalue ** 2)
+
+    def update_hist_batch(self, batch: EventBatch, mask: np.ndarray = None):
+        weights = None
+        if self.weighted:
+            weights = batch.weights if mask is None else batch.weights[mask]
+        self.fill_many(evaluate_on_batch(self.xobs, batch, mask), evaluate_on_batch(self.yobs, batch, mask), weights)
+
+    def fill_many(self, xvalues: np.ndarray, yvalues: np.ndarray, weights: np.ndarray = None):
+        """Adds each y value to the bin of the corresponding x value, with the given weights (1 by default)."""
+        bin_indices = self.find_bin_indices(np.asarray(xvalues, dtype=np.float64))
+        n_columns = self._sums.shape[1]
+        columns = np.where(bin_indices >= 0, bin_indices + 1, np.where(bin_indices == self.UNDERFLOW, 0, n_columns - 1))
+        yvalues = np.asarray(yvalues, dtype=np.float64)
+        weights = np.ones(len(columns)) if weights is None else np.asarray(weights, dtype=np.float64)
+        for row, row_weights in enumerate((None, weights, weights ** 2, weights * yvalues, weights * yvalues ** 2)):
+            self._sums[row] += np.bincount(columns, weights=row_weights, minlength=n_columns)
+
+    def __copy__(self):
+        return self.__class__(xobservable=self.xobs, yobservable=self.yobs, bin_edges=self.bin_edges, weighted=self.weighted)
+
+    def merge_hist(self, hist):
+        self._sums += hist._sums
+
+    def scale(self, factor: float):
+        """Scales the weights by factor: the mean is unchanged, but the profiles merged afterwards are weighted by it."""
+        self._sums[[self._SUMW, self._SUMWY, self._SUMWY2]] *= factor
+        self._sums[self._SUMW2] *= factor ** 2
+
+    def state_dict(self) -> Dict[str, np.ndarray]:
+        return {"sums": self._sums.copy()}
+
+    def load_state_dict(self, state: Dict[str, np.ndarray]):
+        self._sums[...] = state["sums"]
+
+    def config(self) -> Dict:
+        return {"type": type(self).__name__, "bin_edges": list(map(float, self.bin_edges)),
+                "xobservable": callable_name(self.xobs), "yobservable": callable_name(self.yobs),
+                "weighted": self.weighted}
+
+
+class HistogramStack:
+    """
+    ObservableHistogram objects with the same bin edges, stored as the rows of a single 2D array.
+    The bins are found once per distinct observable, and all the rows are filled with a single
+    scatter-add per batch. The histograms attribute holds the histogram of each row, which are
+    ObservableHistogram views of the rows of the contents array.
+    """
+
+    def __init__(self, bin_edges: List[float], observables: List[Callable]):
+        """
+        :param bin_edges: The bin edges shared by all the histograms.
+        :param observables: The observable of each histogram (row).
+        """
+        self._finder = BinIndexFinder(bin_edges)
+        self._allocate(observables)
+        # Rows of the histograms of each distinct observable
+        self._observable_rows = []
+        for row, observable in enumerate(observables):
+            for known_observable, rows in self._observable_rows:
+                if known_observable == observable:
+                    rows.append(row)
+                    break
+            else:
+                self._observable_rows.append((observable, [row]))
+        self._observable_rows = [(observable, np.array(rows)) for observable, rows in self._observable_rows]
+
+    def _allocate(self, observables: List[Callable]):
+        """Allocates the empty contents array and the histogram viewing each row."""
+        bin_edges = self._finder.bin_edges
+        self.contents = np.zeros((len(observables), len(bin_edges) - 1))
+        self.histograms = []
+        for row, observable in enumerate(observables):
+            hist = self.contents[row].view(ObservableHistogram)
+            hist.bin_edges = bin_edges
+            hist.observable = observable
+            self.histograms.append(hist)
+
+    def update_hist(self, event):
+        """Updates all the histograms with the given event."""
+        for observable, rows in self._observable_rows:
+            bin_index = self._finder.find_bin_index(observable(event))
+            if bin_index >= 0:
+                self.contents[rows, bin_index] += 1
+            elif bin_index == BinIndexFinder.UNDERFLOW:
+                for row in rows:
+                    self.histograms[row].underflow += 1
+            else:
+                for row in rows:
+                    self.histograms[row].overflow += 1
+
+    def update_hist_batch(self, batch: EventBatch, mask: np.ndarray = None):
+        """Updates all the histograms with the selected events of the batch."""
+        n_bins = self.contents.shape[1]
+        flat_indices = []
+        for observable, rows in self._observable_rows:
+            values = np.asarray(evaluate_on_batch(observable, batch, mask), dtype=np.float64)
+            bin_indices = self._finder.find_bin_indices(values)
+            # Index of the bins in the flattened contents, for each row of the observable
+            flat_indices.append((rows[:, None] * n_bins + bin_indices[bin_indices >= 0]).ravel())
+            n_underflow = np.count_nonzero(bin_indices == BinIndexFinder.UNDERFLOW)
+            n_overflow = np.count_nonzero(bin_indices == BinIndexFinder.OVERFLOW)
+            for row in rows:
+                self.histograms[row].underflow += n_underflow
+                self.histograms[row].overflow += n_overflow
+        self.contents += np.bincount(
+            np.concatenate(flat_indices), minlength=self.contents.size
+        ).reshape(self.contents.shape)
+
+    def __copy__(self):
+        """Empty stack with the same binning and observables."""
+        clone = self.__class__.__new__(self.__class__)
+        # The bin lookup and the grouping of the rows by observable are shared with the clone
+        clone._finder = self._finder
+        clone._observable_rows = self._observable_rows
+        clone._allocate([hist.observable for hist in self.histograms])
+        return clone
 
 
 class HistogramCompound(Histogram):
-    """Stores a set of Histogram objects that must be updated."""
+    """
+    Stores a set of Histogram objects that must be updated.
+
+    With stacked=True, the ObservableHistogram objects sharing the same bin edges are stored in a
+    HistogramStack, so their bins are found once per distinct observable and they are filled together.
+    get_hist then returns views of the rows of the stack, which replace the given histograms
+    (their content is copied into the stack).
+    """
 
-    def __init__(self, histograms: Dict[str, Histogram]):
+    def __init__(self, histograms: Dict[str, Histogram], stacked: bool = False):
         # Stores a dictionary whose values represent histogram, and the key is a name used to identify them
         self._hist_dict = histograms
+        self.stacked = stacked
+        # The names of the histograms in each stack, and the histograms outside the stacks
+        self._stacks = []
+        self._unstacked = list(histograms)
+        if stacked:
+            self._stack()
+
+    def _stack(self):
+        """Moves the ObservableHistogram objects with the same bin edges into HistogramStack objects."""
+        groups = {}
+        for hist_name, hist in self._hist_dict.items():
+            if type(hist) is ObservableHistogram:
+                groups.setdefault(tuple(map(float, hist.bin_edges)), []).append(hist_name)
+        # A copy, so the dictionary given by the caller is left unchanged
+        self._hist_dict = dict(self._hist_dict)
+        for hist_names in groups.values():
+            if len(hist_names) < 2:
+                continue
+            hists = [self._hist_dict[hist_name] for hist_name in hist_names]
+            stack = HistogramStack(bin_edges=hists[0].bin_edges, observables=[hist.observable for hist in hists])
+            for hist_name, hist, row_hist in zip(hist_names, hists, stack.histograms):
+                row_hist.merge_hist(hist)
+                self._hist_dict[hist_name] = row_hist
+            self._stacks.append((hist_names, stack))
+        stacked_names = {hist_name for hist_names, _ in self._stacks for hist_name in hist_names}
+        self._unstacked = [hist_name for hist_name in self._hist_dict if hist_name not in stacked_names]
 
     def update_hist(self, event):
         """Updates all the histograms with the given event."""
-        for hist_name in self._hist_dict:
+        for _, stack in self._stacks:
+            stack.update_hist(event=event)
+        for hist_name in self._unstacked:
             self._hist_dict[hist_name].update_hist(event=event)
 
+    def update_hist_batch(self, batch: EventBatch, mask: np.ndarray = None):
+        """Updates all the histograms with the selected events of the batch."""
+        for _, stack in self._stacks:
+            stack.update_hist_batch(batch=batch, mask=mask)
+        for hist_name in self._unstacked:
+            self._hist_dict[hist_name].update_hist_batch(batch=batch, mask=mask)
+
+    @property
+    def histograms(self) -> Dict[str, Histogram]:
+        """The histograms of the compound, by name."""
+        return dict(self._hist_dict)
+
     def get_hist(self, hist_name: str):
         """Returns the Histogram object associated with the key 'hist_name'"""
         if hist_name in self._hist_dict:
@@ -127,7 +669,51 @@ class HistogramCompound(Histogram):
 
     def __copy__(self):
         """Returns a shallow clone of all histograms."""
-        clone_dict = {hist_name: copy.copy(hist) for hist_name, hist in self._hist_dict.items()}
-        # Creates a container with now the cloned hists
-        return self.__class__(histograms=clone_dict)
+        if not self._stacks:
+            clone_dict = {hist_name: copy.copy(hist) for hist_name, hist in self._hist_dict.items()}
+            # Creates a container with now the cloned hists
+            return self.__class__(histograms=clone_dict, stacked=self.stacked)
+        # Each stack is cloned with a single allocation
+        clone_dict, clone_stacks = {}, []
+        for hist_names, stack in self._stacks:
+            stack_clone = copy.copy(stack)
+            clone_dict.update(zip(hist_names, stack_clone.histograms))
+            clone_stacks.append((hist_names, stack_clone))
+        for hist_name in self._unstacked:
+            clone_dict[hist_name] = copy.copy(self._hist_dict[hist_name])
+        clone = self.__class__(histograms={hist_name: clone_dict[hist_name] for hist_name in self._hist_dict})
+        clone.stacked = True
+        clone._stacks = clone_stacks
+        clone._unstacked = list(self._unstacked)
+        return clone
+
+    def merge_hist(self, hist):
+        """Merges each histogram with the histogram stored under the same name in the other compound."""
+        for hist_name in self._hist_dict:
+            self._hist_dict[hist_name].merge_hist(hist.get_hist(hist_name))
+
+    def scale(self, factor: float):
+        for hist in self._hist_dict.values():
+            hist.scale(factor)
+
+    def state_dict(self) -> Dict[str, np.ndarray]:
+        """The states of the histograms, with their keys prefixed by the histogram name."""
+        return {
+            f"{hist_name}/{key}": value
+            for hist_name, hist in self._hist_dict.items() for key, value in hist.state_dict().items()
+        }
+
+    def load_state_dict(self, state: Dict[str, np.ndarray]):
+        for hist_name, hist in self._hist_dict.items():
+            prefix = f"{hist_name}/"
+            hist.load_state_dict({key[len(prefix):]: value for key, value in state.items() if key.startswith(prefix)})
+
+    def config(self) -> Dict:
+        return {"type": type(self).__name__, "histograms": {name: hist.config() for name, hist in self._hist_dict.items()}}
+
+    def __getstate__(self):
+        # Pickle does not keep the histograms as views of the stacks, so the stacks are rebuilt when unpickling
+        return {"_hist_dict": self._hist_dict, "stacked": self.stacked}
 
+    def __setstate__(self, state):
+        self.__init__(histograms=state["_hist_dict"], stacked=state["stacked"])
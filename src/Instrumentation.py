@@ -0,0 +1,120 @@
+"""Optional profiling of the event loop and progress reporting."""
+
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+def peak_memory_mb() -> Optional[float]:
+    """Peak resident memory of the process in MB, or None if it can not be measured."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kB on Linux
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+class ProgressPrinter:
+    """Default progress callback of the EventLoop, printing the number of processed events every interval events."""
+
+    def __init__(self, interval: int = 10000):
+        self.interval = interval
+
+    def __call__(self, filename: str, n_processed: int, n_new: int):
+        """
+        :param filename: File being analysed.
+        :param n_processed: Number of events processed so far.
+        :param n_new: Number of events processed since the last call.
+        """
+        if n_processed // self.interval > (n_processed - n_new) // self.interval:
+            print(f"INFO: Processed {n_processed} events")
+
+
+class Profiler:
+    """
+    Accumulates the wall time and number of calls of the sections of the event loop:
+    the file reader, each cut, each cached observable and the histogram filling of each analysis.
+    Give it to the EventLoop to enable the profiling; without a profiler, nothing is timed
+    apart from the cut statistics the CutFlowEngine always keeps.
+    For the cuts, the number of calls is the number of events they were evaluated on.
+    A Profiler can be reused for several files, in which case the timings are added up.
+    """
+
+    def __init__(self):
+        # Maps the section name to its total time and number of calls
+        self.sections: Dict[str, Dict] = {}
+        self.n_events = 0
+        self.wall_time = 0.0
+
+    def add(self, section: str, elapsed: float, calls: int = 1):
+        """Adds elapsed seconds and calls to the section."""
+        entry = self.sections.setdefault(section, {"time": 0.0, "calls": 0})
+        entry["time"] += elapsed
+        entry["calls"] += calls
+
+    @contextmanager
+    def time(self, section: str):
+        """Times the code inside the with block."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(section, time.perf_counter() - start_time)
+
+    def timed_iter(self, iterable: Iterable, section: str) -> Iterator:
+        """Yields the items of the iterable, timing how long each one takes to be produced."""
+        iterator = iter(iterable)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(section, time.perf_counter() - start_time, calls=0)
+                return
+            self.add(section, time.perf_counter() - start_time)
+            yield item
+
+    def report(self) -> Dict:
+        """Profiling report, which can be saved as JSON."""
+        return {
+            "n_events": self.n_events,
+            "wall_time": self.wall_time,
+            "events_per_second": self.n_events / self.wall_time if self.wall_time > 0 else None,
+            "peak_memory_mb": peak_memory_mb(),
+            "sections": {name: dict(entry) for name, entry in sorted(self.sections.items())},
+        }
+
+    def save(self, path: str):
+        """Saves the report as a JSON file."""
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+
+def merge_profiles(profile: Dict, other: Dict) -> Dict:
+    """
+    Adds up the profiling reports of two runs (e.g. of the workers of a ParallelEventLoop).
+    The wall time is the sum of the wall times of both runs, and the peak memory the largest of the two.
+    """
+    sections = {name: dict(entry) for name, entry in profile["sections"].items()}
+    for name, entry in other["sections"].items():
+        merged_entry = sections.setdefault(name, {"time": 0.0, "calls": 0})
+        merged_entry["time"] += entry["time"]
+        merged_entry["calls"] += entry["calls"]
+    n_events = profile["n_events"] + other["n_events"]
+    wall_time = profile["wall_time"] + other["wall_time"]
+    peak_memory = [memory for memory in (profile["peak_memory_mb"], other["peak_memory_mb"]) if memory is not None]
+    return {
+        "n_events": n_events,
+        "wall_time": wall_time,
+        "events_per_second": n_events / wall_time if wall_time > 0 else None,
+        "peak_memory_mb": max(peak_memory) if peak_memory else None,
+        "sections": dict(sorted(sections.items())),
+    }
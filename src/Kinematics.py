@@ -0,0 +1,242 @@
+"""
+Vectorized four-momentum observables and cuts.
+They are evaluated on whole EventBatch chunks at once, and can be used as the observables of the
+histograms and as the selection cuts of EventAnalysis. Called with a single event, they return
+the value for that event, computed directly from its particles, so they also work with per-event readers.
+
+Example, the invariant mass of the e-mu pair and a cut on the MET/mll ratio:
+
+    mll = InvariantMass(MomentumSum(pids=[11, 13]))
+    met = TransverseMomentum(MomentumSum(pids=[12, 14, 16]))
+    met_mll_cut = Cut(Ratio(met, mll), minimum=0.2)
+"""
+
+from abc import ABC, abstractmethod
+from typing import List
+from PyLHE_EventAnalysis.src.EventBatch import EventBatch
+from PyLHE_EventAnalysis.src.ObservableCache import cached_call
+import numpy as np
+
+# Components of the four-momentum arrays, in this order
+MOMENTUM_COMPONENTS = ("e", "px", "py", "pz")
+
+
+def total_momentum(batch: EventBatch, pids: List[int], status: int = None, absolute: bool = True) -> np.ndarray:
+    """
+    Sum of the four-momenta of the particles with the given PIDs in each event.
+
+    :param batch: The events.
+    :param pids: PIDs of the particles included in the sum.
+    :param status: If given, only particles with this status are included.
+    :param absolute: If True, the PIDs are compared with the absolute value of the particle ids.
+
+    :return: Array with shape (len(batch), 4) holding (e, px, py, pz) for each event.
+    """
+    particle_ids = np.abs(batch["id"]) if absolute else batch["id"]
+    selected = np.isin(particle_ids, pids)
+    if status is not None:
+        selected &= batch["status"] == status
+    event_index = batch.event_index[selected]
+    # bincount adds the particles of each event in the order they appear in the event
+    return np.stack([
+        np.bincount(event_index, weights=batch[component][selected], minlength=len(batch))
+        for component in MOMENTUM_COMPONENTS
+    ], axis=1)
+
+
+def invariant_mass(momentum: np.ndarray) -> np.ndarray:
+    """Invariant mass of four-momenta stored as (..., 4) arrays."""
+    energy, px, py, pz = np.moveaxis(momentum, -1, 0)
+    return np.sqrt(energy * energy - px * px - py * py - pz * pz)
+
+
+def transverse_momentum(momentum: np.ndarray) -> np.ndarray:
+    """Transverse momentum of four-momenta stored as (..., 4) arrays."""
+    _, px, py, _ = np.moveaxis(momentum, -1, 0)
+    return np.sqrt(px * px + py * py)
+
+
+def pseudo_rapidity(momentum: np.ndarray) -> np.ndarray:
+    """Pseudo-rapidity of four-momenta stored as (..., 4) arrays."""
+    _, px, py, pz = np.moveaxis(momentum, -1, 0)
+    return np.arcsinh(pz / np.sqrt(px * px + py * py))
+
+
+def rapidity(momentum: np.ndarray) -> np.ndarray:
+    """Rapidity of four-momenta stored as (..., 4) arrays."""
+    energy, _, _, pz = np.moveaxis(momentum, -1, 0)
+    return 0.5 * np.log((energy + pz) / (energy - pz))
+
+
+class KinematicObservable(ABC):
+    """
+    Base class of the vectorized observables.
+    Observables with the same type and parameters compare equal, so they share their cached
+    values (see ObservableCache) and, when used as cuts, are evaluated once by the CutFlowEngine.
+    Subclasses call KinematicObservable.__init__ once their parameters are set.
+    """
+
+    vectorized = True
+
+    def __init__(self):
+        # Name of the observable in the ObservableCache
+        self._name = repr(self)
+
+    @abstractmethod
+    def _parameters(self) -> tuple:
+        """Parameters that define the observable."""
+        pass
+
+    @abstractmethod
+    def compute(self, batch: EventBatch) -> np.ndarray:
+        """Evaluates the observable for all the events of the batch."""
+        pass
+
+    @abstractmethod
+    def compute_event(self, event):
+        """Evaluates the observable for a single event (e.g. a pylhe event or an Event record)."""
+        pass
+
+    def __call__(self, events):
+        if isinstance(events, EventBatch):
+            return cached_call(self._name, self.compute, events)
+        # Single event
+        return cached_call(self._name, self.compute_event, events)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._parameters() == other._parameters()
+
+    def __hash__(self):
+        return hash((type(self), self._parameters()))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(map(repr, self._parameters()))})"
+
+
+class MomentumSum(KinematicObservable):
+    """Total four-momentum of the particles with the given PIDs (see total_momentum)."""
+
+    def __init__(self, pids: List[int], status: int = None, absolute: bool = True):
+        self.pids = tuple(pids)
+        self.status = status
+        self.absolute = absolute
+        super().__init__()
+
+    def _parameters(self) -> tuple:
+        return self.pids, self.status, self.absolute
+
+    def compute(self, batch: EventBatch) -> np.ndarray:
+        return total_momentum(batch, list(self.pids), status=self.status, absolute=self.absolute)
+
+    def compute_event(self, event) -> np.ndarray:
+        # The particles are added in the order they appear in the event, as in total_momentum
+        momentum = [0.0, 0.0, 0.0, 0.0]
+        for particle in event.particles:
+            particle_id = abs(particle.id) if self.absolute else particle.id
+            if particle_id in self.pids and (self.status is None or particle.status == self.status):
+                momentum[0] += particle.e
+                momentum[1] += particle.px
+                momentum[2] += particle.py
+                momentum[3] += particle.pz
+        return np.array(momentum)
+
+
+class _MomentumFunction(KinematicObservable):
+    """Observable computed from a four-momentum observable."""
+
+    function = None
+
+    def __init__(self, momentum: KinematicObservable):
+        self.momentum = momentum
+        super().__init__()
+
+    def _parameters(self) -> tuple:
+        return (self.momentum,)
+
+    def compute(self, batch: EventBatch) -> np.ndarray:
+        return type(self).function(self.momentum(batch))
+
+    def compute_event(self, event) -> float:
+        return float(type(self).function(self.momentum(event)))
+
+
+class InvariantMass(_MomentumFunction):
+    """Invariant mass of a four-momentum observable."""
+    function = staticmethod(invariant_mass)
+
+
+class TransverseMomentum(_MomentumFunction):
+    """Transverse momentum of a four-momentum observable (e.g. the MET for the sum of the neutrinos)."""
+    function = staticmethod(transverse_momentum)
+
+
+class PseudoRapidity(_MomentumFunction):
+    """Pseudo-rapidity of a four-momentum observable."""
+    function = staticmethod(pseudo_rapidity)
+
+
+class Rapidity(_MomentumFunction):
+    """Rapidity of a four-momentum observable."""
+    function = staticmethod(rapidity)
+
+
+class Ratio(KinematicObservable):
+    """Ratio of two observables, e.g. MET / mll."""
+
+    def __init__(self, numerator: KinematicObservable, denominator: KinematicObservable):
+        self.numerator = numerator
+        self.denominator = denominator
+        super().__init__()
+
+    def _parameters(self) -> tuple:
+        return self.numerator, self.denominator
+
+    def compute(self, batch: EventBatch) -> np.ndarray:
+        return self.numerator(batch) / self.denominator(batch)
+
+    def compute_event(self, event) -> float:
+        return float(np.float64(self.numerator(event)) / self.denominator(event))
+
+
+class Cut(KinematicObservable):
+    """
+    Selection cut requiring minimum < observable < maximum.
+    It returns a boolean mask for an EventBatch, and a bool for a single event.
+    """
+
+    def __init__(self, observable: KinematicObservable, minimum: float = None, maximum: float = None,
+                 absolute: bool = False):
+        """
+        :param observable: The observable the cut is applied to.
+        :param minimum: Lower limit. If None, there is no lower limit.
+        :param maximum: Upper limit. If None, there is no upper limit.
+        :param absolute: If True, the cut is applied to the absolute value of the observable.
+        """
+        self.observable = observable
+        self.minimum = minimum
+        self.maximum = maximum
+        self.absolute = absolute
+        super().__init__()
+
+    def _parameters(self) -> tuple:
+        return self.observable, self.minimum, self.maximum, self.absolute
+
+    def compute(self, batch: EventBatch) -> np.ndarray:
+        return self.apply(self.observable(batch))
+
+    def apply(self, values: np.ndarray) -> np.ndarray:
+        """Boolean mask of the observable values passing the cut."""
+        if self.absolute:
+            values = np.abs(values)
+        passed = np.ones(len(values), dtype=bool)
+        if self.minimum is not None:
+            passed &= values > self.minimum
+        if self.maximum is not None:
+            passed &= values < self.maximum
+        return passed
+
+    def compute_event(self, event) -> bool:
+        value = self.observable(event)
+        if self.absolute:
+            value = abs(value)
+        return bool((self.minimum is None or value > self.minimum) and (self.maximum is None or value < self.maximum))
@@ -0,0 +1,456 @@
+"""
+Built-in streaming reader for .lhe files.
+The file is read in large blocks and the <event> blocks are parsed directly into compact records
+(per-event reader) or into the columns of an EventBatch (batch reader), without building an XML tree.
+Both readers can be restricted to the events stored in a byte range of the file.
+Files compressed with gzip, xz or zstd are decompressed on the fly.
+
+A prefilter can skip events using only cheap fields (PIDs, statuses and the event weight) before
+their kinematics are decoded, and the per-event reader can decode the particles lazily.
+"""
+
+from typing import Callable, Dict, Iterator, List, Tuple
+from PyLHE_EventAnalysis.src.EventBatch import Event, EventBatch, EventInfo, Particle
+from PyLHE_EventAnalysis.src.FileIO import detect_compression, open_lhe
+import numpy as np
+import functools
+import inspect
+import mmap
+import os
+import re
+
+# Size of the blocks read from the file
+_READ_SIZE = 1 << 22
+# Position of the id, status, e, px, py, pz and m attributes in the particle lines
+_PARTICLE_FIELDS = (0, 1, 9, 6, 7, 8, 10)
+# Characters that may follow '<event' in an opening tag
+_TAG_DELIMITERS = (b">", b" ", b"\t", b"\n", b"\r")
+# Entries of the <rwgt> block
+_WEIGHT_ENTRY = re.compile(rb"<wgt\s+id\s*=\s*['\"]([^'\"]+)['\"]\s*>\s*(\S+)\s*</wgt>")
+
+
+def _iter_event_blocks(filename: str, start: int = 0, end: int = None,
+                       statistics: "ReadStatistics" = None) -> Iterator[bytes]:
+    """
+    Yields the content of each <event> block whose opening tag starts in the byte range [start, end).
+    Plain files are memory-mapped, and compressed files are decompressed in a background thread
+    (see FileIO.open_lhe). Byte ranges are only supported for plain files.
+
+    :param filename: Path to the .lhe file.
+    :param start: Byte offset where the range starts.
+    :param end: Byte offset where the range ends. If None, reads until the end of the file.
+    :param statistics: ReadStatistics whose position is updated with the end of each block of a plain file.
+    """
+    if detect_compression(filename) is None:
+        yield from _iter_mapped_blocks(filename, start, end, statistics)
+        return
+    if start != 0 or end is not None:
+        raise ValueError(f"Byte ranges can not be read from the compressed file {filename}.")
+    with open_lhe(filename) as lhe_file:
+        yield from _iter_stream_blocks(lhe_file)
+
+
+def _iter_mapped_blocks(filename: str, start: int, end: int, statistics: "ReadStatistics" = None) -> Iterator[bytes]:
+    """Yields the <event> blocks of a plain file, searching the tags directly in the memory-mapped file."""
+    with open(filename, "rb") as lhe_file:
+        # Empty files can not be mapped
+        if os.fstat(lhe_file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(lhe_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            position = start
+            while True:
+                tag_start = mapped_file.find(b"<event", position)
+                # Events starting after the end of the range belong to the next chunk
+                if tag_start == -1 or (end is not None and tag_start >= end):
+                    return
+                if mapped_file[tag_start + 6:tag_start + 7] not in _TAG_DELIMITERS:
+                    # Another tag starting with '<event'
+                    position = tag_start + 6
+                    continue
+                tag_end = mapped_file.find(b">", tag_start)
+                block_end = mapped_file.find(b"</event>", tag_end) if tag_end != -1 else -1
+                if block_end == -1:
+                    return
+                position = block_end + 8
+                if statistics is not None:
+                    statistics.position = position
+                yield mapped_file[tag_end + 1:block_end]
+
+
+def _iter_stream_blocks(lhe_file) -> Iterator[bytes]:
+    """Yields the <event> blocks of a binary stream, which is read in blocks of about _READ_SIZE bytes."""
+    buffer, position = b"", 0
+    end_of_file = False
+    while True:
+        tag_start = buffer.find(b"<event", position)
+        if tag_start != -1 and tag_start + 6 < len(buffer):
+            if buffer[tag_start + 6:tag_start + 7] not in _TAG_DELIMITERS:
+                # Another tag starting with '<event'
+                position = tag_start + 6
+                continue
+            tag_end = buffer.find(b">", tag_start)
+            block_end = buffer.find(b"</event>", tag_end) if tag_end != -1 else -1
+            if block_end != -1:
+                yield buffer[tag_end + 1:block_end]
+                position = block_end + 8
+                continue
+        if end_of_file:
+            return
+        # Keeps the part of the buffer that was not processed yet and reads the next block
+        keep = tag_start if tag_start != -1 else max(position, len(buffer) - 6)
+        data = lhe_file.read(_READ_SIZE)
+        end_of_file = not data
+        buffer, position = buffer[keep:] + data, 0
+
+
+def _split_block(block: bytes) -> Tuple[bytes, List[bytes], List[bytes]]:
+    """Returns the event information line, the particle lines and the remaining lines (e.g. <rwgt>) of an event block."""
+    lines = block.strip().split(b"\n")
+    n_particles = int(lines[0].split(None, 1)[0])
+    return lines[0], lines[1:n_particles + 1], lines[n_particles + 1:]
+
+
+def _parse_weights(extra_lines: List[bytes]) -> Dict[str, float]:
+    """Parses the <wgt id='...'> value </wgt> entries of the <rwgt> block, keyed by weight id."""
+    if not extra_lines:
+        return {}
+    return {
+        weight_id.decode(): float(value)
+        for weight_id, value in _WEIGHT_ENTRY.findall(b"\n".join(extra_lines))
+    }
+
+
+def _parse_batch_weights(extra_blocks: List[bytes]) -> Tuple[List[str], np.ndarray]:
+    """
+    Parses the <rwgt> weights of all the events of a batch at once.
+    Returns the weight ids, in the order of the first event, and the array of weights with one row per event.
+    """
+    first_entries = _WEIGHT_ENTRY.findall(extra_blocks[0]) if extra_blocks else []
+    entries = _WEIGHT_ENTRY.findall(b"\n".join(extra_blocks))
+    if not entries:
+        return [], np.zeros((len(extra_blocks), 0))
+    weight_ids = [weight_id.decode() for weight_id, _ in first_entries]
+    if len(entries) != len(weight_ids) * len(extra_blocks):
+        raise ValueError("All the events must have the same <rwgt> weights.")
+    values = np.array([value for _, value in entries]).astype(np.float64)
+    return weight_ids, values.reshape(len(extra_blocks), len(weight_ids))
+
+
+def _decode_particles(particle_lines: List[bytes]) -> List[Particle]:
+    """Parses the particle lines of an event into Particle records."""
+    particles = []
+    for line in particle_lines:
+        fields = line.split()
+        particles.append(Particle(
+            int(fields[0]), int(fields[1]), float(fields[9]),
+            float(fields[6]), float(fields[7]), float(fields[8]), float(fields[10])
+        ))
+    return particles
+
+
+class ReadStatistics:
+    """
+    Number of events read from the file, skipped by the prefilter and with decoded particle kinematics.
+    For plain files, position holds the byte offset after the last event read, where the reading of the
+    file can resume (see resume_reader). It is None for compressed files.
+    """
+
+    __slots__ = ("n_read", "n_skipped", "n_decoded", "position")
+
+    def __init__(self):
+        self.n_read = 0
+        self.n_skipped = 0
+        self.n_decoded = 0
+        self.position = None
+
+    def to_dict(self) -> dict:
+        return {"read": self.n_read, "skipped": self.n_skipped, "decoded": self.n_decoded}
+
+    def state_dict(self) -> dict:
+        """Counters and position, so the reading of the file can resume (see Checkpoint)."""
+        return {"n_read": self.n_read, "n_skipped": self.n_skipped, "n_decoded": self.n_decoded,
+                "position": self.position}
+
+    def load_state_dict(self, state: dict):
+        """Restores the state saved by state_dict."""
+        self.n_read, self.n_skipped, self.n_decoded = state["n_read"], state["n_skipped"], state["n_decoded"]
+        self.position = state["position"]
+
+
+class LazyEvent:
+    """
+    Event record whose particles are only decoded when the particles attribute is first used.
+    The PIDs and statuses (ids and statuses attributes) and the eventinfo are cheap to access,
+    so prefilters can use them without decoding the kinematics.
+    """
+
+    __slots__ = ("eventinfo", "_lines", "_extra_lines", "_particles", "_weights", "_ids", "_statuses", "_statistics")
+
+    def __init__(self, eventinfo: EventInfo, particle_lines: List[bytes], extra_lines: List[bytes] = (),
+                 statistics: ReadStatistics = None):
+        self.eventinfo = eventinfo
+        self._lines = particle_lines
+        self._extra_lines = extra_lines
+        self._particles = None
+        self._weights = None
+        self._ids = None
+        self._statuses = None
+        self._statistics = statistics
+
+    @property
+    def particles(self) -> List[Particle]:
+        if self._particles is None:
+            self._particles = _decode_particles(self._lines)
+            if self._statistics is not None:
+                self._statistics.n_decoded += 1
+        return self._particles
+
+    @property
+    def weights(self) -> Dict[str, float]:
+        """The <rwgt> weights, keyed by weight id."""
+        if self._weights is None:
+            self._weights = _parse_weights(self._extra_lines)
+        return self._weights
+
+    def _decode_codes(self):
+        """Parses only the PID and status of the particles."""
+        codes = [line.split(None, 2) for line in self._lines]
+        self._ids = [int(fields[0]) for fields in codes]
+        self._statuses = [int(fields[1]) for fields in codes]
+
+    @property
+    def ids(self) -> List[int]:
+        """PIDs of the particles."""
+        if self._ids is None:
+            self._decode_codes()
+        return self._ids
+
+    @property
+    def statuses(self) -> List[int]:
+        """Statuses of the particles."""
+        if self._statuses is None:
+            self._decode_codes()
+        return self._statuses
+
+
+class RequirePIDs:
+    """
+    Prefilter keeping the events that have at least one particle with each of the given PIDs,
+    e.g. RequirePIDs([11, 13], status=1) for the e-mu final state.
+    """
+
+    def __init__(self, pids: List[int], status: int = None, absolute: bool = True):
+        """
+        :param pids: PIDs that must be present in the event.
+        :param status: If given, only particles with this status are considered.
+        :param absolute: If True, the PIDs are compared with the absolute value of the particle ids.
+        """
+        self.pids = frozenset(pids)
+        self.status = status
+        self.absolute = absolute
+
+    def __call__(self, event: LazyEvent) -> bool:
+        ids = event.ids
+        if self.status is not None:
+            ids = [pid for pid, status in zip(ids, event.statuses) if status == self.status]
+        if self.absolute:
+            ids = map(abs, ids)
+        return self.pids.issubset(ids)
+
+    def __repr__(self):
+        return f"RequirePIDs({sorted(self.pids)}, status={self.status}, absolute={self.absolute})"
+
+
+class EventStream:
+    """
+    Iterator over the events (or EventBatch chunks) yielded by the built-in readers.
+    The statistics attribute holds the ReadStatistics of the file, which the EventLoop uses to count
+    the events skipped by the prefilter in the normalisation.
+    """
+
+    def __init__(self, chunks: Iterator, statistics: ReadStatistics):
+        self._chunks = chunks
+        self.statistics = statistics
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        self._chunks.close()
+
+
+def _iter_selected(filename: str, start: int, end: int, prefilter: Callable,
+                   statistics: ReadStatistics) -> Iterator[LazyEvent]:
+    """Yields the events of the byte range accepted by the prefilter, with their particles not decoded yet."""
+    for block in _iter_event_blocks(filename, start, end, statistics):
+        info, particle_lines, extra_lines = _split_block(block)
+        statistics.n_read += 1
+        event = LazyEvent(EventInfo(nparticles=len(particle_lines), weight=float(info.split()[2])), particle_lines,
+                          extra_lines, statistics)
+        if prefilter is not None and not prefilter(event):
+            statistics.n_skipped += 1
+            continue
+        yield event
+
+
+def _iter_decoded(filename: str, start: int, end: int, statistics: ReadStatistics) -> Iterator[Event]:
+    """Yields all the events of the byte range with their particles decoded."""
+    for block in _iter_event_blocks(filename, start, end, statistics):
+        info, particle_lines, extra_lines = _split_block(block)
+        statistics.n_read += 1
+        statistics.n_decoded += 1
+        yield Event(EventInfo(nparticles=len(particle_lines), weight=float(info.split()[2])),
+                    _decode_particles(particle_lines), _parse_weights(extra_lines))
+
+
+def read_lhe(filename: str, start: int = 0, end: int = None, prefilter: Callable = None,
+             lazy: bool = False) -> EventStream:
+    """
+    Yields the events of the .lhe file one by one as compact Event records.
+    It is a drop-in replacement for pylhe.read_lhe as the file_reader of the EventLoop:
+    the records have the particles and eventinfo attributes used by the observables.
+
+    :param filename: Path to the .lhe file.
+    :param start: Only the events whose <event> tag starts at or after this byte offset are read.
+    :param end: Only the events whose <event> tag starts before this byte offset are read.
+    :param prefilter: Optional function taking a LazyEvent and returning False for the events that
+                      must be skipped. It should only use the cheap fields (eventinfo, ids, statuses).
+    :param lazy: If True, LazyEvent records are yielded, and the particles of each event are only
+                 decoded if an observable or cut uses them.
+    """
+    statistics = ReadStatistics()
+    if prefilter is None and not lazy:
+        return EventStream(_iter_decoded(filename, start, end, statistics), statistics)
+    events = _iter_selected(filename, start, end, prefilter, statistics)
+    if not lazy:
+        events = (Event(event.eventinfo, event.particles, event.weights) for event in events)
+    return EventStream(events, statistics)
+
+
+def read_pylhe(filename: str):
+    """
+    Yields the events of the .lhe file with pylhe.read_lhe. pylhe is imported on the first call,
+    so the scripts using it as the file_reader of the EventLoop only pay for its import when they read a file.
+    """
+    import pylhe
+    return pylhe.read_lhe(filename)
+
+
+def read_lhe_batches(filename: str, batch_size: int = 10000, start: int = 0, end: int = None,
+                     prefilter: Callable = None) -> EventStream:
+    """
+    Yields the events of the .lhe file in EventBatch chunks of batch_size events.
+    The start, end and prefilter arguments have the same meaning as in read_lhe. Only the events
+    accepted by the prefilter are decoded and stored in the batches.
+    """
+    statistics = ReadStatistics()
+    return EventStream(_iter_batches(filename, batch_size, start, end, prefilter, statistics), statistics)
+
+
+def _iter_batches(filename: str, batch_size: int, start: int, end: int, prefilter: Callable,
+                  statistics: ReadStatistics) -> Iterator[EventBatch]:
+    """Yields the EventBatch chunks of the events accepted by the prefilter."""
+    weights, particle_lines, n_particles, extra_blocks = [], [], [], []
+    if prefilter is None:
+        # Without a prefilter, no LazyEvent records are built and the weights are parsed at once
+        info_lines = []
+        for block in _iter_event_blocks(filename, start, end, statistics):
+            info, lines, extra_lines = _split_block(block)
+            statistics.n_read += 1
+            info_lines.append(info)
+            particle_lines.extend(lines)
+            n_particles.append(len(lines))
+            extra_blocks.append(b"\n".join(extra_lines))
+            if len(info_lines) == batch_size:
+                yield _build_batch(np.loadtxt(info_lines, usecols=2, ndmin=1), particle_lines, n_particles,
+                                   extra_blocks, statistics)
+                info_lines, particle_lines, n_particles, extra_blocks = [], [], [], []
+        weights = np.loadtxt(info_lines, usecols=2, ndmin=1) if info_lines else []
+    else:
+        for event in _iter_selected(filename, start, end, prefilter, statistics):
+            weights.append(event.eventinfo.weight)
+            particle_lines.extend(event._lines)
+            n_particles.append(len(event._lines))
+            extra_blocks.append(b"\n".join(event._extra_lines))
+            if len(weights) == batch_size:
+                yield _build_batch(np.array(weights), particle_lines, n_particles, extra_blocks, statistics)
+                weights, particle_lines, n_particles, extra_blocks = [], [], [], []
+    # Remaining events
+    if len(weights):
+        yield _build_batch(np.asarray(weights, dtype=np.float64), particle_lines, n_particles, extra_blocks, statistics)
+
+
+def _build_batch(weights: np.ndarray, particle_lines: List[bytes], n_particles: List[int],
+                 extra_blocks: List[bytes], statistics: ReadStatistics) -> EventBatch:
+    """Parses the lines of all the events of the batch at once."""
+    # Only the id, status, e, px, py, pz and m fields are parsed. The table is a single
+    # contiguous buffer whose rows hold the momentum columns of the batch
+    particles_table = np.ascontiguousarray(np.loadtxt(particle_lines, usecols=_PARTICLE_FIELDS, ndmin=2).T)
+    particles = {
+        "id": particles_table[0].astype(np.int64),
+        "status": particles_table[1].astype(np.int64),
+        **dict(zip(("e", "px", "py", "pz", "m"), particles_table[2:])),
+    }
+    offsets = np.zeros(len(n_particles) + 1, dtype=np.int64)
+    np.cumsum(n_particles, out=offsets[1:])
+    weight_ids, variation_weights = _parse_batch_weights(extra_blocks)
+    statistics.n_decoded += len(n_particles)
+    return EventBatch(particles=particles, offsets=offsets, weights=weights,
+                      variation_weights=variation_weights, weight_ids=weight_ids)
+
+
+def split_file(filename: str, n_chunks: int) -> List[Tuple[int, int]]:
+    """
+    Splits the file into n_chunks byte ranges of similar size.
+    Each event belongs to the range where its <event> tag starts, so the ranges
+    can be given to read_lhe (or read_lhe_batches) to process the file in parallel.
+    Compressed files can not be read from an arbitrary offset, so they are a single range.
+    """
+    if detect_compression(filename) is not None:
+        return [(0, None)]
+    file_size = os.path.getsize(filename)
+    boundaries = [file_size * chunk // n_chunks for chunk in range(n_chunks + 1)]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _reader_arguments(file_reader: Callable) -> Tuple[Callable, tuple, dict]:
+    """
+    Function, positional and keyword arguments of the file reader (a function or a functools.partial).
+    Raises a ValueError if the function does not take the start and end byte offsets.
+    """
+    if isinstance(file_reader, functools.partial):
+        function, args, keywords = file_reader.func, file_reader.args, file_reader.keywords
+    else:
+        function, args, keywords = file_reader, (), {}
+    try:
+        parameters = inspect.signature(function).parameters
+    except (TypeError, ValueError):
+        parameters = {}
+    if "start" not in parameters or "end" not in parameters:
+        raise ValueError(
+            f"The file reader {getattr(function, '__name__', repr(function))} does not take the start and end "
+            "byte offsets, so it can not read a byte range of a file."
+        )
+    return function, args, keywords
+
+
+def range_reader(file_reader: Callable, start: int, end: int) -> Callable:
+    """
+    Reader of the events in the byte range [start, end) of a file, calling the function of file_reader with
+    the same arguments (e.g. the batch_size, prefilter or lazy arguments of a functools.partial of read_lhe).
+    Raises a ValueError if the function does not take the start and end byte offsets.
+    """
+    function, args, keywords = _reader_arguments(file_reader)
+    return functools.partial(function, *args, **{**keywords, "start": start, "end": end})
+
+
+def resume_reader(file_reader: Callable, start: int) -> Callable:
+    """
+    Reader of the events of file_reader from the byte offset start (e.g. the position of its ReadStatistics),
+    keeping the end of its byte range. Raises a ValueError if the function does not take the byte offsets.
+    """
+    function, args, keywords = _reader_arguments(file_reader)
+    return functools.partial(function, *args, **{**keywords, "start": start})
@@ -0,0 +1,139 @@
+"""Metadata of .lhe files (cross-section, number of events, init block and weight names) and its persistent index."""
+
+from typing import Dict, Optional
+from PyLHE_EventAnalysis.src.Utilities import file_signature
+from PyLHE_EventAnalysis.src.FileIO import open_lhe_text
+import json
+import os
+import re
+
+# Line of the MadGraph banner storing the cross-section
+_XSECTION_LINE = "#  Integrated weight (pb)  :"
+# Weight declarations in the <initrwgt> block
+_WEIGHT_ID = re.compile(r"<weight\s+id\s*=\s*['\"]([^'\"]+)['\"]")
+
+
+class LHEMetadata:
+    """Information about an .lhe file that the drivers need to normalise the histograms."""
+
+    def __init__(self, cross_section: float = None, num_events: int = None, init: Dict = None,
+                 weight_names: list = None):
+        """
+        :param cross_section: Cross-section in pb.
+        :param num_events: Number of events in the file.
+        :param init: Content of the <init> block.
+        :param weight_names: Identifiers of the weights declared in the <initrwgt> block.
+        """
+        self.cross_section = cross_section
+        self.num_events = num_events
+        self.init = init
+        self.weight_names = weight_names if weight_names is not None else []
+
+    def to_dict(self) -> Dict:
+        return {
+            "cross_section": self.cross_section, "num_events": self.num_events,
+            "init": self.init, "weight_names": self.weight_names
+        }
+
+    @classmethod
+    def from_dict(cls, metadata: Dict) -> "LHEMetadata":
+        return cls(**metadata)
+
+    def __repr__(self):
+        return f"LHEMetadata(cross_section={self.cross_section}, num_events={self.num_events})"
+
+
+def _parse_init(init_lines: list) -> Dict:
+    """Parses the lines of the <init> block."""
+    beam_info = init_lines[0].split()
+    processes = []
+    for line in init_lines[1:int(beam_info[9]) + 1]:
+        xsec, xerr, xmax, process_id = line.split()[:4]
+        processes.append({"xsec": float(xsec), "xerr": float(xerr), "xmax": float(xmax), "id": int(process_id)})
+    return {
+        "beam_ids": [int(beam_info[0]), int(beam_info[1])],
+        "beam_energies": [float(beam_info[2]), float(beam_info[3])],
+        "pdf_groups": [int(beam_info[4]), int(beam_info[5])],
+        "pdf_sets": [int(beam_info[6]), int(beam_info[7])],
+        "weighting_strategy": int(beam_info[8]),
+        "processes": processes,
+    }
+
+
+def read_metadata(filename: str) -> LHEMetadata:
+    """
+    Reads the metadata from the header of the .lhe file.
+    Only the lines before the first <event> block are read. The number of events is not
+    known at this point; the EventLoop sets it while iterating over the events.
+    If the banner has no 'Integrated weight (pb)' line, the cross-section is the sum of
+    the process cross-sections in the <init> block.
+    """
+    metadata = LHEMetadata()
+    init_lines = None
+    with open_lhe_text(filename) as lhe_file:
+        for line in lhe_file:
+            stripped = line.strip()
+            if stripped.startswith("<event"):
+                break
+            if line.startswith(_XSECTION_LINE):
+                metadata.cross_section = float(line.split(":")[1])
+            elif stripped == "<init>" or stripped.startswith("<init "):
+                init_lines = []
+            elif stripped.startswith("</init>"):
+                metadata.init = _parse_init(init_lines)
+                init_lines = None
+            elif init_lines is not None:
+                # Comments inside the init block are ignored
+                if stripped and not stripped.startswith("#"):
+                    init_lines.append(stripped)
+            else:
+                metadata.weight_names.extend(_WEIGHT_ID.findall(line))
+    # Cross-section from the init block
+    if metadata.cross_section is None and metadata.init is not None:
+        metadata.cross_section = sum(process["xsec"] for process in metadata.init["processes"])
+    return metadata
+
+
+class MetadataIndex:
+    """
+    Sidecar index with the metadata of the .lhe files already read.
+    Entries are keyed by the absolute path of the file, and are discarded if the
+    size or the modification time of the file changed.
+    """
+
+    def __init__(self, index_path: str):
+        """
+        :param index_path: Path to the .json file storing the index.
+        """
+        self.index_path = index_path
+
+    def _load(self) -> Dict:
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as index_file:
+            return json.load(index_file)
+
+    def get(self, filename: str) -> Optional[LHEMetadata]:
+        """Returns the stored metadata of the file, or None if it is not in the index or is out of date."""
+        entry = self._load().get(os.path.abspath(filename))
+        if entry is None or entry["signature"] != list(file_signature(filename)):
+            return None
+        return LHEMetadata.from_dict(entry["metadata"])
+
+    def put(self, filename: str, metadata: LHEMetadata):
+        """Stores the metadata of the file."""
+        self.put_many({filename: metadata})
+
+    def put_many(self, entries: Dict[str, LHEMetadata]):
+        """
+        Stores the metadata of several files ({filename: metadata}) with a single write of the index.
+        The index is not locked, so it must only be written by one process at a time.
+        """
+        index = self._load()
+        for filename, metadata in entries.items():
+            index[os.path.abspath(filename)] = {"signature": list(file_signature(filename)), "metadata": metadata.to_dict()}
+        # Writes to a temporary file first, so the index is never left half written
+        temporary_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as index_file:
+            json.dump(index, index_file, indent=4)
+        os.replace(temporary_path, self.index_path)
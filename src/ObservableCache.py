@@ -0,0 +1,108 @@
+"""Event-scoped cache that shares observable values between all the cuts and histograms applied to an event."""
+
+from contextlib import contextmanager
+from typing import Callable, Dict
+import functools
+import time
+
+# Cache used by the cached observables. It is set by the EventLoop while it iterates over the events.
+_active_cache = None
+
+
+def _hashable(argument):
+    """Converts list arguments (e.g. lists of PIDs) to tuples, so they can be used in the cache keys."""
+    if isinstance(argument, (list, set)):
+        return tuple(argument)
+    return argument
+
+
+class ObservableCache:
+    """
+    Stores the values of the observables computed for the events (or EventBatch chunks) being analysed.
+    The EventLoop clears the cache whenever it moves to the next event or chunk, so each observable
+    decorated with cached_observable is evaluated at most once per event, whatever the number of
+    cuts, histograms and analyses using it.
+    """
+
+    def __init__(self):
+        # Maps (event id, observable name, arguments) to the observable value
+        self._values = {}
+        # Number of cached and computed values for each observable
+        self.hits = {}
+        self.misses = {}
+        # If profile is True, the time spent computing each observable is added to timings.
+        # The time of an observable includes the time of the cached observables it calls.
+        self.profile = False
+        self.timings = {}
+
+    def clear(self):
+        """Drops the stored values. Must be called before moving to a new set of events."""
+        self._values.clear()
+
+    def evaluate(self, name: str, observable: Callable, event, *args):
+        """Returns the cached value of the observable for the event, computing it if needed."""
+        key = (id(event), name, tuple(map(_hashable, args)))
+        try:
+            value = self._values[key]
+            self.hits[name] = self.hits.get(name, 0) + 1
+        except KeyError:
+            if self.profile:
+                start_time = time.perf_counter()
+                value = self._values[key] = observable(event, *args)
+                self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start_time
+            else:
+                value = self._values[key] = observable(event, *args)
+            self.misses[name] = self.misses.get(name, 0) + 1
+        return value
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Number of hits and misses for each observable."""
+        return {
+            name: {"hits": self.hits.get(name, 0), "misses": self.misses.get(name, 0)}
+            for name in sorted(set(self.hits) | set(self.misses))
+        }
+
+    def reset_stats(self):
+        """Sets the hit and miss counters (and the timings) to zero."""
+        self.hits.clear()
+        self.misses.clear()
+        self.timings.clear()
+
+    @contextmanager
+    def activate(self):
+        """Makes this the cache used by the cached observables inside the with block."""
+        global _active_cache
+        previous_cache, _active_cache = _active_cache, self
+        try:
+            yield self
+        finally:
+            _active_cache = previous_cache
+            self.clear()
+
+
+def cached_call(name: str, observable: Callable, event, *args):
+    """Evaluates observable(event, *args) through the active cache, if there is one."""
+    if _active_cache is None:
+        return observable(event, *args)
+    return _active_cache.evaluate(name, observable, event, *args)
+
+
+def cached_observable(observable: Callable = None, *, name: str = None) -> Callable:
+    """
+    Decorator for observables of the form observable(event, *args).
+    While an ObservableCache is active, the value computed for an event (or an EventBatch) is stored
+    and reused by any other cut or histogram that calls the observable with the same arguments.
+    The cached values are shared, so they must not be modified by the callers.
+
+    :param observable: The observable function.
+    :param name: Name used in the cache and in the statistics. Defaults to the qualified name of the function.
+    """
+    if observable is None:
+        return functools.partial(cached_observable, name=name)
+    observable_name = name or f"{observable.__module__}.{observable.__qualname__}"
+
+    @functools.wraps(observable)
+    def wrapper(event, *args):
+        return cached_call(observable_name, observable, event, *args)
+
+    return wrapper
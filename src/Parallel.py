@@ -0,0 +1,170 @@
+"""Runs the EventLoop on a pool of processes, distributing whole files or byte-range chunks of a single file."""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+from PyLHE_EventAnalysis.src.Analysis import EventAnalysis, EventLoop
+from PyLHE_EventAnalysis.src.Histogram import Histogram
+from PyLHE_EventAnalysis.src.CutFlow import merge_cutflows
+from PyLHE_EventAnalysis.src.Instrumentation import merge_profiles
+from PyLHE_EventAnalysis.src.LHEReader import range_reader, split_file
+from PyLHE_EventAnalysis.src.FileIO import detect_compression
+from PyLHE_EventAnalysis.src.EventIndex import EventIndex
+import copy
+import os
+
+
+def _run_event_loop(event_loop: EventLoop, filename: str, event_analyses: Dict[str, EventAnalysis]):
+    """Task executed by the workers. Each call books its own clones of the histogram template."""
+    return event_loop.analyse_events(filename=filename, event_analyses=event_analyses)
+
+
+def merge_results(results: List[Dict[str, Histogram]]) -> Dict[str, Histogram]:
+    """
+    Merges the histograms booked for the same analyses in several runs, adding up their number of events,
+    cut-flows, profiling reports and reader statistics.
+    The results are merged in the order they are given, so the output is deterministic.
+    """
+    merged, *others = results
+    for result in others:
+        for analysis_name, hist in merged.items():
+            hist.merge_hist(result[analysis_name])
+        merged.metadata.num_events += result.metadata.num_events
+        merged.cutflow = merge_cutflows(merged.cutflow, result.cutflow)
+        if merged.profile is not None and result.profile is not None:
+            merged.profile = merge_profiles(merged.profile, result.profile)
+        if merged.reader_statistics is not None and result.reader_statistics is not None:
+            merged.reader_statistics = {
+                key: count + result.reader_statistics[key] for key, count in merged.reader_statistics.items()
+            }
+    return merged
+
+
+class ParallelEventLoop:
+    """
+    Runs an EventLoop on a pool of processes.
+    The file reader, the histogram template and the analyses are sent to the workers,
+    so they must be picklable (e.g. functions and classes defined at module level).
+    To split a single file into chunks, the file reader of the EventLoop must take the start and end
+    byte offsets, like the built-in readers of LHEReader (see LHEReader.range_reader).
+    """
+
+    def __init__(self, event_loop: EventLoop, n_workers: int = None, use_event_index: bool = True,
+                 save_event_index: bool = False):
+        """
+        :param event_loop: The EventLoop to be executed by the workers.
+        :param n_workers: Number of processes. Defaults to the number of CPUs.
+        :param use_event_index: Whether a single file is split with its EventIndex sidecar file, if it
+                                has an up-to-date one, so the chunks hold the same number of events.
+        :param save_event_index: Whether the EventIndex built to split a file on the partial sums of the
+                                 EventLoop is written to its sidecar file. By default, it is only kept in memory.
+        """
+        self._event_loop = event_loop
+        self._n_workers = n_workers
+        self.use_event_index = use_event_index
+        self.save_event_index = save_event_index
+
+    def _fills_partial_sums(self, filename: str) -> bool:
+        """Whether the chunks of the file are split on the partial sums of the EventLoop."""
+        return (
+            self._event_loop.partial_events is not None and not self._event_loop.fused
+            and detect_compression(filename) is None
+        )
+
+    def split(self, filename: str, n_chunks: int):
+        """
+        Byte ranges of the chunks. If the EventLoop fills partial sums (see EventLoop.partial_events), each
+        chunk holds a contiguous group of whole partial sums, located with the EventIndex of the file
+        (built in memory if needed), so there are at most n_chunks chunks.
+        Otherwise, the n_chunks chunks are balanced by number of events if the file has an EventIndex, else by size.
+        """
+        if self._fills_partial_sums(filename):
+            partial_events = self._event_loop.partial_events
+            if self.use_event_index:
+                event_index = EventIndex.open(filename, save=self.save_event_index)
+            else:
+                event_index = EventIndex.build(filename)
+            if len(event_index) == 0:
+                return [(0, None)]
+            n_partials = -(-len(event_index) // partial_events)
+            n_chunks = min(n_chunks, n_partials)
+            # Index of the first partial sum of each chunk
+            bounds = [chunk * n_partials // n_chunks for chunk in range(n_chunks + 1)]
+            return [
+                event_index.byte_range(first * partial_events, last * partial_events)
+                for first, last in zip(bounds[:-1], bounds[1:])
+            ]
+        event_index = EventIndex.load(filename) if self.use_event_index else None
+        if event_index is not None:
+            return event_index.split(n_chunks)
+        return split_file(filename, n_chunks)
+
+    def analyse_files(self, filenames: List[str], event_analyses: Dict[str, EventAnalysis]):
+        """
+        Runs the analyses on each file in a separate task.
+
+        :return: Dict with the result of EventLoop.analyse_events for each file.
+        """
+        # The workers do not write to the metadata index concurrently, it is updated once they finished
+        event_loop = copy.copy(self._event_loop)
+        event_loop.metadata_index = None
+        with ProcessPoolExecutor(max_workers=self._n_workers) as executor:
+            results = dict(zip(filenames, executor.map(
+                _run_event_loop, [event_loop] * len(filenames), filenames, [event_analyses] * len(filenames)
+            )))
+        if self._event_loop.metadata_index is not None:
+            # The number of events of a file read partially is not stored in the index
+            self._event_loop.metadata_index.put_many({
+                filename: result.metadata for filename, result in results.items() if result.early_stopping is None
+            })
+        return results
+
+    def analyse_events(self, filename: str, event_analyses: Dict[str, EventAnalysis], n_chunks: int = None):
+        """
+        Splits a single file into byte-range chunks, analyses them in parallel and merges the histograms.
+        If the EventLoop fills partial sums (see EventLoop.partial_events), the chunks hold whole partial sums,
+        which the workers return separately (see EventLoop.keep_partial_sums). The merge adds them in file order,
+        like the serial run, so the histograms match it bit-for-bit.
+        This requires the partial_events of the EventLoop to be a multiple of the batch size of EventBatch
+        readers, and a reader without prefilter: the partial sums of the serial run count the events
+        accepted by the prefilter, while the chunks count all the events of the file.
+        Event counts are identical to the serial run in all cases.
+        An EventLoop with an EarlyStopping can not split a file, since each chunk would stop on its own;
+        analyse_files applies it to each file, as in the serial run.
+
+        :param filename: Path to the .lhe file.
+        :param event_analyses: Dictionary with all the analyses applied to the events.
+        :param n_chunks: Number of chunks (at most the number of partial sums, if the EventLoop fills them).
+                         Defaults to the number of workers.
+
+        :return: Dict with the booked histogram for each analysis, as returned by EventLoop.analyse_events.
+        """
+        if self._event_loop.early_stopping is not None:
+            raise ValueError("A file can not be split into chunks with an EarlyStopping, use analyse_files instead.")
+        n_chunks = n_chunks or self._n_workers or os.cpu_count()
+        keep_partial_sums = self._fills_partial_sums(filename)
+        # One EventLoop for each chunk of the file
+        event_loops = [
+            self._event_loop.with_reader(range_reader(self._event_loop.file_reader, start, end))
+            for start, end in self.split(filename, n_chunks)
+        ]
+        n_chunks = len(event_loops)
+        for event_loop in event_loops:
+            # The chunks only know their own number of events, so the index is updated after merging
+            event_loop.metadata_index = None
+            event_loop.keep_partial_sums = keep_partial_sums
+        with ProcessPoolExecutor(max_workers=self._n_workers) as executor:
+            results = list(executor.map(
+                _run_event_loop, event_loops, [filename] * n_chunks, [event_analyses] * n_chunks
+            ))
+        # Merges the chunks in file order
+        merged = merge_results(results)
+        if keep_partial_sums:
+            # The booked histograms of the chunks are empty, the partial sums are added in file order
+            for result in results:
+                for partial_hist in result.partial_sums:
+                    for analysis_name, hist in merged.items():
+                        hist.merge_hist(partial_hist[analysis_name])
+            merged.partial_sums = None
+        if self._event_loop.metadata_index is not None:
+            self._event_loop.metadata_index.put(filename, merged.metadata)
+        return merged
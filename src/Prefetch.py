@@ -0,0 +1,140 @@
+"""Reads and parses the events in a background thread while the EventLoop analyses the previous ones."""
+
+from typing import Callable, Iterator, Optional
+import collections
+import threading
+import time
+
+
+class PrefetchStream:
+    """
+    Iterator over the chunks yielded by a file reader running in a background thread.
+    At most depth chunks (and, if max_bytes is given, about max_bytes of EventBatch arrays) are
+    kept in the queue. Exceptions raised by the reader are raised again by the iterator, and closing
+    the iterator stops the thread. The stall_time attribute holds the time spent waiting for the reader.
+
+    If the iterator is closed before the end of the file (e.g. by EarlyStopping), the number of events
+    read and skipped in the statistics is reset to the last chunk returned, so the events read ahead
+    do not count in the normalisation.
+    """
+
+    def __init__(self, chunks: Iterator, depth: int = 4, max_bytes: int = None):
+        """
+        :param chunks: The events (or EventBatch chunks) yielded by the file reader.
+        :param depth: Maximum number of chunks read ahead.
+        :param max_bytes: Maximum memory used by the chunks read ahead. At least one chunk is always queued.
+        """
+        self._chunks = chunks
+        self._depth = depth
+        self._max_bytes = max_bytes
+        # The statistics of the built-in readers (see LHEReader.EventStream)
+        self.statistics = getattr(chunks, "statistics", None)
+        self.stall_time = 0.0
+        self._queue = collections.deque()
+        self._queued_bytes = 0
+        self._condition = threading.Condition()
+        self._finished = False
+        self._exhausted = False
+        self._stopped = False
+        # State of the statistics when the last chunk returned was read
+        self._consumed_counts = None
+        self._error = None
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _is_full(self, chunk_bytes: int) -> bool:
+        if len(self._queue) >= self._depth:
+            return True
+        return self._max_bytes is not None and bool(self._queue) and self._queued_bytes + chunk_bytes > self._max_bytes
+
+    def _produce(self):
+        """Runs in the background thread."""
+        try:
+            for chunk in self._chunks:
+                # Per-event records are small; only the EventBatch arrays count for the memory cap
+                chunk_bytes = getattr(chunk, "nbytes", 0)
+                counts = None
+                if self.statistics is not None:
+                    counts = self.statistics.state_dict()
+                with self._condition:
+                    while not self._stopped and self._is_full(chunk_bytes):
+                        self._condition.wait()
+                    if self._stopped:
+                        break
+                    self._queue.append((chunk, chunk_bytes, counts))
+                    self._queued_bytes += chunk_bytes
+                    self._condition.notify_all()
+        except BaseException as error:
+            self._error = error
+        finally:
+            close = getattr(self._chunks, "close", None)
+            if close is not None:
+                close()
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._condition:
+            if not self._queue and not self._finished:
+                start_time = time.perf_counter()
+                while not self._queue and not self._finished:
+                    self._condition.wait()
+                self.stall_time += time.perf_counter() - start_time
+            if self._queue:
+                chunk, chunk_bytes, self._consumed_counts = self._queue.popleft()
+                self._queued_bytes -= chunk_bytes
+                self._condition.notify_all()
+                return chunk
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            self._exhausted = True
+            raise StopIteration
+
+    def close(self):
+        """Stops the background thread and drops the chunks read ahead."""
+        with self._condition:
+            self._stopped = True
+            self._queue.clear()
+            self._queued_bytes = 0
+            self._condition.notify_all()
+        self._thread.join()
+        if not self._exhausted and self._consumed_counts is not None:
+            self.statistics.n_read = self._consumed_counts["n_read"]
+            self.statistics.n_skipped = self._consumed_counts["n_skipped"]
+
+    @property
+    def consumed_statistics(self) -> Optional[dict]:
+        """
+        State of the statistics (see LHEReader.ReadStatistics.state_dict) when the last chunk returned was read,
+        without the events read ahead. None if the reader has no statistics or no chunk was returned yet.
+        """
+        return self._consumed_counts
+
+
+class PrefetchReader:
+    """
+    Wraps a file reader so the events are read and parsed in a background thread (see PrefetchStream).
+    An instance can be given as the file_reader of the EventLoop, or the EventLoop can wrap its reader
+    itself with the prefetch argument.
+
+    Parsing in Python holds the GIL for most of the time, so the overlap comes mainly from the file
+    reads, the decompression and the NumPy calls, which release it.
+    """
+
+    def __init__(self, file_reader: Callable, depth: int = 4, max_bytes: int = None):
+        """
+        :param file_reader: Function that takes the filename and yields the events (or EventBatch chunks).
+        :param depth: Maximum number of chunks read ahead.
+        :param max_bytes: Maximum memory used by the EventBatch chunks read ahead.
+        """
+        self._file_reader = file_reader
+        self.depth = depth
+        self.max_bytes = max_bytes
+
+    def __call__(self, filename: str) -> PrefetchStream:
+        return PrefetchStream(self._file_reader(filename), depth=self.depth, max_bytes=self.max_bytes)
@@ -0,0 +1,404 @@
+"""
+Runs the analysis of many .lhe files split into shards, e.g. as the jobs of a batch cluster, and
+merges the histograms of the shards, normalised to the cross-section of each file.
+
+The files and the analysis are described by a JSON manifest:
+
+    {
+        "analysis": "PyLHE_EventAnalysis.examples.FCC_hh.tau_leptonic.analyse_events:build_analysis",
+        "files": {"template": "mU1_10TeV/x1L-x1L-x1L-x1L-bin-{bin}.lhe", "parameters": {"bin": [1, 2, 3]}},
+        "n_shards": 8,
+        "scale": 2.0,
+        "output_dir": "shards",
+        "checkpoint_dir": "checkpoints"
+    }
+
+analysis is "module:function", the function returning the EventLoop and the dictionary of EventAnalysis.
+files is a list of paths or of {"path": ..., "cross_section": ...} objects, the cross-section (in pb)
+replacing the one read from the file, or a template expanded over all the combinations of the
+parameters. Relative paths are relative to the directory of the manifest. checkpoint_dir is optional
+(see Checkpoint.CheckpointRunner), so preempted jobs resume where they stopped.
+
+Shard i analyses the files i, i + n_shards, i + 2 n_shards, ... and writes shard-{i}.npz to the
+output directory, holding the unnormalised histograms and the metadata of each file. The merge
+weights the histograms of each file by scale * cross_section / num_events and adds them up. Histograms
+already filled with the event weights (e.g. WeightedHistogram) are normalised by the generator, in
+which case "normalise": false in the manifest weights them by scale only.
+
+Usage:
+    python -m PyLHE_EventAnalysis.src.Shards run manifest.json --shard 3
+    python -m PyLHE_EventAnalysis.src.Shards merge manifest.json [--output merged.npz] [--json merged.json]
+    python -m PyLHE_EventAnalysis.src.Shards run-local manifest.json [--workers 4] [--output merged.npz]
+    python -m PyLHE_EventAnalysis.src.Shards serve [manifest.json] < requests.jsonl
+
+serve runs the shards requested on its standard input, one JSON object per line such as
+{"shard": 3} or {"manifest": "other.json", "shard": 0, "output": "shard-0.npz"}, and writes one
+JSON line per request with the path of the histogram file (or the error). The process, the imports
+and the analyses built from each manifest are reused for all the requests, so short jobs only pay
+for them once.
+"""
+
+from typing import Dict, List, Optional, Tuple
+from PyLHE_EventAnalysis.src.Analysis import AnalysisResult, EventAnalysis, EventLoop
+from PyLHE_EventAnalysis.src.Checkpoint import CheckpointRunner, analysis_fingerprint
+from PyLHE_EventAnalysis.src.CutFlow import merge_cutflows
+from PyLHE_EventAnalysis.src.Histogram import Histogram
+from PyLHE_EventAnalysis.src.Metadata import LHEMetadata
+from PyLHE_EventAnalysis.src.Utilities import file_signature
+import argparse
+import contextlib
+import copy
+import importlib
+import itertools
+import json
+import os
+import sys
+import time
+import numpy as np
+
+# Identifier and version of the histogram file format
+HISTOGRAM_FILE_FORMAT = "PyLHE_EventAnalysis.histograms"
+HISTOGRAM_FILE_VERSION = 1
+
+
+def save_histogram_file(path: str, header: Dict, histograms: Dict[str, Dict[str, Histogram]]):
+    """
+    Writes the groups of histograms ({group: {analysis: histogram}}) and the JSON header to a compressed
+    .npz file. The file is written atomically, so an interrupted job never leaves a truncated file.
+    """
+    header = {"format": HISTOGRAM_FILE_FORMAT, "version": HISTOGRAM_FILE_VERSION, **header}
+    arrays = {
+        f"{group}/{analysis_name}/{key}": value
+        for group, analyses_hist in histograms.items()
+        for analysis_name, hist in analyses_hist.items() for key, value in hist.state_dict().items()
+    }
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as histogram_file:
+        np.savez_compressed(histogram_file, header=np.array(json.dumps(header)), **arrays)
+    os.replace(temporary_path, path)
+
+
+def load_histogram_file(path: str) -> Tuple[Dict, Dict[str, Dict[str, Dict[str, np.ndarray]]]]:
+    """Reads the header and the histogram states ({group: {analysis: state}}) of a histogram file."""
+    with np.load(path, allow_pickle=False) as histogram_file:
+        header = json.loads(str(histogram_file["header"]))
+        if header.get("format") != HISTOGRAM_FILE_FORMAT:
+            raise ValueError(f"{path} is not a histogram file.")
+        if header.get("version") != HISTOGRAM_FILE_VERSION:
+            raise ValueError(f"{path} has version {header.get('version')} of the format, expected {HISTOGRAM_FILE_VERSION}.")
+        states = {}
+        for key in histogram_file.files:
+            if key != "header":
+                group, analysis_name, state_key = key.split("/", 2)
+                states.setdefault(group, {}).setdefault(analysis_name, {})[state_key] = histogram_file[key]
+    return header, states
+
+
+def _load_histograms(template: Histogram, states: Dict[str, Dict[str, np.ndarray]]) -> Dict[str, Histogram]:
+    """Clones of the template with the booked content of each analysis."""
+    analyses_hist = {}
+    for analysis_name, state in states.items():
+        analyses_hist[analysis_name] = copy.copy(template)
+        analyses_hist[analysis_name].load_state_dict(state)
+    return analyses_hist
+
+
+class ShardManifest:
+    """The files, the analysis and the sharding read from a JSON manifest (see the module documentation)."""
+
+    def __init__(self, path: str):
+        """
+        :param path: Path to the JSON manifest.
+        """
+        self.path = os.path.abspath(path)
+        with open(self.path) as manifest_file:
+            manifest = json.load(manifest_file)
+        base_dir = os.path.dirname(self.path)
+        self.analysis = manifest["analysis"]
+        self.files = [
+            {**entry, "path": os.path.join(base_dir, entry["path"])} for entry in self._expand_files(manifest["files"])
+        ]
+        self.n_shards = manifest.get("n_shards", 1)
+        self.scale = manifest.get("scale", 1.0)
+        self.normalise = manifest.get("normalise", True)
+        self.output_dir = os.path.join(base_dir, manifest.get("output_dir", "shards"))
+        checkpoint_dir = manifest.get("checkpoint_dir")
+        self.checkpoint_dir = os.path.join(base_dir, checkpoint_dir) if checkpoint_dir is not None else None
+
+    @staticmethod
+    def _expand_files(files) -> List[Dict]:
+        """File entries of the manifest, with the templates expanded."""
+        if isinstance(files, dict):
+            names = list(files["parameters"])
+            return [
+                {"path": files["template"].format(**dict(zip(names, values)))}
+                for values in itertools.product(*(files["parameters"][name] for name in names))
+            ]
+        return [{"path": entry} if isinstance(entry, str) else dict(entry) for entry in files]
+
+    def build_analysis(self) -> Tuple[EventLoop, Dict[str, EventAnalysis]]:
+        """Imports the analysis module and calls its function returning the EventLoop and the analyses."""
+        module_name, function_name = self.analysis.split(":")
+        return getattr(importlib.import_module(module_name), function_name)()
+
+    def shard_files(self, shard_index: int) -> List[Dict]:
+        """File entries analysed by the shard."""
+        if not 0 <= shard_index < self.n_shards:
+            raise ValueError(f"Shard index {shard_index} out of range for {self.n_shards} shards.")
+        return self.files[shard_index::self.n_shards]
+
+    def shard_path(self, shard_index: int) -> str:
+        """Path of the histogram file written by the shard."""
+        return os.path.join(self.output_dir, f"shard-{shard_index}.npz")
+
+
+def run_shard(manifest: ShardManifest, shard_index: int, output: str = None,
+              analysis: Tuple[EventLoop, Dict[str, EventAnalysis]] = None) -> str:
+    """
+    Analyses the files of the shard and writes their unnormalised histograms and metadata to a histogram file.
+
+    :param analysis: The EventLoop and the analyses already built from the manifest. Built if not given.
+
+    :return: Path of the histogram file.
+    """
+    event_loop, event_analyses = analysis if analysis is not None else manifest.build_analysis()
+    runner = None
+    if manifest.checkpoint_dir is not None:
+        runner = CheckpointRunner(event_loop=event_loop, checkpoint_dir=manifest.checkpoint_dir)
+    files, histograms = [], {}
+    for entry in manifest.shard_files(shard_index):
+        filename = entry["path"]
+        if runner is not None:
+            result = runner.analyse_events(filename, event_analyses)
+        else:
+            result = event_loop.analyse_events(filename, event_analyses)
+        histograms[f"file-{len(files)}"] = result
+        files.append({
+            "path": filename, "signature": list(file_signature(filename)), "metadata": result.metadata.to_dict(),
+            "cutflow": result.cutflow, "reader_statistics": result.reader_statistics,
+        })
+    output = output or manifest.shard_path(shard_index)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    save_histogram_file(output, {
+        "kind": "shard", "manifest": manifest.path, "shard": shard_index, "n_shards": manifest.n_shards,
+        "fingerprint": analysis_fingerprint(event_loop, event_analyses),
+        "histogram": event_loop.histogram_template.config(), "files": files,
+    }, histograms)
+    return output
+
+
+def merge_shards(manifest: ShardManifest, shard_paths: List[str] = None, allow_missing: bool = False) -> AnalysisResult:
+    """
+    Merges the histograms of the shards, weighting the histograms of each file by
+    scale * cross_section / num_events, where the cross-section is the one given in the manifest
+    or, if not given, the one read from the file. If the manifest has normalise set to false, the
+    weight is scale.
+    The metadata of the result holds the sum of the normalised cross-sections and of the number of
+    events, and its cut-flow the unweighted sum of the cut-flow tables of the files.
+
+    :param manifest: The manifest the shards were run with.
+    :param shard_paths: Histogram files of the shards. Defaults to the files of all the shards of the manifest.
+    :param allow_missing: Whether files of the manifest missing from the shards are allowed.
+    """
+    event_loop, event_analyses = manifest.build_analysis()
+    template = event_loop.histogram_template
+    fingerprint = analysis_fingerprint(event_loop, event_analyses)
+    cross_sections = {entry["path"]: entry.get("cross_section") for entry in manifest.files}
+    if shard_paths is None:
+        shard_paths = [manifest.shard_path(shard_index) for shard_index in range(manifest.n_shards)]
+
+    merged = {analysis_name: copy.copy(template) for analysis_name in event_analyses}
+    merged_files, merged_paths, cutflow = [], set(), None
+    total_cross_section, total_events = 0.0, 0
+    for shard_path in shard_paths:
+        header, states = load_histogram_file(shard_path)
+        if header.get("kind") != "shard":
+            raise ValueError(f"{shard_path} is not the output of a shard.")
+        if header["fingerprint"] != fingerprint or header["histogram"] != template.config():
+            raise ValueError(f"{shard_path} was produced with a different analysis configuration.")
+        for file_index, file_entry in enumerate(header["files"]):
+            if file_entry["path"] in merged_paths:
+                raise ValueError(f"{file_entry['path']} appears in several shards.")
+            metadata = LHEMetadata.from_dict(file_entry["metadata"])
+            cross_section = cross_sections.get(file_entry["path"])
+            if cross_section is None:
+                cross_section = metadata.cross_section
+            if not manifest.normalise:
+                weight = manifest.scale
+            elif cross_section is None:
+                raise ValueError(f"No cross-section for {file_entry['path']}: give it in the manifest.")
+            else:
+                weight = manifest.scale * cross_section / metadata.num_events if metadata.num_events else 0.0
+            for analysis_name, hist in _load_histograms(template, states.get(f"file-{file_index}", {})).items():
+                hist.scale(weight)
+                merged[analysis_name].merge_hist(hist)
+            cutflow = file_entry["cutflow"] if cutflow is None else merge_cutflows(cutflow, file_entry["cutflow"])
+            if cross_section is not None:
+                total_cross_section += manifest.scale * cross_section
+            total_events += metadata.num_events
+            merged_paths.add(file_entry["path"])
+            merged_files.append({
+                "path": file_entry["path"], "cross_section": cross_section,
+                "num_events": metadata.num_events, "weight": weight,
+            })
+
+    missing = set(cross_sections) - merged_paths
+    if missing and not allow_missing:
+        raise ValueError(f"{len(missing)} files of the manifest are missing from the shards, e.g. {sorted(missing)[0]}")
+    result = AnalysisResult(merged, LHEMetadata(cross_section=total_cross_section, num_events=total_events), cutflow)
+    result.files = merged_files
+    result.fingerprint = fingerprint
+    return result
+
+
+def save_merged(path: str, result: AnalysisResult, manifest: ShardManifest):
+    """Writes the merged histograms to a histogram file."""
+    save_histogram_file(path, {
+        "kind": "merged", "manifest": manifest.path, "scale": manifest.scale, "normalise": manifest.normalise,
+        "fingerprint": result.fingerprint,
+        "histogram": next(iter(result.values())).config() if result else None,
+        "metadata": result.metadata.to_dict(), "cutflow": result.cutflow, "files": result.files,
+    }, {"merged": result})
+
+
+def load_merged(path: str, template: Histogram) -> Tuple[Dict, Dict[str, Histogram]]:
+    """Reads the header and the histograms of each analysis written by save_merged."""
+    header, states = load_histogram_file(path)
+    if header.get("kind") != "merged":
+        raise ValueError(f"{path} is not the output of a merge.")
+    return header, _load_histograms(template, states.get("merged", {}))
+
+
+class ShardWorker:
+    """
+    Runs shards in a persistent process. The manifests and the analyses built from them are kept
+    between the shards, and reloaded only if the manifest file changed.
+    """
+
+    def __init__(self):
+        # Signature of the manifest file, manifest and analysis, for each manifest path
+        self._manifests = {}
+
+    def load(self, manifest_path: str) -> Tuple[ShardManifest, Tuple[EventLoop, Dict[str, EventAnalysis]]]:
+        """The manifest and the EventLoop and analyses it builds."""
+        manifest_path = os.path.abspath(manifest_path)
+        signature = file_signature(manifest_path)
+        entry = self._manifests.get(manifest_path)
+        if entry is None or entry[0] != signature:
+            manifest = ShardManifest(manifest_path)
+            entry = (signature, manifest, manifest.build_analysis())
+            self._manifests[manifest_path] = entry
+        return entry[1], entry[2]
+
+    def run(self, manifest_path: str, shard_index: int, output: str = None) -> str:
+        """Runs the shard (see run_shard), returning the path of its histogram file."""
+        manifest, analysis = self.load(manifest_path)
+        return run_shard(manifest, shard_index, output, analysis=analysis)
+
+
+# Worker of each process of run_local, which may run several shards
+_worker = ShardWorker()
+
+
+def _run_shard_task(manifest_path: str, shard_index: int) -> str:
+    """Task executed by the local workers."""
+    return _worker.run(manifest_path, shard_index)
+
+
+def serve(manifest_path: str = None, requests=None, responses=None, worker: ShardWorker = None) -> int:
+    """
+    Runs the shards requested as JSON lines (see the module documentation) until the end of the input.
+    A failed request is reported in its response and does not stop the worker. The output of the
+    EventLoop is redirected to the standard error, so the responses are the only output.
+
+    :param manifest_path: Manifest of the requests that do not give one.
+    :param requests: Stream of requests. Defaults to the standard input.
+    :param responses: Stream of responses. Defaults to the standard output.
+    :param worker: ShardWorker running the shards.
+
+    :return: Number of failed requests.
+    """
+    requests = requests or sys.stdin
+    responses = responses or sys.stdout
+    worker = worker or ShardWorker()
+    n_failed = 0
+    for line in requests:
+        if not line.strip():
+            continue
+        start_time = time.perf_counter()
+        try:
+            request = json.loads(line)
+            shard_index = request["shard"]
+            if request.get("manifest", manifest_path) is None:
+                raise ValueError("The request does not give a manifest, and the worker has no default one.")
+            with contextlib.redirect_stdout(sys.stderr):
+                output = worker.run(request.get("manifest", manifest_path), shard_index, request.get("output"))
+            response = {"shard": shard_index, "output": output}
+        except Exception as error:
+            n_failed += 1
+            response = {"error": f"{type(error).__name__}: {error}", "request": line.strip()}
+        response["time"] = time.perf_counter() - start_time
+        responses.write(json.dumps(response) + "\n")
+        responses.flush()
+    return n_failed
+
+
+def run_local(manifest: ShardManifest, n_workers: int = None) -> List[str]:
+    """Runs all the shards of the manifest on a pool of local processes, returning the paths of their histogram files."""
+    # Imported here, so the cluster jobs running a single shard do not pay for it
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return list(executor.map(
+            _run_shard_task, [manifest.path] * manifest.n_shards, range(manifest.n_shards)
+        ))
+
+
+def _merge_and_save(manifest: ShardManifest, shard_paths: Optional[List[str]], args) -> AnalysisResult:
+    result = merge_shards(manifest, shard_paths, allow_missing=args.allow_missing)
+    output = args.output or os.path.join(manifest.output_dir, "merged.npz")
+    save_merged(output, result, manifest)
+    print(f"Merged {len(result.files)} files into {output}")
+    if args.json:
+        # Same layout as the JSON files written by the example drivers
+        with open(args.json, "w") as json_file:
+            json.dump({
+                analysis_name: {key: value.tolist() for key, value in hist.state_dict().items()}
+                for analysis_name, hist in result.items()
+            }, json_file, indent=4)
+    return result
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="Runs a single shard")
+    run_parser.add_argument("manifest")
+    run_parser.add_argument("--shard", type=int, required=True, help="Index of the shard, from 0 to n_shards - 1")
+    run_parser.add_argument("--output", help="Histogram file of the shard. Defaults to output_dir/shard-{index}.npz")
+    for command, help_text in (("merge", "Merges the shards"), ("run-local", "Runs all the shards locally and merges them")):
+        command_parser = commands.add_parser(command, help=help_text)
+        command_parser.add_argument("manifest")
+        command_parser.add_argument("--output", help="Merged histogram file. Defaults to output_dir/merged.npz")
+        command_parser.add_argument("--json", help="Also writes the merged histograms to this JSON file")
+        command_parser.add_argument("--allow-missing", action="store_true",
+                                    help="Merges even if some files of the manifest are not in the shards")
+    commands.choices["merge"].add_argument("--shards", nargs="+", help="Histogram files of the shards to merge")
+    commands.choices["run-local"].add_argument("--workers", type=int, help="Number of processes")
+    serve_parser = commands.add_parser("serve", help="Runs the shards requested on the standard input")
+    serve_parser.add_argument("manifest", nargs="?", help="Manifest of the requests that do not give one")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        return 1 if serve(args.manifest) else 0
+    manifest = ShardManifest(args.manifest)
+    if args.command == "run":
+        print(f"Shard written to {run_shard(manifest, args.shard, args.output)}")
+    elif args.command == "merge":
+        _merge_and_save(manifest, args.shards, args)
+    else:
+        _merge_and_save(manifest, run_local(manifest, args.workers), args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,28 @@
+from PyLHE_EventAnalysis.src.FileIO import open_lhe_text
+import hashlib
+import os
 
 
 def read_xsection(path_to_file: str):
-    """Reads the cross-section from a .lhe or banner file"""
-    with open(path_to_file) as info_file:
+    """Reads the cross-section from a .lhe or banner file (possibly compressed)"""
+    with open_lhe_text(path_to_file) as info_file:
         for line in info_file:
             if line.startswith("#  Integrated weight (pb)  :"):
                 _, xsection = line.split(":")
                 return float(xsection)
     return None
+
+
+def file_signature(path_to_file: str):
+    """Returns the size and the modification time (in ns) of the file, used to detect modified files."""
+    file_stat = os.stat(path_to_file)
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+
+def file_hash(path_to_file: str) -> str:
+    """Hash of the whole content of the file, used to detect files rewritten with the same size and modification time."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path_to_file, "rb") as data_file:
+        for block in iter(lambda: data_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()